@@ -1,6 +1,7 @@
 import asyncio
 import os
 import json
+import time
 
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
@@ -14,9 +15,10 @@ from yapapi.log import enable_default_logger
 
 import argparse
 import asyncio
+import sys
 import tempfile
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional
 
 import colorama  # type: ignore
 
@@ -24,8 +26,21 @@ from yapapi import Golem, NoPaymentAccountError
 from yapapi import __version__ as yapapi_version
 from yapapi import windows_event_loop_fix
 from yapapi.log import enable_default_logger
-from yapapi.strategy import SCORE_TRUSTED, SCORE_REJECTED, MarketStrategy
+from yapapi.strategy import SCORE_REJECTED, MarketStrategy
 from yapapi.strategy.base import PropValueRange, PROP_DEBIT_NOTE_INTERVAL_SEC, PROP_PAYMENT_TIMEOUT_SEC
+from yapapi.events import DebitNoteAccepted, InvoiceAccepted, ServiceStateChanged
+
+# Modules shared with example/ai-requestor, the build bundles them with `pyinstaller --paths`.
+sys.path.append(str(Path(__file__).resolve().parents[2] / "example" / "ai-requestor"))
+
+from autoscale import Autoscaler, ScalingOptions, Spending
+from fleet import Fleet
+from gateway import TXT2IMG_URL, Gateway
+from models import MODELS, ModelSpec
+from readiness import InstanceHealth, ProbeOptions, ReadinessMonitor
+from registry import ActivityHandle, ActivityRegistry
+from scoring import REFERENCE_SECONDS_PER_IMAGE, OfferEstimate, OfferScorer, ScoringOptions
+from state_feed import StateFeed, open_channel
 
 # Utils
 
@@ -60,8 +75,153 @@ def build_parser(description: str) -> argparse.ArgumentParser:
         help="Log file for YAPAPI; default: %(default)s",
     )
     parser.add_argument("--runtime", default="dummy", help="Runtime name, for example `automatic`")
+    parser.add_argument(
+        "--model",
+        default=None,
+        choices=sorted(MODELS),
+        help="Model deployed on providers; default: mobilenet-v3-small for `dummy` runtime, sd-1.5 otherwise",
+    )
     parser.add_argument("--descriptor", default=None, help="Path to node descriptor file")
     parser.add_argument("--pay-interval", default=180, help="Interval of making partial payments")
+    parser.add_argument(
+        "--num-instances",
+        type=int,
+        default=1,
+        help="Number of providers to keep running, failed ones are replaced; default: %(default)s",
+    )
+    parser.add_argument("--gpu-model", default=None, help="Hire only providers with GPU model matching this regex")
+    parser.add_argument("--min-vram", type=float, default=0.0, help="Minimum GPU memory in GiB; default: %(default)s")
+    parser.add_argument(
+        "--max-seconds-per-image",
+        type=float,
+        default=None,
+        help="Reject GPUs estimated to be slower than this",
+    )
+    parser.add_argument(
+        "--max-cost-per-image",
+        type=float,
+        default=None,
+        help="Reject offers with higher expected GLM cost per image",
+    )
+    parser.add_argument(
+        "--require-gpu",
+        action="store_true",
+        help="Reject offers without GAP-35 GPU properties",
+    )
+    parser.add_argument(
+        "--reference-seconds-per-image",
+        type=float,
+        default=REFERENCE_SECONDS_PER_IMAGE,
+        help="Expected generation time on RTX 3090, scales speed estimates of all GPUs; default: %(default)s",
+    )
+    parser.add_argument(
+        "--state-feed",
+        default=None,
+        help="Write instance state changes as JSON lines here: `fd:N` or path of a file or named pipe",
+    )
+    parser.add_argument(
+        "--gateway-port",
+        type=int,
+        default=None,
+        help="Serve /sdapi/v1/txt2img on this port, spreading requests over all running instances",
+    )
+    parser.add_argument("--gateway-host", default="127.0.0.1", help="Address of gateway; default: %(default)s")
+    parser.add_argument(
+        "--max-per-provider",
+        type=int,
+        default=1,
+        help="Requests sent to one provider at a time by the gateway; default: %(default)s",
+    )
+    parser.add_argument(
+        "--max-queue",
+        type=int,
+        default=32,
+        help="Requests the gateway holds while all providers are busy, more are rejected with 503; default: %(default)s",
+    )
+    parser.add_argument(
+        "--queue-timeout",
+        type=float,
+        default=60.0,
+        help="Seconds a request waits for a free provider before 503; default: %(default)s",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=4.0,
+        help="Maximum GLM spent in this run; default: %(default)s",
+    )
+    parser.add_argument(
+        "--max-instances",
+        type=int,
+        default=None,
+        help="Grow and shrink the cluster with gateway load up to this many providers; default: fixed size",
+    )
+    parser.add_argument(
+        "--min-instances",
+        type=int,
+        default=1,
+        help="Providers kept when idle, with --max-instances; default: %(default)s",
+    )
+    parser.add_argument(
+        "--scale-up-queue",
+        type=float,
+        default=2.0,
+        help="Hire more providers when more requests per provider than this wait in the gateway; default: %(default)s",
+    )
+    parser.add_argument(
+        "--scale-up-p95",
+        type=float,
+        default=None,
+        help="Hire more providers when p95 of request duration in seconds exceeds this while requests wait",
+    )
+    parser.add_argument(
+        "--scale-down-idle",
+        type=float,
+        default=120.0,
+        help="Stop providers which got no requests for this many seconds; default: %(default)s",
+    )
+    parser.add_argument(
+        "--scale-up-cooldown",
+        type=float,
+        default=30.0,
+        help="Seconds after resizing the cluster before it grows again; default: %(default)s",
+    )
+    parser.add_argument(
+        "--scale-down-cooldown",
+        type=float,
+        default=120.0,
+        help="Seconds after resizing the cluster before it shrinks again; default: %(default)s",
+    )
+    parser.add_argument(
+        "--budget-share",
+        type=float,
+        default=0.9,
+        help="Stop hiring and stop idle providers once this share of --budget is spent; default: %(default)s",
+    )
+    parser.add_argument(
+        "--ready-timeout",
+        type=float,
+        default=1800.0,
+        help="Seconds a provider has to download and load the model before it is given up; default: %(default)s",
+    )
+    parser.add_argument(
+        "--liveness-interval",
+        type=float,
+        default=30.0,
+        help="Seconds between liveness probes of ready providers, 0 disables them; default: %(default)s",
+    )
+    parser.add_argument(
+        "--liveness-failures",
+        type=int,
+        default=3,
+        help="Failed liveness probes in a row after which provider gets no more requests; default: %(default)s",
+    )
+    parser.add_argument(
+        "--request-timeout",
+        type=float,
+        default=600.0,
+        help="Timeout of a single inference request in seconds; default: %(default)s",
+    )
     return parser
 
 
@@ -129,28 +289,38 @@ def run_golem_example(example_main, log_file=None):
 
 
 class ProviderOnceStrategy(MarketStrategy):
-    """Hires provider only once.
+    """Hires provider only once, preferring GPUs with most images per GLM.
     """
 
-    def __init__(self, pay_interval=180):
+    def __init__(self, pay_interval=180, scorer: Optional[OfferScorer] = None):
         self.history = set(())
+        self.scorer = scorer or OfferScorer()
+        self.estimates: Dict[str, OfferEstimate] = {}
         self.acceptable_prop_value_range_overrides =  {
             PROP_DEBIT_NOTE_INTERVAL_SEC: PropValueRange(60, None),
             PROP_PAYMENT_TIMEOUT_SEC: PropValueRange(int(pay_interval), None),
         }
 
     async def score_offer(self, offer):
-        if offer.issuer not in self.history:
-            return SCORE_TRUSTED
-        else:
+        if offer.issuer in self.history:
             return SCORE_REJECTED
+        estimate = self.scorer.estimate(offer.props)
+        if self.scorer.rejection(estimate) is not None:
+            return SCORE_REJECTED
+        self.estimates[offer.issuer] = estimate
+        return self.scorer.score(estimate)
 
 
     def remember(self, provider_id: str):
         self.history.add(provider_id)
+        estimate = self.estimates.get(provider_id)
+        if estimate is not None:
+            print(f"Hired {provider_id}: {estimate.describe()}")
+
 
 # App
 
+
 @dataclass
 class AiPayload(Payload):
     image_url: str = prop("golem.srv.comp.ai.model")
@@ -164,6 +334,7 @@ class AiPayload(Payload):
 class AiRuntimeService(Service):
     runtime: str
     node_descriptor: Optional[str] = None
+    model: Optional[ModelSpec] = None
 
     @staticmethod
     async def get_payload():
@@ -171,16 +342,14 @@ class AiRuntimeService(Service):
             node_descriptor = json.loads(open(AiRuntimeService.node_descriptor, "r").read())
         else:
             node_descriptor = None
-        
-        if AiRuntimeService.runtime == "dummy":
-            return AiPayload(
-                image_url="hash:sha3:eb222a9f6afa502a379b2315ec9f1e853ba7013f7240bfa47fb2f455375fea9c:https://huggingface.co/timm/tf_mobilenetv3_small_minimal_100.in1k/resolve/main/model.safetensors?download=true",
-                runtime="dummy",
-                node_descriptor=node_descriptor
-            )
+
+        model = AiRuntimeService.model
+        if model is None:
+            model = MODELS["mobilenet-v3-small" if AiRuntimeService.runtime == "dummy" else "sd-1.5"]
         return AiPayload(
-            image_url="hash:sha3:b2da48d618beddab1887739d75b50a3041c810bc73805a416761185998359b24:https://huggingface.co/runwayml/stable-diffusion-v1-5/resolve/main/v1-5-pruned-emaonly.safetensors?download=true",
-            runtime="automatic",
+            image_url=model.url,
+            image_fmt=model.format,
+            runtime=AiRuntimeService.runtime,
             node_descriptor=node_descriptor
         )
 
@@ -201,87 +370,176 @@ class AiRuntimeService(Service):
         
 
 async def main(subnet_tag, descriptor, driver=None, network=None, runtime="dummy", args=None):
-    strategy = ProviderOnceStrategy(pay_interval=args.pay_interval)
+    strategy = ProviderOnceStrategy(
+        pay_interval=args.pay_interval,
+        scorer=OfferScorer(
+            ScoringOptions(
+                gpu_model=args.gpu_model,
+                min_vram_gib=args.min_vram,
+                max_seconds_per_image=args.max_seconds_per_image,
+                max_cost_per_image=args.max_cost_per_image,
+                require_gpu=args.require_gpu,
+                reference_seconds_per_image=args.reference_seconds_per_image,
+            )
+        ),
+    )
     async with Golem(
-        budget=4.0,
+        budget=args.budget,
         subnet_tag=subnet_tag,
         strategy=strategy,
         payment_driver=driver,
         payment_network=network,
     ) as golem:
+        def print_usage(handle: ActivityHandle):
+            token = golem._engine._api_config.app_key
+
+            print([handle.activity.id])
+
+            custom_url = "/sdapi/v1/txt2img"
+            url = handle.url + custom_url
+
+            print('Request example:\n')
+            if os.name == 'nt':
+                payload = '"prompt"="happy golem"'
+                headers = (
+                    f"\"Authorization\" = \"Bearer {token}\"; "
+                    "\"Content-Type\" = \"application/json; charset=utf-8\"; "
+                    "\"Accept\" = \"text/event-stream\""
+                )
+                powershell_cmd = (
+                    f"$images = Invoke-WebRequest -Method POST -Headers @{{ {headers} }} -Body (@{{ {payload} }}|ConvertTo-Json) -Uri {url} | ConvertFrom-Json | Select images | Select-Object -Index 0\n"
+                    "$bytes = [Convert]::FromBase64String($images.images)\n"
+                    "$filename = \"C:\\Windows\\Temp\\output.png\"\n"
+                    "[IO.File]::WriteAllBytes($filename, $bytes)\n"
+                    "explorer C:\\Windows\\Temp\\output.png\n"
+                )
+                print(powershell_cmd)
+            else:
+                payload = '{ \\"prompt\\": \\"happy golem\\" }'
+                headers = (
+                    f"-H \'Authorization: Bearer {token}\' "
+                    "-H \'Content-Type: application/json; charset=utf-8\' "
+                    "-H \'Accept: text/event-stream\' "
+                )
+                pipe_image_cmd = '| jq -r ".images[0]" | base64 --decode > output.png && xdg-open output.png'
+                print(f'curl -X POST {headers} -d "{payload}" {url} {pipe_image_cmd}')
+
+        gateway = None
+        if args.gateway_port is not None:
+            gateway = Gateway(args.max_per_provider, args.max_queue, args.queue_timeout, args.request_timeout)
+
+        feed = StateFeed(open_channel(args.state_feed) if args.state_feed else None)
+
+        announced = set()
+
+        def on_added(handle: ActivityHandle):
+            if handle.activity.id not in announced:
+                announced.add(handle.activity.id)
+                print_usage(handle)
+            if readiness is not None:
+                readiness.add(handle)
+
+        def on_ready(health: InstanceHealth):
+            handle = health.handle
+            feed.emit({
+                "ts": round(time.time(), 3),
+                "event": "ready",
+                "service": handle.service.id,
+                "provider_id": handle.service.provider_id,
+                "provider_name": handle.service.provider_name,
+                "activity": handle.activity.id,
+                "warm_up": round(health.warm_up, 3),
+            })
+            gateway.add(handle)
+
+        def retire(health: InstanceHealth):
+            # Stopped instances are replaced by the fleet, so a dead provider is not paid for idle.
+            gateway.remove(health.handle.service.id)
+            service = health.handle.service
+            if service.cluster is not None and not service.cluster.service_runner.stopped:
+                print(f"Stopping {health.handle.provider_name} ({health.state})")
+                service.cluster.stop_instance(service)
+
+        # Gateway sends requests only to instances which answered a warm-up request.
+        readiness = None
+        if gateway is not None:
+            readiness = ReadinessMonitor(
+                ProbeOptions(
+                    ready_timeout=args.ready_timeout,
+                    liveness_interval=args.liveness_interval,
+                    liveness_failures=args.liveness_failures,
+                )
+            )
+            readiness.add_listener(on_ready=on_ready, on_unhealthy=retire, on_failed=retire)
+
+        def on_removed(handle: ActivityHandle):
+            if readiness is not None:
+                readiness.remove(handle)
+            if gateway is not None:
+                gateway.remove(handle.service_id)
+
+        registry = ActivityRegistry(golem._engine._api_config.app_key)
+        registry.add_listener(on_added=on_added, on_removed=on_removed)
+        golem.add_event_consumer(registry.consume, [ServiceStateChanged])
+        golem.add_event_consumer(feed.consume, [ServiceStateChanged])
+        target = args.num_instances
+        if args.max_instances is not None:
+            target = min(max(target, args.min_instances), args.max_instances)
+        fleet = Fleet(target, {"strategy": strategy}, feed)
+        golem.add_event_consumer(fleet.consume, [ServiceStateChanged])
+        spending = Spending()
+        golem.add_event_consumer(spending.consume, [DebitNoteAccepted, InvoiceAccepted])
+
         AiRuntimeService.runtime = runtime
         AiRuntimeService.node_descriptor = descriptor
+        AiRuntimeService.model = MODELS[args.model] if args.model else None
         cluster = await golem.run_service(
             AiRuntimeService,
-            instance_params=[
-                {"strategy": strategy}
-            ],
-            num_instances=1,
+            instance_params=[fleet.instance_params] * fleet.target,
+            num_instances=fleet.target,
             expiration=datetime.now(timezone.utc) + timedelta(days=10),
         )
+        fleet.track(cluster)
+
+        if gateway is not None:
+            await gateway.start(args.gateway_host, args.gateway_port)
+            print(f"Gateway: POST http://{args.gateway_host}:{args.gateway_port}{TXT2IMG_URL}")
+
+        # Load is measured by the gateway, without it cluster size stays fixed.
+        autoscaler = None
+        if args.max_instances is not None and gateway is None:
+            print("--max-instances needs --gateway-port, cluster size stays fixed")
+        elif args.max_instances is not None:
+            autoscaler = Autoscaler(
+                fleet,
+                gateway,
+                spending,
+                ScalingOptions(
+                    min_instances=args.min_instances,
+                    max_instances=args.max_instances,
+                    queue_per_instance=args.scale_up_queue,
+                    max_p95=args.scale_up_p95,
+                    idle_timeout=args.scale_down_idle,
+                    up_cooldown=args.scale_up_cooldown,
+                    down_cooldown=args.scale_down_cooldown,
+                    budget=args.budget,
+                    budget_share=args.budget_share,
+                ),
+                feed,
+                readiness,
+            )
+            autoscaler.start()
 
-        async def print_usage():
-            token = golem._engine._api_config.app_key
-
-            activities = [
-                s._ctx._activity.id
-                for s in cluster.instances if s._ctx != None
-            ]
-
-            print(activities)
-            
-            for id in activities:
-                activity = await golem._engine._activity_api.use_activity(id)
-                custom_url = "/sdapi/v1/txt2img"
-                url = activity._api.api_client.configuration.host + f"/activity/{activity.id}/proxy-http" + custom_url
-
-                print('Request example:\n')
-                if os.name == 'nt':
-                    payload = '"prompt"="happy golem"'
-                    headers = (
-                        f"\"Authorization\" = \"Bearer {token}\"; "
-                        "\"Content-Type\" = \"application/json; charset=utf-8\"; "
-                        "\"Accept\" = \"text/event-stream\""
-                    )
-                    powershell_cmd = (
-                        f"$images = Invoke-WebRequest -Method POST -Headers @{{ {headers} }} -Body (@{{ {payload} }}|ConvertTo-Json) -Uri {url} | ConvertFrom-Json | Select images | Select-Object -Index 0\n"
-                        "$bytes = [Convert]::FromBase64String($images.images)\n"
-                        "$filename = \"C:\\Windows\\Temp\\output.png\"\n"
-                        "[IO.File]::WriteAllBytes($filename, $bytes)\n"
-                        "explorer C:\\Windows\\Temp\\output.png\n"
-                    )
-                    print(powershell_cmd)
-                else:
-                    payload = '{ \\"prompt\\": \\"happy golem\\" }'
-                    headers = (
-                        f"-H \'Authorization: Bearer {token}\' "
-                        "-H \'Content-Type: application/json; charset=utf-8\' "
-                        "-H \'Accept: text/event-stream\' "
-                    )
-                    pipe_image_cmd = '| jq -r ".images[0]" | base64 --decode > output.png && xdg-open output.png'
-                    print(f'curl -X POST {headers} -d "{payload}" {url} {pipe_image_cmd}')
-
-        def instances():
-            return [
-                {
-                    'name': s.provider_name,
-                    'state': s.state.value,
-                    'context': s._ctx
-                } for s in cluster.instances
-            ]
-
-        usage_printed = False
-        while True:
-            await asyncio.sleep(3)
-
-            i = instances()
-
-            running = [r for r in i if not r['context'] == None]
-            if not usage_printed and len(running) > 0:
-                await print_usage()
-                usage_printed = True
-            
-            print(f"""instances: {[f"{r['name']}: {r['state']}" for r in i]}""")
+        # Instances are watched and replaced from event consumers, run until interrupted.
+        try:
+            await asyncio.Future()
+        finally:
+            if autoscaler is not None:
+                await autoscaler.close()
+            if readiness is not None:
+                await readiness.close()
+            if gateway is not None:
+                await gateway.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,143 @@
+"""Growing and shrinking the fleet with load seen by the gateway, within the budget."""
+import asyncio
+import math
+import time
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import Dict, Optional, Union
+
+from yapapi.events import DebitNoteAccepted, InvoiceAccepted
+
+from fleet import Fleet
+from gateway import Gateway
+from readiness import ReadinessMonitor
+from state_feed import StateFeed
+
+
+@dataclass
+class ScalingOptions:
+    min_instances: int = 1
+    max_instances: int = 4
+    queue_per_instance: float = 2.0
+    max_p95: Optional[float] = None
+    idle_timeout: float = 120.0
+    up_cooldown: float = 30.0
+    down_cooldown: float = 120.0
+    interval: float = 5.0
+    budget: float = 4.0
+    budget_share: float = 0.9
+
+
+class Spending:
+    """GLM accepted in debit notes and invoices, the highest amount of every agreement."""
+
+    def __init__(self):
+        self._agreements: Dict[str, Decimal] = {}
+
+    def consume(self, event: Union[DebitNoteAccepted, InvoiceAccepted]):
+        amount = Decimal(event.amount)
+        if amount > self._agreements.get(event.agr_id, Decimal(0)):
+            self._agreements[event.agr_id] = amount
+
+    @property
+    def spent(self) -> float:
+        return float(sum(self._agreements.values(), Decimal(0)))
+
+
+class Autoscaler:
+    """Resizes the fleet every `interval` seconds from load seen by the gateway.
+
+    The fleet grows when more than `queue_per_instance` requests per instance wait
+    for a provider, or when p95 of request duration exceeds `max_p95` while requests
+    wait. Instances still starting count as capacity, ones `readiness` found failing
+    do not. Ready instances idle for
+    `idle_timeout` are stopped one at a time. Nothing is hired once `budget_share`
+    of the budget is spent, and idle instances are stopped right away.
+    """
+
+    def __init__(
+        self,
+        fleet: Fleet,
+        gateway: Gateway,
+        spending: Spending,
+        options: ScalingOptions,
+        feed: StateFeed,
+        readiness: ReadinessMonitor,
+    ):
+        self.fleet = fleet
+        self.gateway = gateway
+        self.spending = spending
+        self.options = options
+        self.feed = feed
+        self.readiness = readiness
+        self.resized_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def step(self):
+        now = time.monotonic()
+        options = self.options
+        failing = self.readiness.failing
+        size = len([s for s in self.fleet.alive() if s.id not in failing])
+        queued = self.gateway.waiting
+        since_resize = now - self.resized_at
+        over_budget = self.spending.spent >= options.budget * options.budget_share
+
+        if size < options.max_instances and since_resize >= options.up_cooldown and not over_budget:
+            if queued > options.queue_per_instance * size:
+                count = min(options.max_instances, math.ceil(queued / options.queue_per_instance)) - size
+                self._resized(size, size + max(count, 1), f"{queued} requests waiting", now)
+                self.fleet.grow(max(count, 1))
+                return
+            p95 = self.gateway.quantile(0.95) if options.max_p95 else None
+            if p95 is not None and p95 > options.max_p95 and queued > 0:
+                self._resized(size, size + 1, f"p95 {p95:.1f}s with {queued} requests waiting", now)
+                self.fleet.grow(1)
+                return
+
+        if queued > 0 or size <= options.min_instances:
+            return
+        if over_budget:
+            idle_for = 0.0
+            reason = f"{self.spending.spent:.4g} of {options.budget} GLM budget spent"
+        elif since_resize >= options.down_cooldown:
+            idle_for = options.idle_timeout
+            reason = f"idle for {options.idle_timeout:.0f}s"
+        else:
+            return
+        idle = sorted(
+            (u for u in self.gateway.upstreams.values() if u.outstanding == 0 and now - u.last_active >= idle_for),
+            key=lambda u: u.last_active,
+        )[:size - options.min_instances if over_budget else 1]
+        if idle:
+            self._resized(size, size - len(idle), reason, now)
+            for upstream in idle:
+                # Stop routing right away, the instance takes a while to terminate.
+                self.gateway.remove(upstream.handle.service.id)
+            self.fleet.shrink([u.handle.service for u in idle])
+
+    def _resized(self, old: int, new: int, reason: str, now: float):
+        print(f"[Autoscale] {old} -> {new} instances: {reason}")
+        self.resized_at = now
+        self.feed.emit({
+            "ts": round(time.time(), 3),
+            "event": "scale",
+            "old": old,
+            "new": new,
+            "reason": reason,
+        })
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.options.interval)
+            if not self.fleet.cluster.service_runner.stopped:
+                self.step()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
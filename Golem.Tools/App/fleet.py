@@ -0,0 +1,99 @@
+"""Keeping the service cluster at its target size and timing instance startup."""
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from yapapi.events import ServiceStateChanged
+from yapapi.services import Service
+
+from state_feed import StateFeed
+
+
+@dataclass
+class StartupTiming:
+    spawned: float
+    starting: Optional[float] = None
+    running: Optional[float] = None
+    attempts: int = 0
+
+    @property
+    def startup(self) -> Optional[float]:
+        """Seconds from spawning the instance until it was running."""
+        return None if self.running is None else self.running - self.spawned
+
+
+class Fleet:
+    """Keeps `target` instances of the cluster alive and measures how long they take to start.
+
+    Instances that fail while starting are restarted by yapapi on another provider.
+    Instances terminated after they were running are replaced with new ones.
+    """
+
+    def __init__(self, target: int, instance_params: Dict, feed: StateFeed):
+        self.target = target
+        self.instance_params = instance_params
+        self.feed = feed
+        self.timings: Dict[str, StartupTiming] = {}
+        self.replaced = 0
+        self.cluster = None
+
+    def track(self, cluster):
+        self.cluster = cluster
+        for service in cluster.instances:
+            self.timings.setdefault(service.id, StartupTiming(time.monotonic()))
+
+    def consume(self, event: ServiceStateChanged):
+        service = event.service
+        now = time.monotonic()
+        timing = self.timings.setdefault(service.id, StartupTiming(now))
+        if event.new.value == "starting":
+            timing.starting = now
+            timing.attempts += 1
+        elif event.new.value == "running":
+            timing.running = now
+            print(
+                f"{service.provider_name} running after {timing.startup:.1f}s "
+                f"(deploy and start: {now - timing.starting:.1f}s, attempts: {timing.attempts})"
+            )
+            print(self.summary())
+            self.feed.emit({
+                "ts": round(time.time(), 3),
+                "event": "startup",
+                "service": service.id,
+                "startup": round(timing.startup, 3),
+                "attempts": timing.attempts,
+            })
+        elif event.new.value == "terminated" and self.cluster is not None:
+            self.replace_failed()
+
+    def alive(self) -> List[Service]:
+        # Instances that failed to start are briefly terminated before yapapi restarts them.
+        return [s for s in self.cluster.instances if s.state.value != "terminated" or s.restart_condition]
+
+    def replace_failed(self):
+        cluster = self.cluster
+        if cluster.service_runner.stopped:
+            return
+        missing = self.target - len(self.alive())
+        if missing > 0:
+            print(f"Replacing {missing} terminated instance(s)")
+            cluster.spawn_instances(instance_params=[self.instance_params] * missing)
+            self.replaced += missing
+            self.track(cluster)
+
+    def grow(self, count: int):
+        self.target += count
+        self.cluster.spawn_instances(instance_params=[self.instance_params] * count)
+        self.track(self.cluster)
+
+    def shrink(self, services: List[Service]):
+        """Stop instances without replacing them."""
+        self.target -= len(services)
+        for service in services:
+            self.cluster.stop_instance(service)
+
+    def summary(self) -> str:
+        running = sum(s.state.value == "running" for s in self.cluster.instances)
+        startups = sorted(t.startup for t in self.timings.values() if t.startup is not None)
+        median = f", median startup: {startups[len(startups) // 2]:.1f}s" if startups else ""
+        return f"running: {running}/{self.target}, replaced: {self.replaced}{median}"
@@ -0,0 +1,182 @@
+"""Local txt2img endpoint balancing requests over running instances."""
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import AbstractSet, Deque, Dict, Optional
+
+import aiohttp
+from aiohttp import web
+
+from registry import ActivityHandle
+
+TXT2IMG_URL = "/sdapi/v1/txt2img"
+CHUNK_SIZE = 64 * 1024
+
+
+class GatewayBusy(Exception):
+    """No provider got free in time, or too many requests are waiting already."""
+
+
+@dataclass
+class Upstream:
+    handle: ActivityHandle
+    session: aiohttp.ClientSession
+    outstanding: int = 0
+    completed: int = 0
+    failed: int = 0
+    last_active: float = field(default_factory=time.monotonic)
+
+
+class Gateway:
+    """Local `/sdapi/v1/txt2img` endpoint spreading requests over all running instances.
+
+    Every instance takes up to `max_per_instance` requests at a time, sent over its own
+    pool of keep-alive connections to yagna `proxy-http`. A request goes to the least
+    loaded instance with a free slot. When there is none it waits, at most `max_queue`
+    requests for at most `queue_timeout` seconds, and is answered with 503 otherwise.
+    Responses, `text/event-stream` progress included, are streamed back as they arrive.
+    Request failing to connect is sent once more to another instance.
+    """
+
+    def __init__(self, max_per_instance=1, max_queue=32, queue_timeout=60.0, request_timeout=600.0):
+        self.max_per_instance = max_per_instance
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.timeout = aiohttp.ClientTimeout(total=request_timeout, connect=30.0)
+        self.upstreams: Dict[str, Upstream] = {}
+        self.waiting = 0
+        self.rejected = 0
+        self.durations: Deque[float] = deque(maxlen=200)
+        self._changed = asyncio.Event()
+        self._runner: Optional[web.AppRunner] = None
+
+    def add(self, handle: ActivityHandle):
+        connector = aiohttp.TCPConnector(limit=self.max_per_instance)
+        session = aiohttp.ClientSession(connector=connector, headers=handle.headers)
+        self.upstreams[handle.service.id] = Upstream(handle, session)
+        self._changed.set()
+
+    def remove(self, service_id: str):
+        """Stop routing to the instance. Requests already sent to it fail."""
+        upstream = self.upstreams.pop(service_id, None)
+        if upstream is not None:
+            asyncio.create_task(upstream.session.close())
+
+    def _least_loaded(self, exclude: AbstractSet[str]) -> Optional[Upstream]:
+        candidates = [u for key, u in self.upstreams.items() if key not in exclude] or list(self.upstreams.values())
+        free = [u for u in candidates if u.outstanding < self.max_per_instance]
+        return min(free, key=lambda u: u.outstanding) if free else None
+
+    async def _acquire(self, exclude: AbstractSet[str]) -> Upstream:
+        upstream = self._least_loaded(exclude)
+        if upstream is None:
+            if self.waiting >= self.max_queue:
+                raise GatewayBusy(f"{self.waiting} requests are already waiting for a provider")
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.queue_timeout
+            self.waiting += 1
+            try:
+                while upstream is None:
+                    self._changed.clear()
+                    await asyncio.wait_for(self._changed.wait(), max(0.0, deadline - loop.time()))
+                    upstream = self._least_loaded(exclude)
+            except asyncio.TimeoutError:
+                raise GatewayBusy(f"No provider got free in {self.queue_timeout}s")
+            finally:
+                self.waiting -= 1
+        upstream.outstanding += 1
+        return upstream
+
+    def _release(self, upstream: Upstream):
+        upstream.outstanding -= 1
+        upstream.last_active = time.monotonic()
+        self._changed.set()
+
+    async def txt2img(self, request: web.Request) -> web.StreamResponse:
+        body = await request.read()
+        headers = {
+            "Content-Type": request.headers.get("Content-Type", "application/json"),
+            "Accept": request.headers.get("Accept", "application/json"),
+        }
+        tried = set()
+        error = "No provider is running"
+        while len(tried) < 2:
+            try:
+                upstream = await self._acquire(tried)
+            except GatewayBusy as e:
+                self.rejected += 1
+                return web.json_response({"error": str(e)}, status=503, headers={"Retry-After": "5"})
+            if upstream.handle.service.id in tried:
+                # The only running instance failed already.
+                self._release(upstream)
+                break
+            tried.add(upstream.handle.service.id)
+            response = None
+            sent_at = time.monotonic()
+            try:
+                async with upstream.session.post(
+                    upstream.handle.url + TXT2IMG_URL, data=body, headers=headers, timeout=self.timeout
+                ) as upstream_response:
+                    response = web.StreamResponse(status=upstream_response.status)
+                    response.content_type = upstream_response.content_type
+                    response.headers["X-Provider-Name"] = upstream.handle.service.provider_name or ""
+                    await response.prepare(request)
+                    async for chunk in upstream_response.content.iter_chunked(CHUNK_SIZE):
+                        await response.write(chunk)
+                    await response.write_eof()
+                    upstream.completed += 1
+                    self.durations.append(time.monotonic() - sent_at)
+                    return response
+            except aiohttp.ClientConnectionError as e:
+                upstream.failed += 1
+                if response is not None:
+                    # Part of the response is sent already, the client sees a cut connection.
+                    raise
+                error = f"{upstream.handle.service.provider_name}: {e}"
+            except asyncio.TimeoutError:
+                upstream.failed += 1
+                if response is not None:
+                    raise
+                return web.json_response({"error": "Provider did not respond in time"}, status=504)
+            finally:
+                self._release(upstream)
+        return web.json_response({"error": error}, status=502)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Quantile of recent request durations."""
+        if not self.durations:
+            return None
+        ordered = sorted(self.durations)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    async def status(self, _request: web.Request) -> web.Response:
+        return web.json_response({
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "instances": [
+                {
+                    "provider_id": u.handle.service.provider_id,
+                    "provider_name": u.handle.service.provider_name,
+                    "activity": u.handle.activity.id,
+                    "outstanding": u.outstanding,
+                    "completed": u.completed,
+                    "failed": u.failed,
+                }
+                for u in self.upstreams.values()
+            ],
+        })
+
+    async def start(self, host: str, port: int):
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post(TXT2IMG_URL, self.txt2img)
+        app.router.add_get("/gateway/status", self.status)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+        upstreams, self.upstreams = self.upstreams, {}
+        await asyncio.gather(*(u.session.close() for u in upstreams.values()))
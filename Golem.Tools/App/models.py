@@ -0,0 +1,38 @@
+"""Models which can be deployed on AI runtime providers."""
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    name: str
+    url: str
+    """`hash:<algorithm>:<hash>:<download url>`. Providers keep downloaded models by hash."""
+    format: str = "safetensors"
+    size_gib: float = 0.0
+
+
+BUILTIN_MODELS = [
+    ModelSpec(
+        "sd-1.5",
+        "hash:sha3:b2da48d618beddab1887739d75b50a3041c810bc73805a416761185998359b24:https://huggingface.co/runwayml/stable-diffusion-v1-5/resolve/main/v1-5-pruned-emaonly.safetensors?download=true",
+        size_gib=3.97,
+    ),
+    ModelSpec(
+        "sdxl",
+        "hash:sha2:31e35c80fc4829d14f90153f4c74cd59c90b779f6afe05a74cd6120b893f7e5b:https://huggingface.co/stabilityai/stable-diffusion-xl-base-1.0/resolve/main/sd_xl_base_1.0.safetensors?download=true",
+        size_gib=6.46,
+    ),
+    # Small models for testing deployment, not usable for image generation.
+    ModelSpec(
+        "rubert-tiny2",
+        "hash:sha3:0b682cf78786b04dc108ff0b254db1511ef820105129ad021d2e123a7b975e7c:https://huggingface.co/cointegrated/rubert-tiny2/resolve/main/model.safetensors?download=true",
+        size_gib=0.11,
+    ),
+    ModelSpec(
+        "mobilenet-v3-small",
+        "hash:sha3:eb222a9f6afa502a379b2315ec9f1e853ba7013f7240bfa47fb2f455375fea9c:https://huggingface.co/timm/tf_mobilenetv3_small_minimal_100.in1k/resolve/main/model.safetensors?download=true",
+        size_gib=0.01,
+    ),
+]
+
+MODELS = {model.name: model for model in BUILTIN_MODELS}
@@ -59,6 +59,10 @@ namespace App
 
         private readonly string _runtime;
         public UInt32? PaymentInterval { get; set; }
+        public UInt32? NumInstances { get; set; }
+        public UInt32? GatewayPort { get; set; }
+        public UInt32? MaxInstances { get; set; }
+        public string? Model { get; set; }
 
         private string _message;
         public string Message
@@ -107,6 +111,22 @@ namespace App
             {
                 args += $" --pay-interval {PaymentInterval.Value}";
             }
+            if (NumInstances.HasValue)
+            {
+                args += $" --num-instances {NumInstances.Value}";
+            }
+            if (GatewayPort.HasValue)
+            {
+                args += $" --gateway-port {GatewayPort.Value}";
+            }
+            if (MaxInstances.HasValue)
+            {
+                args += $" --max-instances {MaxInstances.Value}";
+            }
+            if (Model != null)
+            {
+                args += $" --model {Model}";
+            }
             return args;
         }
 
@@ -1,32 +1,130 @@
-# app.py
-from flask import Flask, request, jsonify
-import base64
+from flask import Flask, Response, request
+import random
+import threading
+import time
+
+from backend import (
+    DEFAULT_STEPS, Config, QueueFull, generation_time, image_count, image_size, parse_distribution,
+    progress, response_body, sse, warm_up,
+)
 
 app = Flask(__name__)
 
-response = {
-    "images": [],
-    "prompt": ""
-}
 
-def read_image():
-    with open("img.png", "rb") as image_file:
-        encoded_string = base64.b64encode(image_file.read())
-    return encoded_string
+class GpuQueue:
+    """Bounded queue in front of `slots` concurrently processed requests."""
+
+    def __init__(self, slots, queue_size):
+        self.slots = threading.Semaphore(slots)
+        self.queue_size = queue_size
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+    def ticket(self):
+        """Take place in the queue or raise `QueueFull`."""
+        with self.lock:
+            if self.waiting >= self.queue_size:
+                raise QueueFull()
+            self.waiting += 1
+        return Ticket(self)
+
+
+class Ticket:
+    def __init__(self, queue):
+        self.queue = queue
+        self.state = "waiting"
+
+    def wait(self):
+        """Block until GPU slot is free."""
+        self.queue.slots.acquire()
+        with self.queue.lock:
+            self.queue.waiting -= 1
+            self.state = "running"
+
+    def release(self):
+        """Give back slot or place in the queue. Safe to call more than once."""
+        with self.queue.lock:
+            state, self.state = self.state, "done"
+            if state == "waiting":
+                self.queue.waiting -= 1
+        if state == "running":
+            self.queue.slots.release()
+
 
+config = Config.from_env()
+latency = parse_distribution(config.latency)
+rng = random.Random(config.seed)
+gpu = GpuQueue(config.gpu_slots, config.queue_size)
 
+warm_up(config)
+
+
+def error(message, status):
+    return {"error": message}, status
+
+
+def stream_events(r, count, ticket):
+    """Progress events every sampling step, previews every `preview_every` steps, then result.
+
+    Mirrors shape of automatic's `/sdapi/v1/progress` response, so clients can
+    treat it the same as polled progress.
+    """
+    steps = max(1, int(r.get("steps", DEFAULT_STEPS)))
+    yield progress(0, steps, 0)
+    ticket.wait()
+    roll = rng.random()
+    if roll < config.timeout_rate:
+        # Stalled provider: connection stays open, but no more events arrive.
+        time.sleep(config.timeout)
+        yield sse("error", {"error": "Generation timed out", "status": 504})
+        return
+    total = generation_time({**r, "steps": steps}, count, config, latency, rng)
+    for step in range(1, steps + 1):
+        time.sleep(total / steps)
+        preview = config.preview_every > 0 and step % config.preview_every == 0
+        yield progress(step, steps, total * (steps - step) / steps, preview)
+        if roll < config.timeout_rate + config.error_rate and step * 2 >= steps:
+            yield sse("error", {"error": "Injected failure", "status": 500})
+            return
+    ticket.release()
+    yield b"event: result\ndata: " + response_body(r, count, config) + b"\n\n"
 
 
 @app.post("/sdapi/v1/txt2img")
-def add_country():
-    if request.is_json:
-        r = request.get_json(force=True)
-        print(r)
-        print(r['prompt'])
-        response['prompt'] = r['prompt']
-        response['images'].append(read_image().decode("utf-8"))
-        return response, 200
-    return {"error": "Request must be JSON"}, 415
+def txt2img():
+    if not request.is_json:
+        return error("Request must be JSON", 415)
+    r = request.get_json(force=True)
+    app.logger.info("prompt: %s", r.get("prompt"))
+
+    count = image_count(r, config)
+    if count is None:
+        return error(f"batch_size * n_iter must be between 1 and {config.max_images}", 422)
+    if image_size(r, config) is None:
+        return error(f"width and height must be between 1 and {config.max_size}", 400)
+
+    try:
+        ticket = gpu.ticket()
+    except QueueFull:
+        return error("GPU queue is full", 503)
 
+    if "text/event-stream" in request.headers.get("Accept", ""):
+        response = Response(stream_events(r, count, ticket), mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        # Called also when client disconnects or generator never starts.
+        response.call_on_close(ticket.release)
+        return response
 
+    try:
+        ticket.wait()
+        roll = rng.random()
+        if roll < config.timeout_rate:
+            time.sleep(config.timeout)
+            return error("Generation timed out", 504)
+        time.sleep(generation_time(r, count, config, latency, rng))
+        if roll < config.timeout_rate + config.error_rate:
+            return error("Injected failure", 500)
+    finally:
+        ticket.release()
 
+    return Response(response_body(r, count, config), status=200, mimetype="application/json")
@@ -0,0 +1,186 @@
+"""Synthetic txt2img backend shared by the Flask app and the async server."""
+from dataclasses import dataclass, field
+from functools import lru_cache
+import base64
+import json
+import os
+import random
+import struct
+import zlib
+
+DEFAULT_STEPS = 20
+SOURCE_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "img.png")
+
+
+def parse_distribution(spec):
+    """Parse `name:arg1,arg2` latency spec into a function returning seconds.
+
+    Supported: `fixed:s`, `uniform:low,high`, `normal:mean,stddev`,
+    `lognormal:mu,sigma` (of underlying normal) and `exponential:mean`.
+    """
+    name, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if name == "fixed":
+        (seconds,) = values or [0.0]
+        return lambda rng: seconds
+    if name == "uniform":
+        low, high = values
+        return lambda rng: rng.uniform(low, high)
+    if name == "normal":
+        mean, stddev = values
+        return lambda rng: max(0.0, rng.gauss(mean, stddev))
+    if name == "lognormal":
+        mu, sigma = values
+        return lambda rng: rng.lognormvariate(mu, sigma)
+    if name == "exponential":
+        (mean,) = values
+        return lambda rng: rng.expovariate(1 / mean) if mean > 0 else 0.0
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+@dataclass
+class Config:
+    latency: str = "fixed:0"
+    """Base latency distribution of every request, see `parse_distribution`."""
+    step_latency: float = 0.0
+    """Additional seconds per sampling step and image, so `steps` and `batch_size` matter."""
+    image: str = "source"
+    """`source` returns img.png, `synthetic` returns noise PNG of requested width and height."""
+    sizes: list = field(default_factory=lambda: ["512x512"])
+    """Synthetic image sizes encoded at startup; other sizes are encoded on first use."""
+    gpu_slots: int = 1
+    """Number of requests processed concurrently, like a single GPU."""
+    queue_size: int = 16
+    """Requests waiting for a GPU slot above this limit are rejected with 503."""
+    error_rate: float = 0.0
+    """Fraction of requests failing with 500."""
+    timeout_rate: float = 0.0
+    """Fraction of requests hanging for `timeout` seconds before failing with 504."""
+    timeout: float = 600.0
+    preview_every: int = 5
+    """In event stream mode, attach preview image to every n-th progress event. 0 disables previews."""
+    max_images: int = 64
+    max_size: int = 2048
+    """Largest `width` and `height` accepted, larger requests are rejected with 400."""
+    seed: int = None
+
+    @staticmethod
+    def from_env():
+        env = os.environ
+        return Config(
+            latency=env.get("DUMMY_LATENCY", "fixed:0"),
+            step_latency=float(env.get("DUMMY_STEP_LATENCY", 0)),
+            image=env.get("DUMMY_IMAGE", "source"),
+            sizes=[s for s in env.get("DUMMY_SIZES", "512x512").split(",") if s],
+            gpu_slots=int(env.get("DUMMY_GPU_SLOTS", 1)),
+            queue_size=int(env.get("DUMMY_QUEUE_SIZE", 16)),
+            error_rate=float(env.get("DUMMY_ERROR_RATE", 0)),
+            timeout_rate=float(env.get("DUMMY_TIMEOUT_RATE", 0)),
+            timeout=float(env.get("DUMMY_TIMEOUT", 600)),
+            preview_every=int(env.get("DUMMY_PREVIEW_EVERY", 5)),
+            max_images=int(env.get("DUMMY_MAX_IMAGES", 64)),
+            max_size=int(env.get("DUMMY_MAX_SIZE", 2048)),
+            seed=int(env["DUMMY_SEED"]) if "DUMMY_SEED" in env else None,
+        )
+
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def synthetic_png(width, height, seed=0):
+    """Noise RGB PNG, barely compressible, so its size is close to a real render."""
+    noise = random.Random(seed).randbytes(width * height * 3)
+    stride = width * 3
+    rows = b"".join(b"\x00" + noise[y * stride:(y + 1) * stride] for y in range(height))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + _png_chunk(b"IDAT", zlib.compress(rows, 1))
+        + _png_chunk(b"IEND", b"")
+    )
+
+
+def encode(image_bytes):
+    """Base64 image as json string literal, ready to be joined into response body."""
+    return json.dumps(base64.b64encode(image_bytes).decode("ascii")).encode("ascii")
+
+
+@lru_cache(maxsize=16)
+def _encoded_image(image, width, height):
+    if image == "source":
+        with open(SOURCE_IMAGE, "rb") as image_file:
+            return encode(image_file.read())
+    return encode(synthetic_png(width, height))
+
+
+def encoded_image(image, width, height):
+    if image == "source":
+        # Source image does not depend on requested size, cache it once.
+        return _encoded_image(image, 0, 0)
+    return _encoded_image(image, width, height)
+
+
+class QueueFull(Exception):
+    pass
+
+
+def image_count(r, config):
+    """Number of images requested, or `None` if outside of configured limit."""
+    count = int(r.get("batch_size", 1)) * int(r.get("n_iter", 1))
+    return count if 0 < count <= config.max_images else None
+
+
+def image_size(r, config):
+    """Requested `(width, height)`, or `None` if not a positive size within configured limit."""
+    try:
+        size = int(r.get("width", 512)), int(r.get("height", 512))
+    except (TypeError, ValueError):
+        return None
+    return size if all(0 < side <= config.max_size for side in size) else None
+
+
+def generation_time(r, count, config, latency, rng):
+    return latency(rng) + config.step_latency * int(r.get("steps", DEFAULT_STEPS)) * count
+
+
+def response_body(r, count, config):
+    image = encoded_image(config.image, *image_size(r, config))
+    # Build body around the precomputed base64 literal instead of serializing it again.
+    return b"".join([
+        b'{"images":[',
+        b",".join([image] * count),
+        b'],"prompt":',
+        json.dumps(r.get("prompt", "")).encode("utf-8"),
+        b',"parameters":',
+        json.dumps(r).encode("utf-8"),
+        b',"info":"{}"}',
+    ])
+
+
+@lru_cache(maxsize=1)
+def preview_image():
+    return encode(synthetic_png(64, 64)).decode("ascii")
+
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+
+
+def progress(step, steps, eta, preview=False):
+    data = {
+        "progress": step / steps,
+        "eta_relative": round(eta, 3),
+        "state": {"sampling_step": step, "sampling_steps": steps},
+    }
+    if preview:
+        data["current_image"] = preview_image()
+    return sse("preview" if preview else "progress", data)
+
+
+def warm_up(config):
+    """Encode configured images up front, so no request pays for it."""
+    for size in config.sizes:
+        width, height = (int(v) for v in size.split("x"))
+        encoded_image(config.image, width, height)
+    preview_image()
@@ -0,0 +1,262 @@
+"""Async multi-worker variant of the dummy server, for load testing at high concurrency.
+
+Every worker process runs an aiohttp server bound to the same port with
+SO_REUSEPORT, so the kernel spreads connections across cores. Request counters
+live in shared memory; the parent prints throughput periodically and every
+worker serves aggregated numbers at `/stats`.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sys
+import time
+
+from aiohttp import web
+
+from backend import (
+    DEFAULT_STEPS, Config, QueueFull, generation_time, image_count, image_size, parse_distribution,
+    progress, response_body, sse, warm_up,
+)
+
+STATS_FIELDS = ("requests", "ok", "errors", "rejected", "active", "bytes")
+
+
+class Stats:
+    """Per-worker counters in a shared array. Each worker writes only its own row."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.values = multiprocessing.Array("q", workers * len(STATS_FIELDS), lock=False)
+        self.started = multiprocessing.Value("d", time.time(), lock=False)
+
+    def add(self, worker, name, value=1):
+        self.values[worker * len(STATS_FIELDS) + STATS_FIELDS.index(name)] += value
+
+    def worker(self, worker):
+        row = worker * len(STATS_FIELDS)
+        return dict(zip(STATS_FIELDS, self.values[row:row + len(STATS_FIELDS)]))
+
+    def totals(self):
+        totals = dict.fromkeys(STATS_FIELDS, 0)
+        for worker in range(self.workers):
+            for name, value in self.worker(worker).items():
+                totals[name] += value
+        return totals
+
+    def snapshot(self):
+        uptime = time.time() - self.started.value
+        totals = self.totals()
+        return {
+            "uptime": round(uptime, 3),
+            **totals,
+            "requests_per_second": round(totals["ok"] / uptime, 3) if uptime else 0,
+            "megabytes_per_second": round(totals["bytes"] / uptime / 1e6, 3) if uptime else 0,
+            "workers": [self.worker(w) for w in range(self.workers)],
+        }
+
+
+class GpuQueue:
+    """Asyncio version of `app.GpuQueue`. Limits apply to each worker separately."""
+
+    def __init__(self, slots, queue_size):
+        self.slots = asyncio.Semaphore(slots)
+        self.queue_size = queue_size
+        self.waiting = 0
+
+    def ticket(self):
+        """Take place in the queue or raise `QueueFull`."""
+        if self.waiting >= self.queue_size:
+            raise QueueFull()
+        self.waiting += 1
+        return Ticket(self)
+
+
+class Ticket:
+    def __init__(self, queue):
+        self.queue = queue
+        self.state = "waiting"
+
+    async def wait(self):
+        """Wait until GPU slot is free."""
+        await self.queue.slots.acquire()
+        self.queue.waiting -= 1
+        self.state = "running"
+
+    def release(self):
+        """Give back slot or place in the queue. Safe to call more than once."""
+        state, self.state = self.state, "done"
+        if state == "waiting":
+            self.queue.waiting -= 1
+        elif state == "running":
+            self.queue.slots.release()
+
+
+def create_app(config, worker, stats):
+    latency = parse_distribution(config.latency)
+    rng = random.Random(None if config.seed is None else config.seed + worker)
+    gpu = GpuQueue(config.gpu_slots, config.queue_size)
+
+    def error(message, status):
+        stats.add(worker, "rejected" if status == 503 else "errors")
+        return web.json_response({"error": message}, status=status)
+
+    async def stream_events(request, r, count, ticket):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        steps = max(1, int(r.get("steps", DEFAULT_STEPS)))
+        await response.write(progress(0, steps, 0))
+        await ticket.wait()
+        try:
+            roll = rng.random()
+            if roll < config.timeout_rate:
+                await asyncio.sleep(config.timeout)
+                stats.add(worker, "errors")
+                await response.write(sse("error", {"error": "Generation timed out", "status": 504}))
+                return response
+            total = generation_time({**r, "steps": steps}, count, config, latency, rng)
+            for step in range(1, steps + 1):
+                await asyncio.sleep(total / steps)
+                preview = config.preview_every > 0 and step % config.preview_every == 0
+                await response.write(progress(step, steps, total * (steps - step) / steps, preview))
+                if roll < config.timeout_rate + config.error_rate and step * 2 >= steps:
+                    stats.add(worker, "errors")
+                    await response.write(sse("error", {"error": "Injected failure", "status": 500}))
+                    return response
+        finally:
+            ticket.release()
+        body = response_body(r, count, config)
+        await response.write(b"event: result\ndata: " + body + b"\n\n")
+        await response.write_eof()
+        stats.add(worker, "ok")
+        stats.add(worker, "bytes", len(body))
+        return response
+
+    async def txt2img(request):
+        stats.add(worker, "requests")
+        if request.content_type != "application/json":
+            return error("Request must be JSON", 415)
+        r = await request.json()
+        count = image_count(r, config)
+        if count is None:
+            return error(f"batch_size * n_iter must be between 1 and {config.max_images}", 422)
+        if image_size(r, config) is None:
+            return error(f"width and height must be between 1 and {config.max_size}", 400)
+        try:
+            ticket = gpu.ticket()
+        except QueueFull:
+            return error("GPU queue is full", 503)
+
+        stats.add(worker, "active")
+        try:
+            if "text/event-stream" in request.headers.get("Accept", ""):
+                return await stream_events(request, r, count, ticket)
+
+            await ticket.wait()
+            try:
+                roll = rng.random()
+                if roll < config.timeout_rate:
+                    await asyncio.sleep(config.timeout)
+                    return error("Generation timed out", 504)
+                await asyncio.sleep(generation_time(r, count, config, latency, rng))
+                if roll < config.timeout_rate + config.error_rate:
+                    return error("Injected failure", 500)
+            finally:
+                ticket.release()
+            body = response_body(r, count, config)
+            stats.add(worker, "ok")
+            stats.add(worker, "bytes", len(body))
+            return web.Response(body=body, content_type="application/json")
+        finally:
+            # Covers requests failing before they waited for the GPU, e.g. in `prepare`.
+            ticket.release()
+            stats.add(worker, "active", -1)
+
+    async def stats_handler(_request):
+        return web.json_response(stats.snapshot())
+
+    app = web.Application(client_max_size=16 * 1024 * 1024)
+    app.router.add_post("/sdapi/v1/txt2img", txt2img)
+    app.router.add_get("/stats", stats_handler)
+    return app
+
+
+def run_worker(worker, host, port, backlog, stats):
+    config = Config.from_env()
+    warm_up(config)
+    web.run_app(
+        create_app(config, worker, stats),
+        host=host,
+        port=port,
+        reuse_port=stats.workers > 1,
+        backlog=backlog,
+        access_log=None,
+        print=None,
+    )
+
+
+def report(stats, interval):
+    previous = stats.totals()
+    while True:
+        time.sleep(interval)
+        current = stats.totals()
+        ok = current["ok"] - previous["ok"]
+        megabytes = (current["bytes"] - previous["bytes"]) / 1e6
+        print(
+            f"{ok / interval:.1f} req/s, {megabytes / interval:.1f} MB/s, "
+            f"active: {current['active']}, errors: {current['errors']}, rejected: {current['rejected']}",
+            flush=True,
+        )
+        previous = current
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Async multi-worker dummy txt2img server")
+    parser.add_argument("--host", default="127.0.0.1", help="default: %(default)s")
+    parser.add_argument("--port", type=int, default=7861, help="default: %(default)s")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes; default: %(default)s")
+    parser.add_argument("--backlog", type=int, default=4096, help="Listen backlog of each worker; default: %(default)s")
+    parser.add_argument(
+        "--report-interval",
+        type=float,
+        default=10.0,
+        help="Print throughput every this many seconds, 0 disables; default: %(default)s",
+    )
+    args = parser.parse_args()
+
+    workers = args.workers
+    if workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        print("SO_REUSEPORT is not supported on this platform, running single worker")
+        workers = 1
+
+    # Run cleanup below also when terminated, so worker processes are not left behind.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    stats = Stats(workers)
+    processes = [
+        multiprocessing.Process(
+            target=run_worker, args=(w, args.host, args.port, args.backlog, stats), daemon=True
+        )
+        for w in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    print(f"Serving on http://{args.host}:{args.port} with {workers} workers, stats at /stats", flush=True)
+    try:
+        if args.report_interval > 0:
+            report(stats, args.report_interval)
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        print(stats.snapshot(), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -27,6 +27,14 @@ public class AppArguments
     public required bool Mainnet { get; set; }
     [Option('p', "pay-interval", Default = null, Required = false, HelpText = "Interval between partial payments in seconds")]
     public UInt32? PaymentInterval { get; set; }
+    [Option('n', "num-instances", Default = null, Required = false, HelpText = "Number of providers to hire concurrently")]
+    public UInt32? NumInstances { get; set; }
+    [Option("gateway-port", Default = null, Required = false, HelpText = "Serve /sdapi/v1/txt2img on this local port, load balanced across hired providers")]
+    public UInt32? GatewayPort { get; set; }
+    [Option("max-instances", Default = null, Required = false, HelpText = "Hire up to this many providers when gateway requests queue up, stop idle ones")]
+    public UInt32? MaxInstances { get; set; }
+    [Option("model", Default = null, Required = false, HelpText = "Model deployed on providers: sd-1.5, sdxl, rubert-tiny2 or mobilenet-v3-small")]
+    public string? Model { get; set; }
 }
 
 
@@ -46,6 +54,10 @@ class ExampleRunner
         var App = new FullExample(workDir, "Requestor", loggerFactory, runtime: parsed.AiFramework.ToString().ToLower(), parsed.Mainnet);
 
         App.PaymentInterval = parsed.PaymentInterval;
+        App.NumInstances = parsed.NumInstances;
+        App.GatewayPort = parsed.GatewayPort;
+        App.MaxInstances = parsed.MaxInstances;
+        App.Model = parsed.Model;
         var logger = loggerFactory.CreateLogger("Example");
 
         _ = Task.Run(async () =>
@@ -0,0 +1,200 @@
+"""Synthetic provider offers and matching of demand constraints against them."""
+import json
+import random
+import re
+from pathlib import Path
+
+GAP_35 = "golem.!exp.gap-35.v1.inf.gpu"
+PAYMENT_PLATFORMS = ["erc20-holesky-tglm", "erc20-polygon-glm", "erc20-mainnet-glm"]
+USAGE_VECTOR = ["golem.usage.duration_sec", "golem.usage.gpu-sec", "ai-runtime.requests"]
+DEFAULT_OVERRIDES = Path(__file__).resolve().parent.parent.parent / "dummy-offer-overrides.json"
+
+# model, memory GiB, cuda cores, compute capability, graphics clock MHz, memory clock MHz
+GPUS = [
+    ("NVIDIA GeForce RTX 3060", 11.99, 3584, "8.6", 1777, 7501),
+    ("NVIDIA GeForce RTX 3070", 7.99, 5888, "8.6", 1725, 7001),
+    ("NVIDIA GeForce RTX 3080", 9.99, 8704, "8.6", 1710, 9501),
+    ("NVIDIA GeForce RTX 3090", 23.99, 10496, "8.6", 1695, 9751),
+    ("NVIDIA GeForce RTX 4060 Ti", 15.99, 4352, "8.9", 2535, 9001),
+    ("NVIDIA GeForce RTX 4070", 11.99, 5888, "8.9", 2475, 10501),
+    ("NVIDIA GeForce RTX 4080", 15.99, 9728, "8.9", 2505, 11201),
+    ("NVIDIA GeForce RTX 4090", 23.99, 16384, "8.9", 2520, 10501),
+]
+
+
+def load_template(path=DEFAULT_OVERRIDES):
+    """Properties of `dummy-offer-overrides.json`, used as a base of every offer."""
+    try:
+        with open(path) as f:
+            return json.load(f).get("properties", {})
+    except FileNotFoundError:
+        return {}
+
+
+def node_id(rng):
+    return "0x" + rng.randbytes(20).hex()
+
+
+def generate_offers(count, runtimes, subnet, seed=None, template=None):
+    """Offers of `count` providers with GAP-35 GPU properties and linear pricing.
+
+    Each runtime in `runtimes` is offered by roughly the same number of providers.
+    Returns list of `{"offerId", "providerId", "properties", "constraints"}`.
+    """
+    rng = random.Random(seed)
+    template = load_template() if template is None else template
+    offers = []
+    for i in range(count):
+        model, memory, cores, capability, graphics, memory_clock = rng.choice(GPUS)
+        provider_id = node_id(rng)
+        duration_price = round(rng.uniform(0.5, 3.0) * 1e-6 * (cores / 8192), 9)
+        properties = {
+            **template,
+            "golem.node.id.name": f"mock-provider-{i}",
+            "golem.node.debug.subnet": subnet,
+            "golem.runtime.name": runtimes[i % len(runtimes)],
+            "golem.runtime.version": "0.1.0",
+            "golem.inf.cpu.architecture": "x86_64",
+            "golem.inf.cpu.cores": rng.choice([4, 6, 8, 12, 16]),
+            "golem.inf.cpu.threads": rng.choice([8, 12, 16, 24, 32]),
+            "golem.inf.mem.gib": rng.choice([16, 32, 64, 128]) - rng.random(),
+            "golem.inf.storage.gib": round(rng.uniform(100, 2000), 3),
+            f"{GAP_35}.model": model,
+            f"{GAP_35}.memory.total.gib": memory,
+            f"{GAP_35}.cuda.enabled": True,
+            f"{GAP_35}.cuda.cores": cores,
+            f"{GAP_35}.cuda.compute-capability": capability,
+            f"{GAP_35}.cuda.version": rng.choice(["12.2", "12.4", "12.6"]),
+            f"{GAP_35}.clocks.graphics.mhz": graphics,
+            f"{GAP_35}.clocks.sm.mhz": graphics,
+            f"{GAP_35}.clocks.memory.mhz": memory_clock,
+            f"{GAP_35}.clocks.video.mhz": int(graphics * 0.8),
+            "golem.com.scheme": "payu",
+            "golem.com.scheme.payu.debit-note.interval-sec?": 120,
+            "golem.com.scheme.payu.payment-timeout-sec?": 1800,
+            "golem.com.payment.debit-notes.accept-timeout?": 240,
+            "golem.com.payment.protocol.version": "3",
+            "golem.com.pricing.model": "linear",
+            "golem.com.pricing.model.linear.coeffs": [duration_price, duration_price, 0.0, 0.0],
+            "golem.com.usage.vector": USAGE_VECTOR,
+            "golem.srv.caps.multi-activity": True,
+            "golem.activity.caps.transfer.protocol": ["http", "https", "gftp"],
+        }
+        for platform in PAYMENT_PLATFORMS:
+            properties[f"golem.com.payment.platform.{platform}.address"] = provider_id
+        offers.append({
+            "offerId": f"offer-{i}-{rng.randbytes(8).hex()}",
+            "providerId": provider_id,
+            "properties": properties,
+            "constraints": "",
+        })
+    return offers
+
+
+_COMPARISON = re.compile(r"^\s*([^<>=]+?)\s*(>=|<=|=|>|<)\s*(.*?)\s*$")
+
+
+class FilterError(ValueError):
+    pass
+
+
+def parse_constraints(constraints):
+    """Parse LDAP-like demand constraints into nested tuples.
+
+    Grammar of yagna constraints: `(&(a=b)(c>=1))`, `(|...)`, `(!(...))`, with
+    `*` used as wildcard and for presence checks. Top level may also be a
+    whitespace separated list of terms, all of which have to match.
+    """
+    text = constraints or ""
+    pos = 0
+
+    def skip_space():
+        nonlocal pos
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+
+    def expect(char):
+        nonlocal pos
+        skip_space()
+        if pos >= len(text) or text[pos] != char:
+            raise FilterError(f"Expected '{char}' at {pos} in constraints: {text}")
+        pos += 1
+
+    def term():
+        nonlocal pos
+        expect("(")
+        skip_space()
+        operator = text[pos] if pos < len(text) else ""
+        rest = text[pos + 1:].lstrip()
+        # Property names may contain `!` (e.g. `golem.!exp...`), so operator is
+        # recognized only when followed by a nested term.
+        if operator in "&|!" and operator and rest.startswith("("):
+            pos += 1
+            children = []
+            skip_space()
+            while pos < len(text) and text[pos] == "(":
+                children.append(term())
+                skip_space()
+            node = (operator, children)
+        else:
+            end = text.find(")", pos)
+            if end == -1:
+                raise FilterError(f"Unterminated term in constraints: {text}")
+            match = _COMPARISON.match(text[pos:end])
+            if match is None:
+                raise FilterError(f"Invalid constraint: {text[pos:end]}")
+            node = ("cmp", match.groups())
+            pos = end
+        expect(")")
+        return node
+
+    children = []
+    skip_space()
+    while pos < len(text):
+        children.append(term())
+        skip_space()
+    return ("&", children)
+
+
+def _compare(value, operator, expected):
+    if value is None:
+        return False
+    if isinstance(value, list):
+        return any(_compare(v, operator, expected) for v in value)
+    if operator == "=":
+        if expected == "*":
+            return True
+        if isinstance(value, bool):
+            return str(value).lower() == expected.lower()
+        if "*" in expected:
+            pattern = "^" + ".*".join(re.escape(p) for p in expected.split("*")) + "$"
+            return re.match(pattern, str(value)) is not None
+        if isinstance(value, (int, float)):
+            try:
+                return float(value) == float(expected)
+            except ValueError:
+                return False
+        return str(value) == expected
+    try:
+        number = float(value)
+        limit = float(expected)
+    except (TypeError, ValueError):
+        return False
+    return {
+        ">=": number >= limit,
+        "<=": number <= limit,
+        ">": number > limit,
+        "<": number < limit,
+    }[operator]
+
+
+def matches(node, properties):
+    kind, args = node
+    if kind == "cmp":
+        key, operator, expected = args
+        return _compare(properties.get(key), operator, expected)
+    if kind == "&":
+        return all(matches(child, properties) for child in args)
+    if kind == "|":
+        return any(matches(child, properties) for child in args)
+    return not all(matches(child, properties) for child in args)
@@ -0,0 +1,724 @@
+"""Local stand-in for yagna market, activity and payment REST APIs.
+
+Serves just enough of the API yapapi uses to negotiate agreements with
+synthetic providers, run services on them and pay for them, without a network
+or funded accounts. Point requestor at it with:
+
+    YAGNA_API_URL=http://127.0.0.1:7465 YAGNA_APPKEY=mock python app.py ...
+
+`/activity-api/v1/activity/{id}/proxy-http/...` is forwarded to `--backend`,
+e.g. the DummyAiHttpServer, so inference requests work end to end.
+"""
+import argparse
+import asyncio
+import bisect
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+from offers import PAYMENT_PLATFORMS, FilterError, generate_offers, matches, node_id, parse_constraints
+
+MARKET = "/market-api/v1"
+ACTIVITY = "/activity-api/v1"
+PAYMENT = "/payment-api/v1"
+
+
+def now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def iso(moment: datetime) -> str:
+    return moment.isoformat().replace("+00:00", "Z")
+
+
+def parse_time(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def parse_distribution(spec):
+    """`fixed:s`, `uniform:low,high` or `exponential:mean`, in seconds."""
+    name, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if name == "fixed":
+        (seconds,) = values or [0.0]
+        return lambda rng: seconds
+    if name == "uniform":
+        low, high = values
+        return lambda rng: rng.uniform(low, high)
+    if name == "exponential":
+        (mean,) = values
+        return lambda rng: rng.expovariate(1 / mean) if mean > 0 else 0.0
+    raise ValueError(f"Unknown distribution: {spec}")
+
+
+def not_found(what: str) -> web.Response:
+    return web.json_response({"message": f"{what} not found"}, status=404)
+
+
+class EventLog:
+    """Persistent, timestamp ordered events served by long-polling endpoints."""
+
+    def __init__(self):
+        self._times: List[datetime] = []
+        self._events: List[dict] = []
+        self._changed = asyncio.Condition()
+
+    async def append(self, event: dict):
+        moment = now()
+        if self._times and moment <= self._times[-1]:
+            # Keep timestamps unique, clients resume from the last one they saw.
+            moment = self._times[-1] + timedelta(microseconds=1)
+        event["eventDate"] = iso(moment)
+        self._times.append(moment)
+        self._events.append(event)
+        async with self._changed:
+            self._changed.notify_all()
+
+    def _after(self, after: Optional[datetime], limit: int) -> List[dict]:
+        start = 0 if after is None else bisect.bisect_right(self._times, after)
+        return self._events[start:start + limit]
+
+    async def poll(self, after: Optional[datetime], timeout: float, limit: int) -> List[dict]:
+        events = self._after(after, limit)
+        if events or timeout <= 0:
+            return events
+        try:
+            async with self._changed:
+                await asyncio.wait_for(self._changed.wait_for(lambda: bool(self._after(after, 1))), timeout)
+        except asyncio.TimeoutError:
+            return []
+        return self._after(after, limit)
+
+
+@dataclass
+class Subscription:
+    id: str
+    properties: dict
+    constraints: str
+    events: asyncio.Queue = field(default_factory=asyncio.Queue)
+    proposals: Dict[str, dict] = field(default_factory=dict)
+    timestamp: datetime = field(default_factory=now)
+
+
+@dataclass
+class Activity:
+    id: str
+    agreement_id: str
+    state: str = "Initialized"
+    created_at: float = field(default_factory=time.monotonic)
+    requests: int = 0
+    batches: Dict[str, dict] = field(default_factory=dict)
+    billing: Optional[asyncio.Task] = None
+    model_ready_at: float = 0.0
+
+
+class YagnaMock:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.identity = node_id(random.Random(f"requestor-{args.seed}"))
+        self.offers = generate_offers(args.offers, args.runtimes, args.subnet, seed=args.seed)
+        self.deploy_time = parse_distribution(args.deploy_time)
+        self.model_load_time = parse_distribution(args.model_load_time)
+        self.subscriptions: Dict[str, Subscription] = {}
+        self.agreements: Dict[str, dict] = {}
+        self.activities: Dict[str, Activity] = {}
+        self.allocations: Dict[str, dict] = {}
+        self.debit_notes: Dict[str, dict] = {}
+        self.invoices: Dict[str, dict] = {}
+        self.debit_note_events = EventLog()
+        self.invoice_events = EventLog()
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.counters = dict.fromkeys(
+            ["subscriptions", "proposals", "agreements", "activities", "debit_notes", "invoices", "proxied"], 0
+        )
+
+    @web.middleware
+    async def authorize(self, request: web.Request, handler):
+        if self.args.app_key and request.headers.get("Authorization") != f"Bearer {self.args.app_key}":
+            return web.json_response({"message": "Invalid application key"}, status=401)
+        return await handler(request)
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self.authorize], client_max_size=64 * 1024 * 1024)
+        app.on_startup.append(self.on_startup)
+        app.on_cleanup.append(self.on_cleanup)
+        r = app.router
+        r.add_get("/me", self.me)
+        r.add_get("/stats", self.stats)
+
+        r.add_post(f"{MARKET}/demands", self.subscribe_demand)
+        r.add_get(f"{MARKET}/demands", self.get_demands)
+        r.add_delete(f"{MARKET}/demands/{{sub}}", self.unsubscribe_demand)
+        r.add_get(f"{MARKET}/demands/{{sub}}/events", self.collect_offers)
+        r.add_post(f"{MARKET}/demands/{{sub}}/proposals/{{proposal}}", self.counter_proposal)
+        r.add_get(f"{MARKET}/demands/{{sub}}/proposals/{{proposal}}", self.get_proposal)
+        r.add_post(f"{MARKET}/demands/{{sub}}/proposals/{{proposal}}/reject", self.reject_proposal)
+        r.add_post(f"{MARKET}/agreements", self.create_agreement)
+        r.add_get(f"{MARKET}/agreements/{{agreement}}", self.get_agreement)
+        r.add_post(f"{MARKET}/agreements/{{agreement}}/confirm", self.confirm_agreement)
+        r.add_post(f"{MARKET}/agreements/{{agreement}}/wait", self.wait_for_approval)
+        r.add_post(f"{MARKET}/agreements/{{agreement}}/terminate", self.terminate_agreement)
+        r.add_get(f"{MARKET}/agreementEvents", self.agreement_events)
+
+        r.add_post(f"{ACTIVITY}/activity", self.create_activity)
+        r.add_delete(f"{ACTIVITY}/activity/{{activity}}", self.destroy_activity)
+        r.add_post(f"{ACTIVITY}/activity/{{activity}}/exec", self.call_exec)
+        r.add_get(f"{ACTIVITY}/activity/{{activity}}/exec/{{batch}}", self.get_exec_batch_results)
+        r.add_get(f"{ACTIVITY}/activity/{{activity}}/state", self.get_activity_state)
+        r.add_get(f"{ACTIVITY}/activity/{{activity}}/usage", self.get_activity_usage)
+        r.add_route("*", f"{ACTIVITY}/activity/{{activity}}/proxy-http/{{path:.*}}", self.proxy_http)
+
+        r.add_get(f"{PAYMENT}/requestorAccounts", self.requestor_accounts)
+        r.add_post(f"{PAYMENT}/allocations", self.create_allocation)
+        r.add_get(f"{PAYMENT}/allocations", self.get_allocations)
+        r.add_get(f"{PAYMENT}/allocations/{{allocation}}", self.get_allocation)
+        r.add_delete(f"{PAYMENT}/allocations/{{allocation}}", self.release_allocation)
+        r.add_get(f"{PAYMENT}/demandDecorations", self.demand_decorations)
+        r.add_get(f"{PAYMENT}/debitNoteEvents", self.get_debit_note_events)
+        r.add_get(f"{PAYMENT}/debitNotes/{{debit_note}}", self.get_debit_note)
+        r.add_post(f"{PAYMENT}/debitNotes/{{debit_note}}/accept", self.accept_debit_note)
+        r.add_get(f"{PAYMENT}/invoiceEvents", self.get_invoice_events)
+        r.add_get(f"{PAYMENT}/invoices/{{invoice}}", self.get_invoice)
+        r.add_post(f"{PAYMENT}/invoices/{{invoice}}/accept", self.accept_invoice)
+        return app
+
+    async def on_startup(self, _app):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0), timeout=aiohttp.ClientTimeout(total=None)
+        )
+
+    async def on_cleanup(self, _app):
+        for activity in self.activities.values():
+            if activity.billing is not None:
+                activity.billing.cancel()
+        await self.session.close()
+
+    async def me(self, _request):
+        return web.json_response({"identity": self.identity, "name": "mock-requestor", "role": "manager"})
+
+    async def stats(self, _request):
+        return web.json_response({
+            **self.counters,
+            "offers": len(self.offers),
+            "active_subscriptions": len(self.subscriptions),
+            "running_activities": sum(a.state == "Ready" for a in self.activities.values()),
+        })
+
+    # Market
+
+    async def subscribe_demand(self, request):
+        demand = await request.json()
+        try:
+            constraints = parse_constraints(demand.get("constraints", ""))
+        except FilterError as e:
+            return web.json_response({"message": str(e)}, status=400)
+        subscription = Subscription(uuid.uuid4().hex, demand.get("properties", {}), demand.get("constraints", ""))
+        self.subscriptions[subscription.id] = subscription
+        self.counters["subscriptions"] += 1
+        for offer in self.offers:
+            if matches(constraints, offer["properties"]):
+                self._propose(subscription, offer, state="Initial")
+        return web.json_response(subscription.id, status=201)
+
+    def _propose(self, subscription: Subscription, offer: dict, state: str, prev: Optional[str] = None) -> dict:
+        proposal = {
+            "properties": offer["properties"],
+            "constraints": offer["constraints"],
+            "proposalId": uuid.uuid4().hex,
+            "issuerId": offer["providerId"],
+            "state": state,
+            "timestamp": iso(now()),
+            "prevProposalId": prev,
+            "_offer": offer,
+        }
+        subscription.proposals[proposal["proposalId"]] = proposal
+        subscription.events.put_nowait({"eventType": "ProposalEvent", "eventDate": iso(now()), "proposalId": proposal["proposalId"]})
+        self.counters["proposals"] += 1
+        return proposal
+
+    @staticmethod
+    def _public(proposal: dict) -> dict:
+        return {k: v for k, v in proposal.items() if not k.startswith("_")}
+
+    async def get_demands(self, _request):
+        return web.json_response([
+            {
+                "properties": s.properties,
+                "constraints": s.constraints,
+                "demandId": s.id,
+                "requestorId": self.identity,
+                "timestamp": iso(s.timestamp),
+            }
+            for s in self.subscriptions.values()
+        ])
+
+    async def unsubscribe_demand(self, request):
+        if self.subscriptions.pop(request.match_info["sub"], None) is None:
+            return not_found("Subscription")
+        return web.Response(status=204)
+
+    async def collect_offers(self, request):
+        subscription = self.subscriptions.get(request.match_info["sub"])
+        if subscription is None:
+            return not_found("Subscription")
+        timeout = float(request.query.get("timeout", 5))
+        max_events = int(request.query.get("maxEvents", 10))
+        events = []
+        try:
+            events.append(await asyncio.wait_for(subscription.events.get(), timeout))
+        except asyncio.TimeoutError:
+            return web.json_response([])
+        while len(events) < max_events and not subscription.events.empty():
+            events.append(subscription.events.get_nowait())
+
+        result = []
+        for event in events:
+            proposal_id = event.pop("proposalId")
+            proposal = subscription.proposals[proposal_id]
+            if event["eventType"] == "ProposalRejectedEvent":
+                result.append({**event, "proposalId": proposal_id, "reason": {"message": "Rejected by provider"}})
+            else:
+                result.append({**event, "proposal": self._public(proposal)})
+        return web.json_response(result)
+
+    async def counter_proposal(self, request):
+        subscription = self.subscriptions.get(request.match_info["sub"])
+        if subscription is None:
+            return not_found("Subscription")
+        offer_proposal = subscription.proposals.get(request.match_info["proposal"])
+        if offer_proposal is None:
+            return not_found("Proposal")
+        body = await request.json()
+        counter_id = uuid.uuid4().hex
+        subscription.proposals[counter_id] = {
+            "properties": body.get("properties", {}),
+            "constraints": body.get("constraints", ""),
+            "proposalId": counter_id,
+            "issuerId": self.identity,
+            "state": "Draft",
+            "timestamp": iso(now()),
+            "prevProposalId": offer_proposal["proposalId"],
+            "_offer": offer_proposal["_offer"],
+        }
+
+        async def respond():
+            await asyncio.sleep(self.args.negotiation_delay)
+            if self.rng.random() < self.args.reject_rate:
+                subscription.events.put_nowait(
+                    {"eventType": "ProposalRejectedEvent", "eventDate": iso(now()), "proposalId": counter_id}
+                )
+            else:
+                self._propose(subscription, offer_proposal["_offer"], state="Draft", prev=counter_id)
+
+        asyncio.create_task(respond())
+        return web.json_response(counter_id, status=201)
+
+    async def get_proposal(self, request):
+        subscription = self.subscriptions.get(request.match_info["sub"])
+        proposal = subscription and subscription.proposals.get(request.match_info["proposal"])
+        if not proposal:
+            return not_found("Proposal")
+        return web.json_response(self._public(proposal))
+
+    async def reject_proposal(self, request):
+        return web.Response(status=204)
+
+    async def create_agreement(self, request):
+        body = await request.json()
+        proposal = None
+        subscription = None
+        for subscription in self.subscriptions.values():
+            proposal = subscription.proposals.get(body.get("proposalId"))
+            if proposal is not None:
+                break
+        if proposal is None:
+            return not_found("Proposal")
+        offer = proposal["_offer"]
+        agreement_id = uuid.uuid4().hex
+        self.agreements[agreement_id] = {
+            "agreementId": agreement_id,
+            "demand": {
+                "properties": subscription.properties,
+                "constraints": subscription.constraints,
+                "demandId": subscription.id,
+                "requestorId": self.identity,
+                "timestamp": iso(subscription.timestamp),
+            },
+            "offer": {
+                "properties": offer["properties"],
+                "constraints": offer["constraints"],
+                "offerId": offer["offerId"],
+                "providerId": offer["providerId"],
+                "timestamp": proposal["timestamp"],
+            },
+            "validTo": body.get("validTo") or iso(now()),
+            "state": "Proposal",
+            "timestamp": iso(now()),
+        }
+        self.counters["agreements"] += 1
+        return web.json_response(agreement_id, status=201)
+
+    async def get_agreement(self, request):
+        agreement = self.agreements.get(request.match_info["agreement"])
+        if agreement is None:
+            return not_found("Agreement")
+        return web.json_response(agreement)
+
+    async def confirm_agreement(self, request):
+        agreement = self.agreements.get(request.match_info["agreement"])
+        if agreement is None:
+            return not_found("Agreement")
+        agreement["state"] = "Pending"
+        return web.Response(status=204)
+
+    async def wait_for_approval(self, request):
+        agreement = self.agreements.get(request.match_info["agreement"])
+        if agreement is None:
+            return not_found("Agreement")
+        await asyncio.sleep(self.args.negotiation_delay)
+        if self.rng.random() < self.args.agreement_reject_rate:
+            agreement["state"] = "Rejected"
+            return web.json_response({"message": "Agreement rejected by provider"}, status=410)
+        agreement["state"] = "Approved"
+        agreement["approvedDate"] = iso(now())
+        return web.json_response("Approved")
+
+    async def terminate_agreement(self, request):
+        agreement_id = request.match_info["agreement"]
+        agreement = self.agreements.get(agreement_id)
+        if agreement is None:
+            return not_found("Agreement")
+        if agreement["state"] != "Terminated":
+            agreement["state"] = "Terminated"
+            await self._issue_invoice(agreement)
+        return web.Response(status=204)
+
+    async def agreement_events(self, request):
+        await asyncio.sleep(min(float(request.query.get("timeout", 0)), 5))
+        return web.json_response([])
+
+    # Activity
+
+    async def create_activity(self, request):
+        body = await request.json()
+        agreement_id = body["agreementId"] if isinstance(body, dict) else body
+        agreement = self.agreements.get(agreement_id)
+        if agreement is None or agreement["state"] != "Approved":
+            return web.json_response({"message": f"Agreement {agreement_id} is not approved"}, status=400)
+        activity = Activity(uuid.uuid4().hex, agreement_id)
+        self.activities[activity.id] = activity
+        activity.billing = asyncio.create_task(self._bill(activity))
+        self.counters["activities"] += 1
+        return web.json_response(activity.id, status=201)
+
+    async def destroy_activity(self, request):
+        activity = self.activities.get(request.match_info["activity"])
+        if activity is None:
+            return not_found("Activity")
+        activity.state = "Terminated"
+        if activity.billing is not None:
+            activity.billing.cancel()
+        await self._issue_debit_note(activity)
+        return web.Response(status=204)
+
+    async def call_exec(self, request):
+        activity = self.activities.get(request.match_info["activity"])
+        if activity is None:
+            return not_found("Activity")
+        body = await request.json()
+        commands = json.loads(body["text"])
+        batch = {"commands": commands, "results": [], "returned": 0, "changed": asyncio.Event()}
+        batch_id = uuid.uuid4().hex
+        activity.batches[batch_id] = batch
+        asyncio.create_task(self._execute(activity, batch))
+        return web.json_response(batch_id, status=201)
+
+    async def _execute(self, activity: Activity, batch: dict):
+        commands = batch["commands"]
+        for index, command in enumerate(commands):
+            name = next(iter(command))
+            ok = True
+            if name == "deploy":
+                activity.state = "Deploying"
+                await asyncio.sleep(self.deploy_time(self.rng))
+                ok = self.rng.random() >= self.args.deploy_failure_rate
+                activity.state = "Deployed" if ok else "Terminated"
+            elif name == "start":
+                await asyncio.sleep(self.args.start_time)
+                activity.state = "Ready"
+                activity.model_ready_at = time.monotonic() + self.model_load_time(self.rng)
+            batch["results"].append({
+                "index": index,
+                "eventDate": iso(now()),
+                "result": "Ok" if ok else "Error",
+                "stdout": None,
+                "stderr": None,
+                "message": None if ok else f"{name} failed",
+                "isBatchFinished": not ok or index == len(commands) - 1,
+            })
+            batch["changed"].set()
+            if not ok:
+                return
+
+    async def get_exec_batch_results(self, request):
+        activity = self.activities.get(request.match_info["activity"])
+        batch = activity and activity.batches.get(request.match_info["batch"])
+        if not batch:
+            return not_found("Batch")
+        timeout = float(request.query.get("timeout", 0))
+        # Results are cumulative, long poll waits until there is something not returned yet.
+        finished = batch["results"] and batch["results"][-1]["isBatchFinished"]
+        if len(batch["results"]) == batch["returned"] and not finished and timeout > 0:
+            batch["changed"].clear()
+            try:
+                await asyncio.wait_for(batch["changed"].wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        batch["returned"] = len(batch["results"])
+        return web.json_response(batch["results"])
+
+    async def get_activity_state(self, request):
+        activity = self.activities.get(request.match_info["activity"])
+        if activity is None:
+            return not_found("Activity")
+        return web.json_response({"state": [activity.state, None], "reason": None, "errorMessage": None})
+
+    async def get_activity_usage(self, request):
+        activity = self.activities.get(request.match_info["activity"])
+        if activity is None:
+            return not_found("Activity")
+        return web.json_response({"currentUsage": self._usage(activity), "timestamp": int(time.time())})
+
+    async def proxy_http(self, request: web.Request):
+        activity = self.activities.get(request.match_info["activity"])
+        if activity is None:
+            return not_found("Activity")
+        if activity.state != "Ready" or not self.args.backend:
+            return web.json_response({"message": "Runtime is not serving http"}, status=503)
+        if time.monotonic() < activity.model_ready_at:
+            return web.json_response({"message": "Runtime is loading the model"}, status=503)
+        activity.requests += 1
+        self.counters["proxied"] += 1
+        headers = {name: request.headers[name] for name in ("Content-Type", "Accept") if name in request.headers}
+        async with self.session.request(
+            request.method,
+            f"{self.args.backend}/{request.match_info['path']}",
+            data=await request.read(),
+            headers=headers,
+        ) as upstream:
+            response = web.StreamResponse(
+                status=upstream.status,
+                headers={"Content-Type": upstream.headers.get("Content-Type", "application/octet-stream")},
+            )
+            await response.prepare(request)
+            try:
+                async for chunk in upstream.content.iter_any():
+                    await response.write(chunk)
+                await response.write_eof()
+            except ConnectionResetError:
+                pass
+            return response
+
+    # Payment
+
+    def _usage(self, activity: Activity) -> List[float]:
+        duration = time.monotonic() - activity.created_at
+        return [duration, duration, float(activity.requests)]
+
+    def _cost(self, activity: Activity) -> float:
+        properties = self.agreements[activity.agreement_id]["offer"]["properties"]
+        coeffs = properties["golem.com.pricing.model.linear.coeffs"]
+        return sum(c * u for c, u in zip(coeffs, self._usage(activity))) + coeffs[-1]
+
+    def _platform(self, agreement: dict) -> str:
+        return agreement["demand"]["properties"].get("golem.com.payment.chosen-platform", PAYMENT_PLATFORMS[0])
+
+    async def _bill(self, activity: Activity):
+        while True:
+            await asyncio.sleep(self.args.debit_note_interval)
+            await self._issue_debit_note(activity)
+
+    async def _issue_debit_note(self, activity: Activity):
+        agreement = self.agreements[activity.agreement_id]
+        amount = self._cost(activity)
+        debit_note_id = uuid.uuid4().hex
+        self.debit_notes[debit_note_id] = {
+            "debitNoteId": debit_note_id,
+            "issuerId": agreement["offer"]["providerId"],
+            "recipientId": self.identity,
+            "payeeAddr": agreement["offer"]["providerId"],
+            "payerAddr": self.identity,
+            "paymentPlatform": self._platform(agreement),
+            "timestamp": iso(now()),
+            "agreementId": activity.agreement_id,
+            "activityId": activity.id,
+            "totalAmountDue": f"{amount:.18f}",
+            "usageCounterVector": self._usage(activity),
+            "status": "RECEIVED",
+        }
+        self.counters["debit_notes"] += 1
+        await self.debit_note_events.append({"eventType": "DebitNoteReceivedEvent", "debitNoteId": debit_note_id})
+
+    async def _issue_invoice(self, agreement: dict):
+        activities = [a for a in self.activities.values() if a.agreement_id == agreement["agreementId"]]
+        amount = sum(self._cost(a) for a in activities)
+        invoice_id = uuid.uuid4().hex
+        self.invoices[invoice_id] = {
+            "invoiceId": invoice_id,
+            "issuerId": agreement["offer"]["providerId"],
+            "recipientId": self.identity,
+            "payeeAddr": agreement["offer"]["providerId"],
+            "payerAddr": self.identity,
+            "paymentPlatform": self._platform(agreement),
+            "timestamp": iso(now()),
+            "agreementId": agreement["agreementId"],
+            "activityIds": [a.id for a in activities],
+            "amount": f"{amount:.18f}",
+            "paymentDueDate": iso(now()),
+            "status": "RECEIVED",
+        }
+        self.counters["invoices"] += 1
+        await self.invoice_events.append({"eventType": "InvoiceReceivedEvent", "invoiceId": invoice_id})
+
+    async def requestor_accounts(self, _request):
+        return web.json_response([
+            {
+                "platform": platform,
+                "address": self.identity,
+                "driver": platform.split("-")[0],
+                "network": platform.split("-")[1],
+                "token": platform.split("-")[2],
+                "send": True,
+                "receive": False,
+            }
+            for platform in PAYMENT_PLATFORMS
+        ])
+
+    async def create_allocation(self, request):
+        body = await request.json()
+        allocation_id = uuid.uuid4().hex
+        total = body.get("totalAmount", "0")
+        self.allocations[allocation_id] = {
+            **body,
+            "allocationId": allocation_id,
+            "address": body.get("address") or self.identity,
+            "paymentPlatform": body.get("paymentPlatform") or PAYMENT_PLATFORMS[0],
+            "spentAmount": "0",
+            "remainingAmount": str(total),
+            "timestamp": iso(now()),
+            "makeDeposit": body.get("makeDeposit", False),
+        }
+        return web.json_response(self.allocations[allocation_id], status=201)
+
+    async def get_allocations(self, _request):
+        return web.json_response(list(self.allocations.values()))
+
+    async def get_allocation(self, request):
+        allocation = self.allocations.get(request.match_info["allocation"])
+        return web.json_response(allocation) if allocation else not_found("Allocation")
+
+    async def release_allocation(self, request):
+        if self.allocations.pop(request.match_info["allocation"], None) is None:
+            return not_found("Allocation")
+        return web.Response(status=204)
+
+    async def demand_decorations(self, request):
+        ids = [i for i in request.query.get("allocationIds", "").split(",") if i]
+        allocations = [self.allocations[i] for i in ids if i in self.allocations]
+        properties = [
+            {"key": f"golem.com.payment.platform.{a['paymentPlatform']}.address", "value": a["address"]}
+            for a in allocations
+        ]
+        properties.append({"key": "golem.com.payment.protocol.version", "value": "3"})
+        constraints = [
+            "(|" + "".join(f"(golem.com.payment.platform.{a['paymentPlatform']}.address=*)" for a in allocations) + ")"
+        ] if allocations else []
+        return web.json_response({"properties": properties, "constraints": constraints})
+
+    async def get_debit_note_events(self, request):
+        return web.json_response(await self._events(self.debit_note_events, request))
+
+    async def get_invoice_events(self, request):
+        return web.json_response(await self._events(self.invoice_events, request))
+
+    @staticmethod
+    async def _events(log: EventLog, request) -> List[dict]:
+        return await log.poll(
+            parse_time(request.query.get("afterTimestamp")),
+            min(float(request.query.get("timeout", 5)), 30),
+            int(request.query.get("maxEvents", 100)),
+        )
+
+    async def get_debit_note(self, request):
+        debit_note = self.debit_notes.get(request.match_info["debit_note"])
+        return web.json_response(debit_note) if debit_note else not_found("Debit note")
+
+    async def get_invoice(self, request):
+        invoice = self.invoices.get(request.match_info["invoice"])
+        return web.json_response(invoice) if invoice else not_found("Invoice")
+
+    def _spend(self, allocation_id: Optional[str], amount: str):
+        allocation = self.allocations.get(allocation_id or "")
+        if allocation is not None:
+            spent = float(allocation["spentAmount"]) + float(amount)
+            allocation["spentAmount"] = f"{spent:.18f}"
+            allocation["remainingAmount"] = f"{float(allocation['totalAmount']) - spent:.18f}"
+
+    async def accept_debit_note(self, request):
+        debit_note = self.debit_notes.get(request.match_info["debit_note"])
+        if debit_note is None:
+            return not_found("Debit note")
+        debit_note["status"] = "ACCEPTED"
+        return web.Response(status=204)
+
+    async def accept_invoice(self, request):
+        invoice = self.invoices.get(request.match_info["invoice"])
+        if invoice is None:
+            return not_found("Invoice")
+        body = await request.json()
+        invoice["status"] = "ACCEPTED"
+        self._spend(body.get("allocationId"), body.get("totalAmountAccepted", invoice["amount"]))
+        return web.Response(status=204)
+
+
+def csv(value):
+    return [v for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1", help="default: %(default)s")
+    parser.add_argument("--port", type=int, default=7465, help="default: %(default)s")
+    parser.add_argument("--app-key", default=None, help="Require this application key; by default any key is accepted")
+    parser.add_argument("--offers", type=int, default=2000, help="Number of synthetic providers; default: %(default)s")
+    parser.add_argument("--runtimes", type=csv, default=["automatic", "dummy"], help="Runtimes offered by providers; default: automatic,dummy")
+    parser.add_argument("--subnet", default="public", help="default: %(default)s")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of generated offers and sampled delays; default: %(default)s")
+    parser.add_argument("--negotiation-delay", type=float, default=0.05, help="Provider response time in negotiation, seconds; default: %(default)s")
+    parser.add_argument("--reject-rate", type=float, default=0.0, help="Fraction of counter-proposals rejected by providers; default: %(default)s")
+    parser.add_argument("--agreement-reject-rate", type=float, default=0.0, help="Fraction of agreements rejected by providers; default: %(default)s")
+    parser.add_argument("--deploy-time", default="uniform:1,5", help="Duration of deploy command: fixed:s, uniform:low,high or exponential:mean; default: %(default)s")
+    parser.add_argument("--deploy-failure-rate", type=float, default=0.0, help="Fraction of failed deployments; default: %(default)s")
+    parser.add_argument("--start-time", type=float, default=0.5, help="Duration of start command, seconds; default: %(default)s")
+    parser.add_argument("--model-load-time", default="fixed:0", help="Time after start during which proxy-http answers 503, like a runtime loading its model: same forms as --deploy-time; default: %(default)s")
+    parser.add_argument("--debit-note-interval", type=float, default=120, help="Seconds between debit notes of an activity; default: %(default)s")
+    parser.add_argument("--backend", default=None, help="Base url proxy-http requests are forwarded to, e.g. http://127.0.0.1:7861")
+    args = parser.parse_args()
+
+    mock = YagnaMock(args)
+    print(f"Serving {len(mock.offers)} offers as {mock.identity} on http://{args.host}:{args.port}", flush=True)
+    web.run_app(mock.app(), host=args.host, port=args.port, access_log=None, print=None)
+
+
+if __name__ == "__main__":
+    main()
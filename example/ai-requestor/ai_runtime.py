@@ -1,12 +1,10 @@
 import asyncio
-import base64
-from concurrent.futures import ThreadPoolExecutor
-import io
+import functools
+import itertools
 import json
 import os
-from typing import Final
-from PIL import Image
-import requests
+import time
+from typing import Dict, Final, Optional, Set
 
 from dataclasses import dataclass
 from datetime import datetime, timedelta
@@ -32,7 +30,24 @@ from yapapi import windows_event_loop_fix
 from yapapi.log import enable_default_logger
 from yapapi.strategy import SCORE_TRUSTED, SCORE_REJECTED, MarketStrategy
 from yapapi.strategy.base import PropValueRange, PROP_DEBIT_NOTE_INTERVAL_SEC, PROP_PAYMENT_TIMEOUT_SEC
-from ya_activity import RequestorControlApi
+from yapapi.events import DebitNoteAccepted, InvoiceAccepted, ServiceStateChanged, SubscriptionCreated
+
+from dispatcher import Dispatcher
+from autoscale import Autoscaler, ScalingOptions, Spending
+from batch import DEFAULT_PARAMS, BatchRunner, open_source
+from cache import CACHE_MODES, ResultCache, model_hash
+from coalesce import Coalescer, CoalescingOptions
+from images import numbered_paths
+from metrics import Metrics, RequestTiming
+from models import DEFAULT_MODEL, ModelSpec, load_catalog
+from postprocess import PostProcessOptions, PostProcessor
+from proxy_client import TXT2IMG_URL, ClientConfig, ProxyHttpClient, txt2img_to_files
+from readiness import InstanceHealth, ProbeOptions, ReadinessMonitor
+from registry import ActivityHandle, ActivityRegistry
+from reputation import ReputationStore
+from resilience import RequestPolicy, ResilientRequester, attempt_handler
+from scoring import REFERENCE_SECONDS_PER_IMAGE, OfferEstimate, OfferScorer, ScoringOptions
+from state_feed import StateFeed, open_channel
 
 PROP_PAYMENT_TIMEOUT_SEC: Final[str] = "golem.com.scheme.payu.payment-timeout-sec?"
 PROP_DEBIT_NOTE_ACCEPTANCE_TIMEOUT: Final[str] = "golem.com.payment.debit-notes.accept-timeout?"
@@ -68,6 +83,309 @@ def build_parser(description: str) -> argparse.ArgumentParser:
     parser.add_argument("--subnet-tag", help="Subnet name, for example `public`")
     parser.add_argument("--select-node", default=None, help="Match only with selected Node")
     parser.add_argument("--runtime", default="automatic", help="Runtime name, for example `automatic`")
+    parser.add_argument(
+        "--model",
+        default=DEFAULT_MODEL,
+        help="Model from the catalog used for prompts which do not name one; default: %(default)s",
+    )
+    parser.add_argument(
+        "--model-catalog",
+        default=None,
+        help="JSON file with models added to the built-in catalog: {\"name\": {\"url\": \"hash:...\", \"size_gib\": 2.0}}",
+    )
+    parser.add_argument(
+        "--model-instances",
+        type=int,
+        default=1,
+        help="Number of providers hired for a model other than --model when a prompt asks for it; default: %(default)s",
+    )
+    parser.add_argument(
+        "--model-affinity",
+        type=float,
+        default=0.5,
+        help="How much to prefer providers which deployed the model before, from 0 to 1; default: %(default)s",
+    )
+    parser.add_argument("--gpu-model", default=None, help="Hire only providers with GPU model matching this regex")
+    parser.add_argument("--min-vram", type=float, default=0.0, help="Minimum GPU memory in GiB; default: %(default)s")
+    parser.add_argument(
+        "--max-seconds-per-image",
+        type=float,
+        default=None,
+        help="Reject GPUs estimated to be slower than this",
+    )
+    parser.add_argument(
+        "--max-cost-per-image",
+        type=float,
+        default=None,
+        help="Reject offers with higher expected GLM cost per image",
+    )
+    parser.add_argument(
+        "--require-gpu",
+        action="store_true",
+        help="Reject offers without GAP-35 GPU properties",
+    )
+    parser.add_argument(
+        "--reference-seconds-per-image",
+        type=float,
+        default=REFERENCE_SECONDS_PER_IMAGE,
+        help="Expected generation time on RTX 3090, scales speed estimates of all GPUs; default: %(default)s",
+    )
+    parser.add_argument(
+        "--reputation-db",
+        default="ai-reputation.sqlite",
+        help="SQLite file with track record of providers, kept across runs; default: %(default)s",
+    )
+    parser.add_argument(
+        "--max-error-rate",
+        type=float,
+        default=0.5,
+        help="Stop hiring providers whose requests failed more often than this; default: %(default)s",
+    )
+    parser.add_argument(
+        "--ready-timeout",
+        type=float,
+        default=1800.0,
+        help="Seconds a provider has to download and load the model before it is given up; default: %(default)s",
+    )
+    parser.add_argument(
+        "--liveness-interval",
+        type=float,
+        default=30.0,
+        help="Seconds between liveness probes of ready providers, 0 disables them; default: %(default)s",
+    )
+    parser.add_argument(
+        "--liveness-failures",
+        type=int,
+        default=3,
+        help="Failed liveness probes in a row after which provider gets no more requests; default: %(default)s",
+    )
+    parser.add_argument(
+        "--request-timeout",
+        type=float,
+        default=600.0,
+        help="Timeout of a single inference request in seconds; default: %(default)s",
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=32,
+        help="Maximum number of requests in flight; default: %(default)s",
+    )
+    parser.add_argument(
+        "--connections-per-provider",
+        type=int,
+        default=4,
+        help="Size of keep-alive connection pool per provider; default: %(default)s",
+    )
+    parser.add_argument(
+        "--stall-timeout",
+        type=float,
+        default=60.0,
+        help="Fail streamed request when provider sends no progress event for this many seconds; default: %(default)s",
+    )
+    parser.add_argument(
+        "--no-progress-stream",
+        dest="progress_stream",
+        action="store_false",
+        help="Do not ask runtime for text/event-stream progress events",
+    )
+    parser.add_argument(
+        "--num-instances",
+        type=int,
+        default=1,
+        help="Number of providers to hire; default: %(default)s",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=50.0,
+        help="Maximum GLM spent in this run; default: %(default)s",
+    )
+    parser.add_argument(
+        "--max-instances",
+        type=int,
+        default=None,
+        help="Grow and shrink every model's cluster with load up to this many providers; default: fixed size",
+    )
+    parser.add_argument(
+        "--min-instances",
+        type=int,
+        default=1,
+        help="Providers kept when idle, with --max-instances; default: %(default)s",
+    )
+    parser.add_argument(
+        "--scale-up-queue",
+        type=float,
+        default=2.0,
+        help="Hire more providers when more prompts per provider than this are queued; default: %(default)s",
+    )
+    parser.add_argument(
+        "--scale-up-p95",
+        type=float,
+        default=None,
+        help="Hire more providers when p95 of request duration in seconds exceeds this while prompts are queued",
+    )
+    parser.add_argument(
+        "--scale-down-idle",
+        type=float,
+        default=120.0,
+        help="Stop providers which got no requests for this many seconds; default: %(default)s",
+    )
+    parser.add_argument(
+        "--scale-up-cooldown",
+        type=float,
+        default=30.0,
+        help="Seconds after resizing a cluster before it grows again; default: %(default)s",
+    )
+    parser.add_argument(
+        "--scale-down-cooldown",
+        type=float,
+        default=120.0,
+        help="Seconds after resizing a cluster before it shrinks again; default: %(default)s",
+    )
+    parser.add_argument(
+        "--budget-share",
+        type=float,
+        default=0.9,
+        help="Stop hiring and stop idle providers once this share of --budget is spent; default: %(default)s",
+    )
+    parser.add_argument(
+        "--max-batch",
+        type=int,
+        default=1,
+        help="Merge up to this many repeated prompts with a random seed into one request, "
+        "needs --cache-mode seeded or bypass; default: %(default)s (off)",
+    )
+    parser.add_argument(
+        "--max-batch-wait",
+        type=float,
+        default=0.25,
+        help="Seconds a prompt waits for others to be batched with; default: %(default)s",
+    )
+    parser.add_argument(
+        "--max-per-provider",
+        type=int,
+        default=1,
+        help="Maximum number of requests in flight on a single provider; default: %(default)s",
+    )
+    parser.add_argument(
+        "--batch",
+        default=None,
+        help="Run prompts from JSONL file (`-` for stdin) instead of asking for them interactively",
+    )
+    parser.add_argument(
+        "--output-dir",
+        default="outputs",
+        help="Directory for batch results and manifest; default: %(default)s",
+    )
+    parser.add_argument(
+        "--batch-concurrency",
+        type=int,
+        default=16,
+        help="Maximum number of batch prompts waiting for results; default: %(default)s",
+    )
+    parser.add_argument(
+        "--image-format",
+        default="png",
+        choices=["png", "webp", "jpeg"],
+        help="Format of saved images, other than png requires re-encoding; default: %(default)s",
+    )
+    parser.add_argument(
+        "--thumbnail-size",
+        type=int,
+        default=None,
+        help="Also save thumbnails fitting into square of this size",
+    )
+    parser.add_argument(
+        "--embed-metadata",
+        action="store_true",
+        help="Embed prompt and generation parameters in saved images",
+    )
+    parser.add_argument(
+        "--postprocess-mode",
+        default="process",
+        choices=["process", "thread"],
+        help="Pool used for image post-processing; default: %(default)s",
+    )
+    parser.add_argument(
+        "--postprocess-workers",
+        type=int,
+        default=None,
+        help="Number of post-processing workers; default: up to 4, depending on CPU count",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default="ai-cache",
+        help="Directory of local result cache; default: %(default)s",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=2048,
+        help="Maximum size of result cache in MiB; default: %(default)s",
+    )
+    parser.add_argument(
+        "--cache-mode",
+        default="use",
+        choices=CACHE_MODES,
+        help="`use` caches all requests, `seeded` only those with fixed seed, `bypass` disables cache; default: %(default)s",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve Prometheus metrics on this port",
+    )
+    parser.add_argument(
+        "--metrics-host",
+        default="127.0.0.1",
+        help="Address of metrics endpoint; default: %(default)s",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default=None,
+        help="Append json snapshot of metrics to this file periodically",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=30.0,
+        help="Interval of json metrics snapshots in seconds; default: %(default)s",
+    )
+    parser.add_argument(
+        "--state-feed",
+        default=None,
+        help="Write instance state changes as JSON lines here: `fd:N` or path of a file or named pipe",
+    )
+    parser.add_argument(
+        "--attempts",
+        type=int,
+        default=3,
+        help="Maximum number of requests sent for a prompt, retries and hedges included; default: %(default)s",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=None,
+        help="Time limit for a prompt in seconds, covering queueing, retries and hedges",
+    )
+    parser.add_argument(
+        "--hedge",
+        action="store_true",
+        help="Send duplicate request to another provider when the first one is slower than usual",
+    )
+    parser.add_argument(
+        "--hedge-quantile",
+        type=float,
+        default=0.95,
+        help="Quantile of observed durations per image of the model after which hedge is sent; default: %(default)s",
+    )
+    parser.add_argument(
+        "--hedge-delay",
+        type=float,
+        default=60.0,
+        help="Hedge delay in seconds used until enough requests are observed; default: %(default)s",
+    )
     parser.add_argument(
         "--log-file",
         default=str(default_log_path),
@@ -140,12 +458,32 @@ def run_golem_example(example_main, log_file=None):
 
 
 class ProviderOnceStrategy(MarketStrategy):
-    """Hires provider only once.
+    """Hires provider only once, preferring GPUs with most images per GLM.
+
+    With `reputation`, speed measured in previous runs replaces the estimate from
+    GPU properties, and providers that failed too often are not hired. Providers
+    which deployed a demanded model before likely have it cached; their score is
+    moved `model_affinity` of the way towards `SCORE_TRUSTED`. Offers don't tell which
+    demand they answer, so with several models demanded any of them counts. Demanded
+    models are learned from `SubscriptionCreated` events, register `consume` for them.
     """
 
-    def __init__(self, select_node: str = None):
+    def __init__(
+        self,
+        select_node: str = None,
+        scorer: Optional[OfferScorer] = None,
+        reputation: Optional[ReputationStore] = None,
+        max_error_rate: float = 1.0,
+        model_affinity: float = 0.0,
+    ):
         self.node = select_node
         self.history = set(())
+        self.scorer = scorer or OfferScorer()
+        self.reputation = reputation
+        self.max_error_rate = max_error_rate
+        self.model_affinity = model_affinity
+        self.estimates: Dict[str, OfferEstimate] = {}
+        self.demanded_models: Set[str] = set()
         self.acceptable_prop_value_range_overrides =  {
             PROP_DEBIT_NOTE_INTERVAL_SEC: PropValueRange(60, None),
             PROP_PAYMENT_TIMEOUT_SEC: PropValueRange(int(180), None),
@@ -162,15 +500,43 @@ class ProviderOnceStrategy(MarketStrategy):
                 print(f"[Strategy] Rejecting issuer: {offer.props['golem.node.id.name']} ({offer.issuer}), because he is not on selected list.")
                 return SCORE_REJECTED
         else:
-            if offer.issuer not in self.history:
-                return SCORE_TRUSTED
-            else:
+            if offer.issuer in self.history:
                 print(f"[Strategy] Rejecting issuer: {offer.props['golem.node.id.name']} ({offer.issuer})")
                 return SCORE_REJECTED
-
-
-    def remember(self, provider_id: str):
+            record = self.reputation.get(offer.issuer) if self.reputation is not None else None
+            if record is None:
+                estimate = self.scorer.estimate(offer.props)
+                reason = None
+            else:
+                estimate = self.scorer.estimate(offer.props, record.measured_seconds, record.reliability)
+                reason = record.rejection(self.max_error_rate)
+            reason = reason or self.scorer.rejection(estimate)
+            if reason is not None:
+                print(f"[Strategy] Rejecting issuer: {offer.props['golem.node.id.name']} ({offer.issuer}): {reason}")
+                return SCORE_REJECTED
+            self.estimates[offer.issuer] = estimate
+            score = self.scorer.score(estimate)
+            if self.reputation is not None and any(
+                self.reputation.has_model(offer.issuer, model) for model in self.demanded_models
+            ):
+                score += (SCORE_TRUSTED - score) * self.model_affinity
+            return score
+
+    def consume(self, event: SubscriptionCreated):
+        image_url = getattr(event.job.payload, "image_url", None)
+        if image_url is not None:
+            self.demanded_models.add(model_hash(image_url))
+
+    def remember(self, provider_id: str, model: Optional[ModelSpec] = None):
         self.history.add(provider_id)
+        estimate = self.estimates.get(provider_id)
+        if estimate is not None:
+            print(f"[Strategy] Hired {provider_id}: {estimate.describe()}")
+        record = self.reputation.get(provider_id) if self.reputation is not None else None
+        if record is not None:
+            print(f"[Strategy] Track record of {provider_id}: {record.describe()}")
+        if model is not None and self.reputation is not None and self.reputation.has_model(provider_id, model.hash):
+            print(f"[Strategy] {provider_id} deployed {model.name} before, it is likely cached")
 
 # App
 
@@ -187,33 +553,19 @@ class AiPayload(Payload):
 
 class AiRuntimeService(Service):
     runtime: str
+    model: ModelSpec
+
+    @classmethod
+    async def get_payload(cls):
+        return AiPayload(image_url=cls.model.url, image_fmt=cls.model.format, runtime=cls.runtime)
+
+    @classmethod
+    def for_model(cls, model: ModelSpec) -> type:
+        """Service class deploying `model`. Every model gets its own cluster."""
+        return type(f"{cls.__name__}[{model.name}]", (cls,), {"model": model})
 
-    @staticmethod
-    async def get_payload():
-        ## TODO switched into using smaller model to avoid problems during tests. Resolve it when automatic runtime integrated
-        # return AiPayload(image_url="hash:sha3:0b682cf78786b04dc108ff0b254db1511ef820105129ad021d2e123a7b975e7c:https://huggingface.co/cointegrated/rubert-tiny2/resolve/main/model.safetensors?download=true")
-        
-        return AiPayload(
-            image_url="hash:sha3:b2da48d618beddab1887739d75b50a3041c810bc73805a416761185998359b24:https://huggingface.co/runwayml/stable-diffusion-v1-5/resolve/main/v1-5-pruned-emaonly.safetensors?download=true",
-            runtime=AiRuntimeService.runtime,
-        )
-        # return AiPayload(
-        #     image_url="hash:sha2:26ebb6db2a68593c54c74902d7a74f332da66297693f965cc9f1b0af4abf3894:https://huggingface.co/cointegrated/rubert-tiny2/resolve/main/model.safetensors?download=true",
-        #     runtime=AiRuntimeService.runtime,
-        # )
-        # return AiPayload(
-        #     image_url="hash:sha3:92180a67d096be309c5e6a7146d89aac4ef900e2bf48a52ea569df7d:https://huggingface.co/stabilityai/stable-diffusion-xl-base-1.0/resolve/main/sd_xl_base_1.0.safetensors?download=true",
-        #     runtime=AiRuntimeService.runtime,
-        # )
-        # return AiPayload(
-        #     image_url="hash:sha2:31e35c80fc4829d14f90153f4c74cd59c90b779f6afe05a74cd6120b893f7e5b:https://huggingface.co/stabilityai/stable-diffusion-xl-base-1.0/resolve/main/sd_xl_base_1.0.safetensors?download=true",
-        #     runtime=AiRuntimeService.runtime,
-        # )
-
-        
-    
     async def start(self):
-        self.strategy.remember(self._ctx.provider_id)
+        self.strategy.remember(self._ctx.provider_id, self.model)
 
         script = self._ctx.new_script(timeout=None)
         script.deploy()
@@ -225,32 +577,32 @@ class AiRuntimeService(Service):
         self.strategy = strategy
 
 
-async def trigger(activity: RequestorControlApi, token, prompt, output_file):
+async def trigger(client: ProxyHttpClient, handle: ActivityHandle, token, payload, path_for, timing=None, verbose=True):
 
-    custom_url = "/sdapi/v1/txt2img"
-    url = activity._api.api_client.configuration.host + f"/activity/{activity.id}/proxy-http" + custom_url
-    headers = {"Authorization": "Bearer "+token}
+    url = handle.url + TXT2IMG_URL
 
-    payload = {
-        'prompt': prompt,
-        'steps': 250
-    }
+    if verbose:
+        print('Sending request:')
+        payload_str = str(payload).replace("'", "\\\"")
+        print(f'curl -X POST -H \'Authorization: Bearer {token}\' -H "Content-Type: application/json; charset=utf-8"  -H "Accept: text/event-stream" -d "{payload_str}" {url}')
 
-    print('Sending request:')
-    payload_str = str(payload).replace("'", "\\\"")
-    print(f'curl -X POST -H \'Authorization: Bearer {token}\' -H "Content-Type: application/json; charset=utf-8"  -H "Accept: text/event-stream" -d "{payload_str}" {url}')
-    
-    response = requests.post(url, headers=headers, json=payload, stream=True)
-    if response.encoding is None:
-        response.encoding = 'utf-8'
+    def on_progress(event, data):
+        if event == "preview":
+            state = data.get("state", {})
+            print(
+                f"{handle.provider_name}: {data.get('progress', 0):.0%} "
+                f"(step {state.get('sampling_step')}/{state.get('sampling_steps')}, "
+                f"eta {data.get('eta_relative', 0):.1f}s)"
+            )
 
-    if response.ok:
-        response = json.loads(response.text)
-        image = Image.open(io.BytesIO(base64.b64decode(response['images'][0])))
-        print(f"Saving response to {os.path.abspath(output_file)}")
-        image.save(output_file)
-    else:
-        print(f"Error code: {response.status_code}, message: {response.text}")
+    return await txt2img_to_files(
+        client,
+        handle,
+        payload,
+        path_for,
+        timing=timing,
+        on_progress=on_progress if verbose else None,
+    )
 
 
 async def ainput(prompt: str = ""):
@@ -258,76 +610,313 @@ async def ainput(prompt: str = ""):
 
 
 async def main(subnet_tag, driver=None, network=None, args=None):
-    strategy = ProviderOnceStrategy(select_node=args.select_node)
+    catalog = load_catalog(Path(args.model_catalog) if args.model_catalog else None)
+    if args.model not in catalog:
+        raise ValueError(f"Unknown model {args.model}, known: {', '.join(catalog)}")
+    default_model = catalog[args.model]
+    reputation = ReputationStore(Path(args.reputation_db))
+    strategy = ProviderOnceStrategy(
+        select_node=args.select_node,
+        scorer=OfferScorer(
+            ScoringOptions(
+                gpu_model=args.gpu_model,
+                min_vram_gib=args.min_vram,
+                max_seconds_per_image=args.max_seconds_per_image,
+                max_cost_per_image=args.max_cost_per_image,
+                require_gpu=args.require_gpu,
+                reference_seconds_per_image=args.reference_seconds_per_image,
+            )
+        ),
+        reputation=reputation,
+        max_error_rate=args.max_error_rate,
+        model_affinity=args.model_affinity,
+    )
     async with Golem(
-        budget=50.0,
+        budget=args.budget,
         subnet_tag=subnet_tag,
         strategy=strategy,
         payment_driver=driver,
         payment_network=network,
-    ) as golem:
-        AiRuntimeService.runtime = args.runtime
-        cluster = await golem.run_service(
-            AiRuntimeService,
-            instance_params=[
-                {"strategy": strategy}
-            ],
-            num_instances=1,
-            expiration=datetime.now(timezone.utc) + timedelta(days=10),
+    ) as golem, ProxyHttpClient(
+        ClientConfig(
+            request_timeout=args.request_timeout,
+            connections_per_activity=args.connections_per_provider,
+            max_concurrency=args.max_concurrency,
+            stream_progress=args.progress_stream,
+            stall_timeout=args.stall_timeout,
+        ),
+    ) as client:
+        registry = ActivityRegistry(golem._engine._api_config.app_key)
+        golem.add_event_consumer(registry.consume, [ServiceStateChanged])
+        state_feed = StateFeed(open_channel(args.state_feed) if args.state_feed else None)
+        golem.add_event_consumer(state_feed.consume, [ServiceStateChanged])
+        golem.add_event_consumer(
+            reputation.consume, [ServiceStateChanged, DebitNoteAccepted, InvoiceAccepted]
+        )
+        golem.add_event_consumer(strategy.consume, [SubscriptionCreated])
+        spending = Spending()
+        golem.add_event_consumer(spending.consume, [DebitNoteAccepted, InvoiceAccepted])
+        readiness = ReadinessMonitor(
+            ProbeOptions(
+                ready_timeout=args.ready_timeout,
+                liveness_interval=args.liveness_interval,
+                liveness_failures=args.liveness_failures,
+            )
         )
+        registry.add_listener(on_added=readiness.add, on_removed=readiness.remove)
+
+        def on_ready(health: InstanceHealth):
+            handle = health.handle
+            model = handle.service.model
+            deploy = reputation.record_deploy(handle.service_id, handle.provider_id, model.hash, health.warm_up)
+            record = {
+                "ts": round(time.time(), 3),
+                "event": "ready",
+                "service": handle.service_id,
+                "provider_id": handle.provider_id,
+                "provider_name": handle.provider_name,
+                "activity": handle.id,
+                "warm_up": round(health.warm_up, 3),
+                "model": model.name,
+            }
+            if deploy is not None:
+                print(
+                    f"{handle.provider_name} deployed {model.name} "
+                    f"({'downloaded' if deploy.last_cold else 'cached'}, "
+                    f"{deploy.cold_deploys} of {deploy.deploys} deploys downloaded it)"
+                )
+                record["cold"] = deploy.last_cold
+            state_feed.emit(record)
 
-        def instances():
-            return [
-                {
-                    'name': s.provider_name,
-                    'state': s.state.value,
-                    'context': s._ctx
-                } for s in cluster.instances
-            ]
-
-        async def get_image(prompt, file_name):
-            
-            for s in cluster.instances:
-
-                for _ in range(0, 10):
-                    if s._ctx == None:
-                        print(f'Context is {s._ctx} for: {s.provider_name} {s.state.value}... waiting')
-                        await asyncio.sleep(1)
-                    else:
-                        break
-
-                if s._ctx != None:
-                    for id in [s._ctx._activity.id ]:
-                        activity = await golem._engine._activity_api.use_activity(id)
-                        await trigger(
-                            activity,
-                            golem._engine._api_config.app_key,
-                            prompt,
-                            file_name
-                        )
-                else:
-                    print(f'...gave up')
+        readiness.add_listener(on_ready=on_ready)
 
-        # Begin
-        while True:
-            i = instances()
+        # Every model runs in its own cluster, so asking for another model hires
+        # providers for it instead of redeploying the ones already running.
+        AiRuntimeService.runtime = args.runtime
+        clusters = {}
+        clusters_lock = asyncio.Lock()
+        scalers = []
+        scaling = None
+        if args.max_instances is not None:
+            scaling = ScalingOptions(
+                min_instances=args.min_instances,
+                max_instances=args.max_instances,
+                queue_per_instance=args.scale_up_queue,
+                max_p95=args.scale_up_p95,
+                idle_timeout=args.scale_down_idle,
+                up_cooldown=args.scale_up_cooldown,
+                down_cooldown=args.scale_down_cooldown,
+                budget=args.budget,
+                budget_share=args.budget_share,
+            )
+
+        async def ensure_cluster(model: ModelSpec, num_instances: int):
+            """Must be called inside the dispatcher context, autoscaler of the cluster reads its queues."""
+            async with clusters_lock:
+                if model.name in clusters:
+                    return
+                if scaling is not None:
+                    num_instances = min(max(num_instances, scaling.min_instances), scaling.max_instances)
+                print(f"Hiring {num_instances} provider(s) for model {model.name} ({model.size_gib:.2f} GiB)")
+                cluster = clusters[model.name] = await golem.run_service(
+                    AiRuntimeService.for_model(model),
+                    instance_params=[
+                        {"strategy": strategy}
+                    ] * num_instances,
+                    num_instances=num_instances,
+                    expiration=datetime.now(timezone.utc) + timedelta(days=10),
+                )
+                if scaling is not None:
+                    scaler = Autoscaler(
+                        cluster,
+                        dispatcher,
+                        {"strategy": strategy},
+                        spending,
+                        scaling,
+                        pool=model.name,
+                        metrics=metrics,
+                        feed=state_feed,
+                        readiness=readiness,
+                    )
+                    scaler.start()
+                    scalers.append(scaler)
+
+        def retire(health: InstanceHealth):
+            """Stop an instance that never got ready or stopped answering, so it is not paid for idle.
+
+            Clusters with an autoscaler hire again when they need to, others get a replacement right away.
+            """
+            service = health.handle.service
+            cluster = service.cluster
+            if cluster is None or cluster.service_runner.stopped:
+                return
+            print(f"Stopping {health.handle.provider_name} ({health.state})")
+            cluster.stop_instance(service)
+            if scaling is None:
+                cluster.spawn_instances(instance_params=[{"strategy": strategy}])
+
+        readiness.add_listener(on_unhealthy=retire, on_failed=retire)
+
+        async def get_image(handle, payload, path_for, timing: RequestTiming):
+            timing.dispatched(handle.provider_id, handle.provider_name)
+            return await trigger(
+                client,
+                handle,
+                golem._engine._api_config.app_key,
+                payload,
+                path_for,
+                timing=timing,
+                verbose=args.batch is None,
+            )
 
-            running = [r for r in i if r['state'] == 'running']
-            
-            print(f"""instances: {[f"{r['name']}: {r['state']}" for r in i]}""")
+        def attach(dispatcher: Dispatcher):
+            def on_removed(handle: ActivityHandle):
+                dispatcher.remove_instance(handle.service_id)
+                asyncio.create_task(client.close_activity(handle.id))
 
-            if len(running) > 0:             
+            def add(handle: ActivityHandle):
+                dispatcher.add_instance(handle.service_id, handle, pool=handle.service.model.name)
+
+            # Only instances which answered a warm-up request get prompts, and only for their model.
+            registry.add_listener(on_removed=on_removed)
+            readiness.add_listener(
+                on_ready=lambda health: add(health.handle),
+                on_unhealthy=lambda health: dispatcher.remove_instance(health.handle.service_id),
+            )
+            for handle in readiness.ready:
+                add(handle)
+
+        async def generate(coalescer: Coalescer, payload, path_for):
+            """`model` in payload picks the model from the catalog, it is not sent to the runtime."""
+            payload = dict(payload)
+            name = payload.pop('model', default_model.name)
+            model = catalog.get(name)
+            if model is None:
+                raise ValueError(f'Unknown model {name}')
+            result = await cache.get(payload, path_for, model.hash)
+            if result is None:
+                await ensure_cluster(model, args.model_instances)
+                result = await coalescer.submit(payload, path_for, pool=model.name)
+                await cache.put(payload, result, model.hash)
+            return result
+
+        async def prompt_to_file(coalescer: Coalescer, prompt, file_name):
+            try:
+                result = await generate(
+                    coalescer,
+                    {**DEFAULT_PARAMS, 'prompt': prompt},
+                    numbered_paths(Path(file_name)),
+                )
+                outputs = await postprocessor.process(
+                    [Path(path) for path in result['images']],
+                    json.dumps(result.get('parameters', {})),
+                )
+                if result.get('cached'):
+                    print('Served from cache')
+                for output in outputs:
+                    print(f"Saved response to {os.path.abspath(output['file'])} (sha256: {output['sha256']})")
+            except asyncio.CancelledError:
+                print(f'Request for {file_name} cancelled')
+            except asyncio.TimeoutError:
+                print(f'Request for {file_name} exceeded deadline of {args.deadline}s')
+            except Exception as e:
+                print(f'Request for {file_name} failed: {e}')
+
+        async def interactive(dispatcher: Dispatcher, coalescer: Coalescer):
+            while not dispatcher.workers:
+                await asyncio.sleep(1)
+
+            tasks = set()
+            for seq in itertools.count():
                 print('Please type your prompt:')
                 prompt = await ainput()
-                print('Sending to automatic')
-                await get_image(
-                    prompt,
-                    'output.png'
+                file_name = f'output-{seq}.png'
+                print(f'Queued as {file_name} (in flight: {dispatcher.in_flight}, queued: {dispatcher.queue_depth})')
+                task = asyncio.create_task(prompt_to_file(coalescer, prompt, file_name))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+        # Begin
+        postprocessor = PostProcessor(
+            PostProcessOptions(
+                image_format=args.image_format,
+                thumbnail_size=args.thumbnail_size,
+                embed_metadata=args.embed_metadata,
+            ),
+            workers=args.postprocess_workers,
+            mode=args.postprocess_mode,
+        )
+        cache = ResultCache(
+            Path(args.cache_dir),
+            default_model.hash,
+            args.cache_size * 1024 * 1024,
+            mode=args.cache_mode,
+        )
+        metrics = Metrics(args.runtime)
+        metrics.add_listener(reputation.record_request)
+        background = []
+        if args.metrics_port is not None:
+            metrics_server = await metrics.serve(args.metrics_host, args.metrics_port)
+            print(f'Metrics available at http://{args.metrics_host}:{args.metrics_port}/metrics')
+        if args.metrics_file is not None:
+            background.append(
+                asyncio.create_task(metrics.write_snapshots(Path(args.metrics_file), args.metrics_interval))
+            )
+        with postprocessor:
+            async with Dispatcher(
+                attempt_handler(get_image), max_per_instance=args.max_per_provider
+            ) as dispatcher:
+                attach(dispatcher)
+                await ensure_cluster(default_model, args.num_instances)
+                requester = ResilientRequester(
+                    dispatcher,
+                    RequestPolicy(
+                        attempts=args.attempts,
+                        deadline=args.deadline,
+                        hedge=args.hedge,
+                        hedge_quantile=args.hedge_quantile,
+                        hedge_delay=args.hedge_delay,
+                    ),
+                    metrics,
                 )
-            
-            await asyncio.sleep(3)
-        # End 
-        
+                # With every request cached, repeated prompts are served from disk and merged results
+                # would be cached under every prompt, so only the seeded cache and no cache batch prompts.
+                max_batch = args.max_batch
+                if max_batch > 1 and args.cache_mode == "use":
+                    print("--max-batch needs --cache-mode seeded or bypass, prompts are not batched")
+                    max_batch = 1
+                coalescer = Coalescer(requester.submit, CoalescingOptions(max_batch, args.max_batch_wait))
+                try:
+                    if args.batch is not None:
+                        runner = BatchRunner(
+                            functools.partial(generate, coalescer),
+                            Path(args.output_dir),
+                            postprocessor,
+                            concurrency=args.batch_concurrency,
+                        )
+                        with open_source(args.batch) as source:
+                            await runner.run(source)
+                    else:
+                        await interactive(dispatcher, coalescer)
+                finally:
+                    await coalescer.close()
+                    if coalescer.requests and args.max_batch > 1:
+                        print(f'Sent {coalescer.prompts} prompts in {coalescer.requests} requests')
+                    for scaler in scalers:
+                        await scaler.close()
+                    for task in background:
+                        task.cancel()
+                    if args.metrics_port is not None:
+                        await metrics_server.cleanup()
+                    print(f'Cache hits: {cache.hits}, misses: {cache.misses}')
+                    cache.close()
+                    reputation.flush()
+                    await readiness.close()
+        # End
+    # Payments for the last agreements are accepted during shutdown of Golem.
+    reputation.close()
+
+
 if __name__ == "__main__":
     parser = build_parser("Run AI runtime task")
     now = datetime.now().strftime("%Y-%m-%d_%H.%M.%S")
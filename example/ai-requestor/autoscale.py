@@ -0,0 +1,205 @@
+"""Growing and shrinking a service cluster with load, within the budget."""
+import asyncio
+import math
+import time
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import Dict, Hashable, List, Optional, Set, Union
+
+from yapapi import events
+from yapapi.services import Cluster, Service
+
+from dispatcher import Dispatcher, Worker
+from metrics import Metrics
+from readiness import ReadinessMonitor
+from state_feed import StateFeed
+
+DURATION_METRIC = "ai_request_duration_seconds"
+ALIVE_STATES = {"pending", "starting", "running"}
+
+
+@dataclass
+class ScalingOptions:
+    min_instances: int = 1
+    max_instances: int = 4
+
+    queue_per_instance: float = 2.0
+    """Queued prompts per instance above which the cluster grows."""
+
+    max_p95: Optional[float] = None
+    """Request duration p95 in seconds above which the cluster grows, while prompts are queued."""
+
+    idle_timeout: float = 120.0
+    """Instance without requests for this long is stopped, unless the cluster is at its minimum."""
+
+    up_cooldown: float = 30.0
+    """Time after any resize before the cluster grows again."""
+
+    down_cooldown: float = 120.0
+    """Time after any resize before the cluster shrinks again."""
+
+    interval: float = 5.0
+
+    budget: float = 50.0
+    budget_share: float = 0.9
+    """Share of `budget` spent after which no instances are added and idle ones are stopped
+    without waiting for `idle_timeout`."""
+
+
+class Spending:
+    """GLM accepted in debit notes and invoices during this run.
+
+    Register `consume` for `DebitNoteAccepted` and `InvoiceAccepted`. Debit notes
+    are cumulative, so the highest amount of every agreement is counted.
+    """
+
+    def __init__(self):
+        self._agreements: Dict[str, Decimal] = {}
+
+    def consume(self, event: Union[events.DebitNoteAccepted, events.InvoiceAccepted]):
+        amount = Decimal(event.amount)
+        if amount > self._agreements.get(event.agr_id, Decimal(0)):
+            self._agreements[event.agr_id] = amount
+
+    @property
+    def spent(self) -> float:
+        return float(sum(self._agreements.values(), Decimal(0)))
+
+
+def alive(cluster: Cluster, failing: Set[str] = frozenset()) -> List[Service]:
+    """Instances which are or will be running, failed starts about to be restarted included.
+
+    Instances with ids in `failing` are left out, they are being stopped.
+    """
+    return [
+        s for s in cluster.instances
+        if s.id not in failing
+        and (s.state.value in ALIVE_STATES or (s.state.value == "terminated" and s.restart_condition))
+    ]
+
+
+class Autoscaler:
+    """Resizes `cluster` every `interval` seconds from load of its instances in `dispatcher`.
+
+    The cluster grows when more than `queue_per_instance` prompts per instance wait
+    in the `pool` queue, or when p95 of request duration exceeds `max_p95` while
+    prompts are waiting. Instances still starting count as capacity, so warm-up of
+    new providers does not trigger more hires, but instances `readiness` found
+    failing do not. Ready instances idle for `idle_timeout` are stopped one at a
+    time. Nothing is hired once `budget_share` of the budget is spent.
+    """
+
+    def __init__(
+        self,
+        cluster: Cluster,
+        dispatcher: Dispatcher,
+        instance_params: Dict,
+        spending: Spending,
+        options: Optional[ScalingOptions] = None,
+        pool: Hashable = None,
+        metrics: Optional[Metrics] = None,
+        feed: Optional[StateFeed] = None,
+        readiness: Optional[ReadinessMonitor] = None,
+    ):
+        self.cluster = cluster
+        self.dispatcher = dispatcher
+        self.instance_params = instance_params
+        self.spending = spending
+        self.options = options or ScalingOptions()
+        self.pool = pool
+        self.metrics = metrics
+        self.feed = feed
+        self.readiness = readiness
+        self.resized_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def name(self) -> str:
+        return str(self.pool) if self.pool is not None else "cluster"
+
+    def _workers(self) -> List[Worker]:
+        return [w for w in self.dispatcher.workers if self.pool is None or w.pool == self.pool]
+
+    @property
+    def over_budget(self) -> bool:
+        return self.spending.spent >= self.options.budget * self.options.budget_share
+
+    def step(self, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        options = self.options
+        size = len(alive(self.cluster, self.readiness.failing if self.readiness else frozenset()))
+        queued = self.dispatcher.queued(self.pool)
+        since_resize = now - self.resized_at
+
+        if size < options.min_instances and not self.over_budget:
+            self._grow(options.min_instances - size, size, f"below minimum of {options.min_instances}", now)
+            return
+        if size < options.max_instances and since_resize >= options.up_cooldown and not self.over_budget:
+            if queued > options.queue_per_instance * size:
+                wanted = math.ceil(queued / options.queue_per_instance)
+                count = min(options.max_instances, wanted) - size
+                self._grow(max(count, 1), size, f"{queued} prompts queued", now)
+                return
+            p95 = self.metrics.quantile(DURATION_METRIC, 0.95) if self.metrics and options.max_p95 else None
+            if p95 is not None and p95 > options.max_p95 and queued > 0:
+                self._grow(1, size, f"p95 {p95:.1f}s with {queued} prompts queued", now)
+                return
+
+        if queued > 0 or size <= options.min_instances:
+            return
+        if self.over_budget:
+            idle_for = 0.0
+            reason = f"{self.spending.spent:.4g} of {options.budget} GLM budget spent"
+        elif since_resize >= options.down_cooldown:
+            idle_for = options.idle_timeout
+            reason = f"idle for {options.idle_timeout:.0f}s"
+        else:
+            return
+        idle = sorted(
+            (w for w in self._workers() if w.outstanding == 0 and now - w.last_active >= idle_for),
+            key=lambda w: w.last_active,
+        )
+        count = size - options.min_instances if self.over_budget else 1
+        if idle[:count]:
+            self._shrink(idle[:count], size, reason, now)
+
+    def _grow(self, count: int, size: int, reason: str, now: float):
+        print(f"[Autoscale {self.name}] {size} -> {size + count} instances: {reason}")
+        self.cluster.spawn_instances(instance_params=[self.instance_params] * count)
+        self._resized(size, size + count, reason, now)
+
+    def _shrink(self, workers: List[Worker], size: int, reason: str, now: float):
+        print(f"[Autoscale {self.name}] {size} -> {size - len(workers)} instances: {reason}")
+        for worker in workers:
+            # Stop routing right away, the instance takes a while to terminate.
+            self.dispatcher.remove_instance(worker.key)
+            self.cluster.stop_instance(worker.target.service)
+        self._resized(size, size - len(workers), reason, now)
+
+    def _resized(self, old: int, new: int, reason: str, now: float):
+        self.resized_at = now
+        if self.feed is not None:
+            self.feed.emit({
+                "ts": round(time.time(), 3),
+                "event": "scale",
+                "pool": self.name,
+                "old": old,
+                "new": new,
+                "reason": reason,
+            })
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.options.interval)
+            if not self.cluster.service_runner.stopped:
+                self.step()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
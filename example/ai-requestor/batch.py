@@ -0,0 +1,251 @@
+"""Offline batch mode: streams prompts from JSONL through dispatch -> post-process -> record."""
+import asyncio
+import json
+import re
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Set, TextIO, Union
+
+from postprocess import PostProcessor
+
+DEFAULT_PARAMS = {"steps": 250}
+ID_PATTERN = re.compile(r"[A-Za-z0-9_-][A-Za-z0-9._-]{0,127}")
+"""Item ids become file names in the output directory."""
+
+_DONE = object()
+
+
+@dataclass
+class BatchItem:
+    id: str
+    payload: dict
+    error: Optional[str] = None
+    """Why the input line was rejected, such items are only recorded as failed."""
+    started_at: float = 0.0
+    files: List[Path] = field(default_factory=list)
+    outputs: List[dict] = field(default_factory=list)
+
+
+@dataclass
+class BatchStats:
+    total: int = 0
+    skipped: int = 0
+    done: int = 0
+    failed: int = 0
+    images: int = 0
+    bytes: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+
+    def summary(self) -> str:
+        elapsed = time.monotonic() - self.started_at
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        return (
+            f"[Batch] read: {self.total}, resumed: {self.skipped}, done: {self.done}, "
+            f"failed: {self.failed}, images: {self.images}, "
+            f"{rate:.2f} prompts/s, {self.bytes / max(elapsed, 1e-9) / 1024:.1f} KiB/s"
+        )
+
+
+def parse_line(line: str, line_no: int) -> Optional[BatchItem]:
+    """Parse single input line.
+
+    A line is either a json object with txt2img parameters (`prompt` is required, `id`
+    is optional and defaults to the line number) or a plain text prompt. Raises
+    ValueError for lines which can't be run.
+    """
+    line = line.strip()
+    if not line:
+        return None
+    if line.startswith("{"):
+        params = json.loads(line)
+        if not isinstance(params, dict):
+            raise ValueError("line is not a json object")
+    else:
+        params = {"prompt": line}
+    item_id = str(params.pop("id", line_no))
+    if not ID_PATTERN.fullmatch(item_id):
+        raise ValueError(f"id {item_id!r} has to be at most 128 letters, digits, `.`, `_` or `-`")
+    prompt = params.get("prompt")
+    if not isinstance(prompt, str) or not prompt.strip():
+        raise ValueError("prompt has to be a non-empty string")
+    return BatchItem(item_id, {**DEFAULT_PARAMS, **params})
+
+
+def read_items(source: TextIO) -> Iterator[BatchItem]:
+    """Items of all non-empty lines, invalid ones with `error` set and the line number as id."""
+    for line_no, line in enumerate(source):
+        try:
+            item = parse_line(line, line_no)
+        except ValueError as e:  # json.JSONDecodeError included
+            item = BatchItem(str(line_no), {}, error=f"invalid input line {line_no}: {e}")
+        if item is not None:
+            yield item
+
+
+class Manifest:
+    """Append-only JSONL record of processed items, used to resume interrupted runs."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.completed: Set[str] = set()
+        if path.exists():
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line may be truncated if previous run was killed.
+                        continue
+                    if record.get("status") == "ok":
+                        self.completed.add(record["id"])
+        self._file = open(path, "a", buffering=1)
+
+    def append(self, record: Dict[str, Any]):
+        self._file.write(json.dumps(record) + "\n")
+        if record.get("status") == "ok":
+            self.completed.add(record["id"])
+
+    def close(self):
+        self._file.close()
+
+
+class BatchRunner:
+    """Bounded pipeline pushing batch items through the dispatcher.
+
+    At most `concurrency` items are waiting for inference at once. `submit` is
+    called with the payload and a `path_for(index)` callback and is expected to
+    stream images straight to these files. Post-processing and manifest stages are
+    connected by bounded queues, so memory stays flat no matter how large the
+    input is.
+    """
+
+    def __init__(
+        self,
+        submit: Callable[[dict, Callable[[int], Path]], Awaitable[dict]],
+        output_dir: Path,
+        postprocessor: PostProcessor,
+        concurrency: int = 16,
+        converters: int = 2,
+        progress_interval: float = 10.0,
+    ):
+        self._submit = submit
+        self.output_dir = output_dir
+        self.concurrency = concurrency
+        self.postprocessor = postprocessor
+        self.converters = converters
+        self.progress_interval = progress_interval
+        self.stats = BatchStats()
+
+    async def run(self, source: TextIO):
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        manifest = Manifest(self.output_dir / "manifest.jsonl")
+
+        process_queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency)
+        record_queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency)
+
+        converters = [
+            asyncio.create_task(self._postprocess(process_queue, record_queue, manifest))
+            for _ in range(self.converters)
+        ]
+        recorder = asyncio.create_task(self._record(record_queue, manifest))
+        progress = asyncio.create_task(self._report())
+        pending: Set[asyncio.Task] = set()
+
+        try:
+            await self._dispatch(source, process_queue, manifest, pending)
+            for _ in converters:
+                await process_queue.put(_DONE)
+            await asyncio.gather(*converters)
+            await record_queue.put(_DONE)
+            await recorder
+        finally:
+            tasks = [progress, *pending, *converters, recorder]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            manifest.close()
+            print(self.stats.summary())
+
+    async def _dispatch(
+        self, source: TextIO, process_queue: asyncio.Queue, manifest: Manifest, pending: Set[asyncio.Task]
+    ):
+        slots = asyncio.Semaphore(self.concurrency)
+
+        items = read_items(source)
+        while True:
+            # Reading from stdin may block, so don't do it on the event loop thread.
+            item = await asyncio.to_thread(next, items, None)
+            if item is None:
+                break
+            self.stats.total += 1
+            if item.error is not None:
+                self._fail(item, manifest, item.error)
+                continue
+            if item.id in manifest.completed:
+                self.stats.skipped += 1
+                continue
+
+            await slots.acquire()
+            task = asyncio.create_task(self._infer(item, process_queue, manifest))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            task.add_done_callback(lambda _: slots.release())
+
+        await asyncio.gather(*pending)
+
+    async def _infer(self, item: BatchItem, process_queue: asyncio.Queue, manifest: Manifest):
+        item.started_at = time.monotonic()
+        try:
+            result = await self._submit(item.payload, self._path_for(item))
+        except Exception as e:
+            self._fail(item, manifest, e)
+            return
+        item.files = [Path(f) for f in result.get("images", [])]
+        await process_queue.put(item)
+
+    def _path_for(self, item: BatchItem) -> Callable[[int], Path]:
+        return lambda index: self.output_dir / f"{item.id}-{index}.png"
+
+    async def _postprocess(
+        self, process_queue: asyncio.Queue, record_queue: asyncio.Queue, manifest: Manifest
+    ):
+        while (item := await process_queue.get()) is not _DONE:
+            try:
+                item.outputs = await self.postprocessor.process(item.files, json.dumps(item.payload))
+            except Exception as e:
+                self._fail(item, manifest, e)
+                continue
+            await record_queue.put(item)
+
+    async def _record(self, record_queue: asyncio.Queue, manifest: Manifest):
+        while (item := await record_queue.get()) is not _DONE:
+            size = sum(output["bytes"] for output in item.outputs)
+            manifest.append(
+                {
+                    "id": item.id,
+                    "status": "ok",
+                    "files": [Path(output["file"]).name for output in item.outputs],
+                    "sha256": [output["sha256"] for output in item.outputs],
+                    "bytes": size,
+                    "elapsed": round(time.monotonic() - item.started_at, 3),
+                    "prompt": item.payload.get("prompt"),
+                }
+            )
+            self.stats.done += 1
+            self.stats.images += len(item.outputs)
+            self.stats.bytes += size
+
+    def _fail(self, item: BatchItem, manifest: Manifest, error: Union[Exception, str]):
+        self.stats.failed += 1
+        manifest.append({"id": item.id, "status": "error", "error": str(error)})
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            print(self.stats.summary())
+
+
+def open_source(path: str) -> TextIO:
+    return sys.stdin if path == "-" else open(path, "r")
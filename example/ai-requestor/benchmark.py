@@ -0,0 +1,328 @@
+"""Offline benchmark of the requestor -> proxy-http -> runtime inference path.
+
+Everything runs locally: the async dummy server from `DummyAiHttpServer` plays
+the provider's runtime, a small stand-in of yagna's
+`/activity/{id}/proxy-http/{path}` endpoint forwards requests to it, and
+prompts are sent through the same dispatcher, retry and streaming decode code
+`ai_runtime.py` uses. For every combination of mode, image size and
+concurrency one JSON line with throughput, latency quantiles and memory usage
+is written to `--output`.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import aiohttp
+from aiohttp import web
+
+from dispatcher import Dispatcher
+from images import numbered_paths
+from metrics import Metrics, RequestTiming
+from proxy_client import ClientConfig, ProxyHttpClient, txt2img_to_files
+from registry import ActivityHandle
+from resilience import RequestPolicy, ResilientRequester, attempt_handler
+
+DUMMY_SERVER = Path(__file__).resolve().parent.parent / "DummyAiHttpServer" / "serve.py"
+APP_KEY = "benchmark-app-key"
+MODES = ["json", "sse"]
+
+
+def run_proxy(port: int, backend: str, activities: List[str]):
+    """Stand-in of yagna REST API serving only `proxy-http` of given activities."""
+
+    async def on_startup(app):
+        app["session"] = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0), timeout=aiohttp.ClientTimeout(total=None)
+        )
+
+    async def on_cleanup(app):
+        await app["session"].close()
+
+    async def proxy(request: web.Request):
+        if request.headers.get("Authorization") != f"Bearer {APP_KEY}":
+            return web.json_response({"message": "Unauthorized"}, status=401)
+        if request.match_info["activity_id"] not in activities:
+            return web.json_response({"message": "Activity not found"}, status=404)
+        headers = {
+            name: request.headers[name] for name in ("Content-Type", "Accept") if name in request.headers
+        }
+        async with request.app["session"].request(
+            request.method,
+            f"{backend}/{request.match_info['path']}",
+            data=await request.read(),
+            headers=headers,
+        ) as upstream:
+            response = web.StreamResponse(
+                status=upstream.status,
+                headers={"Content-Type": upstream.headers.get("Content-Type", "application/octet-stream")},
+            )
+            await response.prepare(request)
+            try:
+                async for chunk in upstream.content.iter_any():
+                    await response.write(chunk)
+                await response.write_eof()
+            except ConnectionResetError:
+                # Requestor gave up on the request, e.g. cancelled hedge.
+                pass
+            return response
+
+    app = web.Application(client_max_size=16 * 1024 * 1024)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_route("*", "/activity/{activity_id}/proxy-http/{path:.*}", proxy)
+    web.run_app(app, host="127.0.0.1", port=port, access_log=None, print=None)
+
+
+async def wait_for(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url) as response:
+                    await response.read()
+                    return
+            except aiohttp.ClientConnectionError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+
+def rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+class MemorySampler:
+    """Peak resident memory of this process during a run, sampled periodically."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.start = rss_bytes()
+        self.peak = self.start or 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _sample(self):
+        while True:
+            self.peak = max(self.peak, rss_bytes() or 0)
+            await asyncio.sleep(self.interval)
+
+    def __enter__(self) -> "MemorySampler":
+        self._task = asyncio.create_task(self._sample())
+        return self
+
+    def __exit__(self, *exc_info):
+        self._task.cancel()
+        self.peak = max(self.peak, rss_bytes() or 0)
+
+    def result(self) -> dict:
+        if self.start is None:
+            if resource is None:
+                return {}
+            # No procfs, fall back to peak of the whole process lifetime.
+            return {"rss_max_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+        return {
+            "rss_start_mb": round(self.start / 1e6, 1),
+            "rss_peak_mb": round(self.peak / 1e6, 1),
+        }
+
+
+def quantiles(values: List[float]) -> dict:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def at(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 6)
+
+    return {
+        "mean": round(sum(ordered) / len(ordered), 6),
+        "p50": at(0.5),
+        "p95": at(0.95),
+        "p99": at(0.99),
+        "max": round(ordered[-1], 6),
+    }
+
+
+async def run_case(handles, mode: str, size: str, concurrency: int, requests: int, output_dir: Path) -> dict:
+    width, height = (int(v) for v in size.split("x"))
+    payload = {"prompt": "benchmark", "width": width, "height": height, "steps": 20}
+    metrics = Metrics("benchmark")
+    timings: List[RequestTiming] = []
+    config = ClientConfig(max_concurrency=max(concurrency, 1), stream_progress=mode == "sse", request_timeout=None)
+
+    async with ProxyHttpClient(config) as client:
+
+        async def get_image(handle, payload, path_for, timing):
+            timing.dispatched(handle.provider_id, handle.provider_name)
+            timings.append(timing)
+            return await txt2img_to_files(client, handle, payload, path_for, timing=timing)
+
+        max_per_instance = -(-concurrency // len(handles))
+        async with Dispatcher(attempt_handler(get_image), max_per_instance=max_per_instance) as dispatcher:
+            for handle in handles:
+                dispatcher.add_instance(handle.service_id, handle)
+            requester = ResilientRequester(dispatcher, RequestPolicy(attempts=1), metrics)
+            semaphore = asyncio.Semaphore(concurrency)
+            errors = 0
+
+            async def one(index: int):
+                nonlocal errors
+                async with semaphore:
+                    try:
+                        result = await requester.submit(payload, numbered_paths(output_dir / f"{index}.png"))
+                    except Exception:
+                        errors += 1
+                        return
+                for image in result["images"]:
+                    Path(image).unlink()
+
+            with MemorySampler() as memory:
+                started = time.monotonic()
+                await asyncio.gather(*(one(i) for i in range(requests)))
+                duration = time.monotonic() - started
+
+    ok = [t for t in timings if t.status == "ok" and t.total is not None]
+    total_bytes = sum(t.bytes for t in ok)
+    return {
+        "mode": mode,
+        "size": size,
+        "concurrency": concurrency,
+        "activities": len(handles),
+        "requests": requests,
+        "ok": len(ok),
+        "errors": errors,
+        "duration": round(duration, 6),
+        "throughput_rps": round(len(ok) / duration, 3),
+        "throughput_mbps": round(total_bytes / duration / 1e6, 3),
+        "response_bytes": total_bytes // max(len(ok), 1),
+        "latency": quantiles([t.queue_wait + t.total for t in ok]),
+        "request": quantiles([t.total for t in ok]),
+        "ttfb": quantiles([t.ttfb for t in ok]),
+        "decode": quantiles([t.decode for t in ok]),
+        **memory.result(),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=Path(__file__).parent
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args):
+    activities = [f"benchmark-activity-{i}" for i in range(args.activities)]
+    handles = [
+        ActivityHandle(
+            SimpleNamespace(id=f"service-{i}", provider_id=f"provider-{i}", provider_name=f"provider-{i}"),
+            SimpleNamespace(id=activity),
+            f"http://127.0.0.1:{args.proxy_port}/activity/{activity}/proxy-http",
+            {"Authorization": f"Bearer {APP_KEY}"},
+        )
+        for i, activity in enumerate(activities)
+    ]
+
+    env = {
+        **os.environ,
+        "DUMMY_IMAGE": "synthetic",
+        "DUMMY_SIZES": ",".join(args.sizes),
+        "DUMMY_LATENCY": args.latency,
+        "DUMMY_GPU_SLOTS": str(max(args.concurrency)),
+        "DUMMY_QUEUE_SIZE": str(max(args.concurrency)),
+        "DUMMY_SEED": "0",
+    }
+    server = subprocess.Popen(
+        [
+            sys.executable, str(DUMMY_SERVER),
+            "--port", str(args.server_port),
+            "--workers", str(args.server_workers),
+            "--report-interval", "0",
+        ],
+        cwd=DUMMY_SERVER.parent,
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    backend = f"http://127.0.0.1:{args.server_port}"
+    proxy = multiprocessing.Process(target=run_proxy, args=(args.proxy_port, backend, activities), daemon=True)
+    proxy.start()
+    output_dir = Path(tempfile.mkdtemp(prefix="ai-benchmark-"))
+    meta = {
+        "benchmark": "proxy-http-txt2img",
+        "timestamp": time.time(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "server_workers": args.server_workers,
+        "server_latency": args.latency,
+    }
+    out = open(args.output, "a") if args.output != "-" else sys.stdout
+    try:
+        await wait_for(f"{backend}/stats")
+        await wait_for(f"http://127.0.0.1:{args.proxy_port}/activity/none/proxy-http/stats")
+        for mode in args.modes:
+            for size in args.sizes:
+                await run_case(handles, mode, size, 1, args.warmup, output_dir)
+                for concurrency in args.concurrency:
+                    result = await run_case(handles, mode, size, concurrency, args.requests, output_dir)
+                    out.write(json.dumps({**meta, **result}) + "\n")
+                    out.flush()
+                    print(
+                        f"{mode:>4} {size:>9} c={concurrency:<4} {result['throughput_rps']:8.1f} req/s "
+                        f"p50={result['latency'].get('p50')} p95={result['latency'].get('p95')} "
+                        f"p99={result['latency'].get('p99')} errors={result['errors']}",
+                        file=sys.stderr,
+                    )
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        proxy.terminate()
+        server.terminate()
+        server.wait()
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def csv(cast):
+    return lambda value: [cast(v) for v in value.split(",") if v]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=csv(int), default=[1, 8, 32, 128], help="default: 1,8,32,128")
+    parser.add_argument("--sizes", type=csv(str), default=["256x256", "512x512", "1024x1024"], help="Image sizes; default: 256x256,512x512,1024x1024")
+    parser.add_argument("--modes", type=csv(str), default=MODES, help="Response modes, json and/or sse; default: json,sse")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per case; default: %(default)s")
+    parser.add_argument("--warmup", type=int, default=5, help="Requests sent before each size and mode; default: %(default)s")
+    parser.add_argument("--activities", type=int, default=4, help="Simulated provider activities; default: %(default)s")
+    parser.add_argument("--latency", default="fixed:0.05", help="Runtime latency, see DummyAiHttpServer; default: %(default)s")
+    parser.add_argument("--server-workers", type=int, default=2, help="Dummy server worker processes; default: %(default)s")
+    parser.add_argument("--server-port", type=int, default=17861, help="default: %(default)s")
+    parser.add_argument("--proxy-port", type=int, default=17465, help="default: %(default)s")
+    parser.add_argument("--output", default="benchmark-results.jsonl", help="Results are appended here, `-` for stdout; default: %(default)s")
+    args = parser.parse_args()
+    for mode in args.modes:
+        if mode not in MODES:
+            parser.error(f"Unknown mode: {mode}")
+
+    asyncio.run(main(args))
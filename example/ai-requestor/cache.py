@@ -0,0 +1,182 @@
+"""Content-addressed local cache of generated images."""
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from postprocess import file_digest
+
+CACHE_MODES = ["use", "seeded", "bypass"]
+"""`use` caches every request, `seeded` only requests with fixed seed, `bypass` disables cache."""
+
+RANDOM_SEED = -1
+
+
+def model_hash(image_url: str) -> str:
+    """Extract `<algorithm>:<hash>` from `hash:<algorithm>:<hash>:<url>` model url."""
+    parts = image_url.split(":", 3)
+    if len(parts) >= 3 and parts[0] == "hash":
+        return f"{parts[1]}:{parts[2]}"
+    return image_url
+
+
+def cache_key(model: str, payload: dict) -> str:
+    canonical = json.dumps({"model": model, "payload": payload}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Maps (model, prompt, generation params, seed) to previously generated images.
+
+    Images are stored once under their sha256 in `objects/`, entries are kept in
+    a SQLite index and least recently used ones are evicted when total size of
+    stored objects exceeds `max_bytes`.
+    """
+
+    def __init__(self, directory: Path, model: str, max_bytes: int, mode: str = "use"):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode: {mode}")
+        self.directory = directory
+        self.model = model
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+
+        self._objects = directory / "objects"
+        self._objects.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(directory / "index.sqlite", check_same_thread=False)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                objects TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_last_used ON entries(last_used);
+            CREATE TABLE IF NOT EXISTS objects (
+                digest TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                refs INTEGER NOT NULL
+            );
+            """
+        )
+        self._lock = asyncio.Lock()
+
+    def cacheable(self, payload: dict) -> bool:
+        if self.mode == "bypass":
+            return False
+        if self.mode == "seeded":
+            return payload.get("seed", RANDOM_SEED) != RANDOM_SEED
+        return True
+
+    def _object_path(self, digest: str) -> Path:
+        return self._objects / digest[:2] / digest
+
+    @staticmethod
+    def _place(source: Path, target: Path):
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if target.exists():
+            target.unlink()
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+
+    def _lookup(self, key: str, path_for: Callable[[int], Path]) -> Optional[List[str]]:
+        row = self._db.execute("SELECT objects FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        files = []
+        for index, digest in enumerate(json.loads(row[0])):
+            source = self._object_path(digest)
+            if not source.exists():
+                # Object removed behind our back, treat the whole entry as a miss.
+                self._remove_entry(key)
+                return None
+            target = path_for(index)
+            self._place(source, target)
+            files.append(str(target))
+        with self._db:
+            self._db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+        return files
+
+    def _store(self, key: str, files: List[Path]):
+        digests = []
+        size = 0
+        with self._db:
+            for f in files:
+                digest = file_digest(f)
+                target = self._object_path(digest)
+                if not target.exists():
+                    self._place(f, target)
+                object_size = target.stat().st_size
+                self._db.execute(
+                    "INSERT INTO objects(digest, size, refs) VALUES (?, ?, 1) "
+                    "ON CONFLICT(digest) DO UPDATE SET refs = refs + 1",
+                    (digest, object_size),
+                )
+                digests.append(digest)
+                size += object_size
+            if self._db.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone():
+                self._remove_entry(key)
+            self._db.execute(
+                "INSERT INTO entries(key, objects, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(digests), size, time.time()),
+            )
+        self._evict()
+
+    def _remove_entry(self, key: str):
+        row = self._db.execute("SELECT objects FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return
+        with self._db:
+            self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            for digest in json.loads(row[0]):
+                self._db.execute("UPDATE objects SET refs = refs - 1 WHERE digest = ?", (digest,))
+            for (digest,) in self._db.execute("SELECT digest FROM objects WHERE refs <= 0").fetchall():
+                self._object_path(digest).unlink(missing_ok=True)
+                self._db.execute("DELETE FROM objects WHERE digest = ?", (digest,))
+
+    def _total_size(self) -> int:
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+
+    def _evict(self):
+        while self._total_size() > self.max_bytes:
+            row = self._db.execute("SELECT key FROM entries ORDER BY last_used LIMIT 1").fetchone()
+            if row is None:
+                break
+            self._remove_entry(row[0])
+
+    async def get(self, payload: dict, path_for: Callable[[int], Path], model: Optional[str] = None) -> Optional[dict]:
+        """Copy cached images to `path_for(index)` and return result like `txt2img_to_files`.
+
+        `model` overrides the model hash given to the constructor.
+        """
+        if not self.cacheable(payload):
+            return None
+        key = cache_key(model or self.model, payload)
+        async with self._lock:
+            files = await asyncio.to_thread(self._lookup, key, path_for)
+        if files is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {"images": files, "parameters": payload, "cached": True}
+
+    async def put(self, payload: dict, result: dict, model: Optional[str] = None):
+        if not self.cacheable(payload) or result.get("cached"):
+            return
+        key = cache_key(model or self.model, payload)
+        files = [Path(f) for f in result.get("images", [])]
+        async with self._lock:
+            await asyncio.to_thread(self._store, key, files)
+
+    def close(self):
+        self._db.close()
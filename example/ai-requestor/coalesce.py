@@ -0,0 +1,153 @@
+"""Merging repeated prompts into single batched txt2img requests."""
+import asyncio
+import json
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+RANDOM_SEED = -1
+PER_PROMPT = ("batch_size", "n_iter")
+"""Parameters which may differ between merged prompts."""
+
+Submit = Callable[[dict, Callable[[int], Path], Hashable], Awaitable[dict]]
+
+
+@dataclass
+class CoalescingOptions:
+    max_batch: int = 4
+    """Prompts merged into one request at most."""
+
+    max_wait: float = 0.25
+    """Time the first prompt of a batch waits for others."""
+
+
+def batch_key(payload: dict) -> Optional[str]:
+    """Key shared by prompts which can be merged, None if the payload can't be.
+
+    txt2img takes one prompt and one seed per request, so only requests for a
+    single image with equal prompt and parameters are merged, and only with a random
+    seed: a batch with a fixed seed would generate images for seed, seed + 1, ...
+    """
+    try:
+        if int(payload.get("batch_size", 1)) != 1 or int(payload.get("n_iter", 1)) != 1:
+            return None
+    except (TypeError, ValueError):
+        return None
+    if payload.get("seed", RANDOM_SEED) != RANDOM_SEED:
+        return None
+    shared = {k: v for k, v in payload.items() if k not in PER_PROMPT and k != "seed"}
+    return json.dumps(shared, sort_keys=True)
+
+
+def merge(payloads: List[dict]) -> dict:
+    """One txt2img payload generating an image for every payload.
+
+    Payloads have equal `batch_key`, so the first one is sent with `batch_size` of
+    all of them. Grid of all images is not returned, so `images` match prompts one to one.
+    """
+    first = payloads[0]
+    merged = {k: v for k, v in first.items() if k not in PER_PROMPT}
+    merged["batch_size"] = len(payloads)
+    merged["n_iter"] = 1
+    merged["override_settings"] = {**first.get("override_settings", {}), "return_grid": False}
+    return merged
+
+
+@dataclass
+class _Waiting:
+    payload: dict
+    path_for: Callable[[int], Path]
+    future: asyncio.Future
+
+
+@dataclass
+class _Batch:
+    items: List[_Waiting] = field(default_factory=list)
+    timer: Optional[asyncio.TimerHandle] = None
+
+
+class Coalescer:
+    """Holds prompts for up to `max_wait` and sends equal ones as one request.
+
+    `submit` has the signature of `ResilientRequester.submit`, which it wraps: retries,
+    hedges and deadline apply to the whole batch. Images of the batched request are
+    written straight to files of the prompts they belong to, and every caller gets
+    a result with its own image and its own parameters. Prompts which can't be
+    merged (see `batch_key`) are sent right away.
+    """
+
+    def __init__(self, submit: Submit, options: Optional[CoalescingOptions] = None):
+        self._submit = submit
+        self.options = options or CoalescingOptions()
+        self._batches: Dict[Tuple[Hashable, str], _Batch] = {}
+        self._tasks: set = set()
+        self.requests = 0
+        self.prompts = 0
+
+    async def submit(self, payload: dict, path_for: Callable[[int], Path], pool: Hashable = None) -> dict:
+        key = batch_key(payload)
+        if key is None or self.options.max_batch <= 1:
+            self.requests += 1
+            self.prompts += 1
+            return await self._submit(payload, path_for, pool)
+        batch_id = (pool, key)
+        batch = self._batches.get(batch_id)
+        if batch is None:
+            batch = self._batches[batch_id] = _Batch()
+            batch.timer = asyncio.get_running_loop().call_later(self.options.max_wait, self._flush, batch_id)
+        item = _Waiting(payload, path_for, asyncio.get_running_loop().create_future())
+        batch.items.append(item)
+        if len(batch.items) >= self.options.max_batch:
+            self._flush(batch_id)
+        return await item.future
+
+    def _flush(self, batch_id: Tuple[Hashable, str]):
+        batch = self._batches.pop(batch_id, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        task = asyncio.create_task(self._send(batch_id[0], [i for i in batch.items if not i.future.done()]))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, pool: Hashable, items: List[_Waiting]):
+        if not items:
+            return
+        self.requests += 1
+        self.prompts += len(items)
+        try:
+            if len(items) == 1:
+                result = await self._submit(items[0].payload, items[0].path_for, pool)
+                if not items[0].future.done():
+                    items[0].future.set_result(result)
+                return
+            result = await self._submit(
+                merge([i.payload for i in items]),
+                lambda index: items[index].path_for(0) if index < len(items) else items[-1].path_for(index),
+                pool,
+            )
+            images = result.get("images", [])
+            if len(images) != len(items):
+                raise RuntimeError(f"Batch of {len(items)} prompts returned {len(images)} images")
+        except Exception as e:
+            for item in items:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            return
+        parameters = result.get("parameters", {})
+        for item, image in zip(items, images):
+            if item.future.done():
+                # Caller gave up while the batch was running.
+                Path(image).unlink(missing_ok=True)
+                continue
+            item.future.set_result({
+                **result,
+                "images": [image],
+                "parameters": {**parameters, **item.payload},
+                "batch": len(items),
+            })
+
+    async def close(self):
+        for batch_id in list(self._batches):
+            self._flush(batch_id)
+        await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,194 @@
+"""Routing of requests across running service instances."""
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import AbstractSet, Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+
+@dataclass
+class Job:
+    args: tuple
+    future: asyncio.Future
+    exclude: AbstractSet[Hashable] = frozenset()
+    pool: Hashable = None
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class Worker:
+    key: Hashable
+    target: Any
+    limit: int
+    pool: Hashable = None
+    outstanding: int = 0
+    completed: int = 0
+    last_active: float = field(default_factory=time.monotonic)
+    """When the instance was added or last finished a job."""
+
+    @property
+    def free(self) -> bool:
+        return self.outstanding < self.limit
+
+
+class Dispatcher:
+    """Feeds queued jobs to registered instances using least-outstanding-requests routing.
+
+    `handler` is called as `handler(target, *job_args)` where `target` is the object
+    registered with `add_instance` (for example an activity handle). Every instance
+    can have at most `max_per_instance` jobs in flight; jobs wait in the queue until
+    some instance has a free slot. Cancelling future returned by `submit` cancels
+    the handler if it is already running.
+
+    Instances can be added to a `pool` (for example of the model they serve). Jobs
+    submitted to a pool go only to its instances and wait in the pool's own queue,
+    so a pool without instances does not hold up the others. Jobs submitted without
+    a pool go to any instance.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[..., Awaitable[Any]],
+        max_per_instance: int = 1,
+    ):
+        self._handler = handler
+        self._max_per_instance = max_per_instance
+        self._queues: Dict[Hashable, "asyncio.Queue[Job]"] = {}
+        self._workers: Dict[Hashable, Worker] = {}
+        self._changed = asyncio.Event()
+        self._tasks: set = set()
+        self._loop_tasks: Dict[Hashable, asyncio.Task] = {}
+        self._started = False
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    def queued(self, pool: Hashable = None) -> int:
+        """Jobs waiting in the queue of `pool`, in all queues if it is None."""
+        if pool is None:
+            return self.queue_depth
+        queue = self._queues.get(pool)
+        return queue.qsize() if queue is not None else 0
+
+    @property
+    def in_flight(self) -> int:
+        return sum(w.outstanding for w in self._workers.values())
+
+    @property
+    def workers(self) -> List[Worker]:
+        return list(self._workers.values())
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._workers
+
+    def add_instance(self, key: Hashable, target: Any, limit: Optional[int] = None, pool: Hashable = None):
+        if key in self._workers:
+            self._workers[key].target = target
+        else:
+            self._workers[key] = Worker(key, target, limit or self._max_per_instance, pool)
+        self._changed.set()
+
+    def remove_instance(self, key: Hashable):
+        """Stop routing to the instance. Jobs already sent to it are not cancelled."""
+        if self._workers.pop(key, None) is not None:
+            self._changed.set()
+
+    def _queue(self, pool: Hashable) -> "asyncio.Queue[Job]":
+        queue = self._queues.get(pool)
+        if queue is None:
+            queue = self._queues[pool] = asyncio.Queue()
+            if self._started:
+                self._loop_tasks[pool] = asyncio.create_task(self._run(pool, queue))
+        return queue
+
+    def submit(self, *args, exclude: AbstractSet[Hashable] = frozenset(), pool: Hashable = None) -> asyncio.Future:
+        """Enqueue a job and return future resolved with handler's result.
+
+        Instances with keys in `exclude` are used only if no other instance of the pool is registered.
+        """
+        job = Job(args, asyncio.get_running_loop().create_future(), exclude, pool)
+        self._queue(pool).put_nowait(job)
+        return job.future
+
+    def has_free_instance(self, exclude: AbstractSet[Hashable] = frozenset(), pool: Hashable = None) -> bool:
+        return any(w.free for w in self._in_pool(pool) if w.key not in exclude)
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            for pool, queue in self._queues.items():
+                self._loop_tasks[pool] = asyncio.create_task(self._run(pool, queue))
+
+    async def stop(self):
+        self._started = False
+        loop_tasks, self._loop_tasks = list(self._loop_tasks.values()), {}
+        for task in loop_tasks:
+            task.cancel()
+        await asyncio.gather(*loop_tasks, return_exceptions=True)
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for queue in self._queues.values():
+            while not queue.empty():
+                queue.get_nowait().future.cancel()
+
+    async def __aenter__(self) -> "Dispatcher":
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    def _in_pool(self, pool: Hashable) -> List[Worker]:
+        return [w for w in self._workers.values() if pool is None or w.pool == pool]
+
+    def _least_loaded(self, exclude: AbstractSet[Hashable], pool: Hashable) -> Optional[Worker]:
+        workers = self._in_pool(pool)
+        candidates = [w for w in workers if w.key not in exclude]
+        if not candidates:
+            candidates = workers
+        free = [w for w in candidates if w.free]
+        if not free:
+            return None
+        return min(free, key=lambda w: (w.outstanding / w.limit, w.outstanding))
+
+    async def _acquire(self, exclude: AbstractSet[Hashable], pool: Hashable) -> Worker:
+        worker = self._least_loaded(exclude, pool)
+        while worker is None:
+            self._changed.clear()
+            await self._changed.wait()
+            worker = self._least_loaded(exclude, pool)
+        worker.outstanding += 1
+        return worker
+
+    async def _run(self, pool: Hashable, queue: "asyncio.Queue[Job]"):
+        while True:
+            job = await queue.get()
+            if job.future.cancelled():
+                continue
+            worker = await self._acquire(job.exclude, pool)
+            if job.future.cancelled():
+                worker.outstanding -= 1
+                self._changed.set()
+                continue
+            task = asyncio.create_task(self._execute(worker, job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            job.future.add_done_callback(lambda f, task=task: task.cancel() if f.cancelled() else None)
+
+    async def _execute(self, worker: Worker, job: Job):
+        try:
+            result = await self._handler(worker.target, *job.args)
+            if not job.future.done():
+                job.future.set_result(result)
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            worker.outstanding -= 1
+            worker.completed += 1
+            worker.last_active = time.monotonic()
+            self._changed.set()
@@ -0,0 +1,175 @@
+"""Incremental decoding of txt2img responses straight to disk."""
+import binascii
+import json
+import os
+from pathlib import Path
+from typing import BinaryIO, Callable, List, Optional
+
+IMAGES_KEY = "images"
+
+_QUOTE = ord('"')
+_BACKSLASH = ord("\\")
+_WHITESPACE = b" \t\r\n"
+
+
+class StreamingImageDecoder:
+    """Parses txt2img json response chunk by chunk.
+
+    Base64 strings from the top level `images` array are decoded as they arrive and
+    written to files returned by `path_for(index)`, so a whole image is never held in
+    memory. Images are written to `.part` files which are renamed once complete.
+    Everything else in the response (`parameters`, `info`) is small and is
+    kept as text, with images replaced by `null`, so it can be loaded with `result()`.
+    """
+
+    def __init__(self, path_for: Callable[[int], Path]):
+        self._path_for = path_for
+        self.files: List[Path] = []
+        self.bytes_written = 0
+
+        self._rest = bytearray()
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string = bytearray()
+        self._last_key: Optional[bytes] = None
+        self._in_images = False
+
+        self._image: Optional[BinaryIO] = None
+        self._image_path: Optional[Path] = None
+        self._pending = b""
+        self._image_escape = False
+
+    def feed(self, chunk: bytes):
+        i = 0
+        n = len(chunk)
+        while i < n:
+            if self._image is not None:
+                i = self._feed_image(chunk, i)
+                continue
+
+            c = chunk[i]
+            i += 1
+            if self._in_string:
+                self._rest.append(c)
+                if self._escape:
+                    self._escape = False
+                elif c == _BACKSLASH:
+                    self._escape = True
+                elif c == _QUOTE:
+                    self._in_string = False
+                    self._string_finished()
+                else:
+                    self._string.append(c)
+                continue
+
+            if c == _QUOTE:
+                if self._in_images and self._depth == 2:
+                    self._start_image()
+                    continue
+                self._in_string = True
+                self._string.clear()
+            elif c in b"{[":
+                self._depth += 1
+                if c == ord("[") and self._depth == 2 and self._last_key == IMAGES_KEY.encode():
+                    self._in_images = True
+            elif c in b"}]":
+                if self._in_images and self._depth == 2:
+                    self._in_images = False
+                self._depth -= 1
+            elif c == ord(",") and self._depth == 1:
+                self._last_key = None
+            self._rest.append(c)
+
+    def _string_finished(self):
+        # Strings at depth 1 followed by `:` are keys. We only need to know if the
+        # value currently parsed belongs to `images`, so remembering the most recent
+        # depth 1 string is enough; it is reset on every `,` separating members.
+        if self._depth == 1 and self._last_key is None:
+            self._last_key = bytes(self._string)
+
+    def _start_image(self):
+        path = self._path_for(len(self.files))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._image_path = path
+        self._image = open(self._partial(path), "wb")
+        self._pending = b""
+        self._image_escape = False
+        self._rest += b"null"
+
+    def _feed_image(self, chunk: bytes, i: int) -> int:
+        end = chunk.find(b'"', i)
+        stop = len(chunk) if end < 0 else end
+        data = chunk[i:stop]
+        if self._image_escape or b"\\" in data:
+            data = self._unescape(data)
+        self._write_base64(data)
+        if end < 0:
+            return len(chunk)
+        if self._image_escape:
+            # Escaped quote can't appear in base64, so treat it as terminator anyway.
+            self._image_escape = False
+        self._finish_image()
+        return end + 1
+
+    def _unescape(self, data: bytes) -> bytes:
+        out = bytearray()
+        for c in data:
+            if self._image_escape:
+                # Only `\/` can legally appear inside base64 payload.
+                out.append(c)
+                self._image_escape = False
+            elif c == _BACKSLASH:
+                self._image_escape = True
+            else:
+                out.append(c)
+        return bytes(out)
+
+    def _write_base64(self, data: bytes):
+        data = self._pending + data.translate(None, _WHITESPACE)
+        usable = len(data) - len(data) % 4
+        self._pending = data[usable:]
+        if usable:
+            decoded = binascii.a2b_base64(data[:usable])
+            self._image.write(decoded)
+            self.bytes_written += len(decoded)
+
+    def _finish_image(self):
+        if self._pending:
+            decoded = binascii.a2b_base64(self._pending + b"=" * (-len(self._pending) % 4))
+            self._image.write(decoded)
+            self.bytes_written += len(decoded)
+            self._pending = b""
+        self._image.close()
+        self._image = None
+        os.replace(self._partial(self._image_path), self._image_path)
+        self.files.append(self._image_path)
+
+    @staticmethod
+    def _partial(path: Path) -> Path:
+        return path.with_name(f"{path.name}.part")
+
+    def close(self):
+        if self._image is not None:
+            self._image.close()
+            self._image = None
+            self._partial(self._image_path).unlink(missing_ok=True)
+
+    def result(self) -> dict:
+        """Response without image payloads; `images` contains paths of written files."""
+        result = json.loads(bytes(self._rest)) if self._rest else {}
+        if isinstance(result, dict):
+            result[IMAGES_KEY] = [str(path) for path in self.files]
+        return result
+
+
+def numbered_paths(output_file: Path) -> Callable[[int], Path]:
+    """First image goes to `output_file`, following ones get `-<index>` suffix."""
+
+    def path_for(index: int) -> Path:
+        if index == 0:
+            return output_file
+        return output_file.with_name(f"{output_file.stem}-{index}{output_file.suffix}")
+
+    return path_for
+
@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
+import argparse
 import asyncio
+import itertools
 import json
 import pathlib
+import re
 import sys
-from asyncio import TimeoutError
+import time
+from dataclasses import dataclass
 from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
+import aiohttp
+from ya_market import ApiException, RequestorApi, models  # type: ignore
 from yapapi import props as yp
 from yapapi.config import ApiConfig
 from yapapi.log import enable_default_logger
@@ -15,45 +22,299 @@ from yapapi.rest import Activity, Configuration, Market, Payment  # noqa
 examples_dir = pathlib.Path(__file__).resolve().parent.parent
 sys.path.append(str(examples_dir))
 import utils
+from offer_index import OfferEntry, OfferIndex
+from scoring import GAP_35
 
+COLLECT_BATCH = 100
+"""Offers fetched per market poll. yapapi's `Subscription.events()` fetches 10 and sleeps between empty polls."""
+
+FILTER_ALIASES = {
+    "runtime": "golem.runtime.name",
+    "name": "golem.node.id.name",
+    "gpu": f"{GAP_35}.model",
+    "vram": f"{GAP_35}.memory.total.gib",
+    "cuda-cores": f"{GAP_35}.cuda.cores",
+    "compute-capability": f"{GAP_35}.cuda.compute-capability",
+    "cpu-threads": "golem.inf.cpu.threads",
+    "mem": "golem.inf.mem.gib",
+    "storage": "golem.inf.storage.gib",
+}
+
+_FILTER = re.compile(r"^\s*([^<>=\s]+)\s*(>=|<=|=|>|<)\s*(.+?)\s*$")
+
+
+def filter_constraint(expression: str) -> str:
+    """Turn `vram>=16` or `gpu=*4090*` into demand constraint, e.g. `(golem.!exp.gap-35.v1.inf.gpu.memory.total.gib>=16)`.
+    Names other than aliases in `FILTER_ALIASES` are used as property names."""
+    match = _FILTER.match(expression)
+    if match is None or any(c in match.group(3) for c in "()"):
+        raise argparse.ArgumentTypeError(f"invalid filter `{expression}`, expected e.g. `vram>=16` or `gpu=*4090*`")
+    name, operator, value = match.groups()
+    return f"({FILTER_ALIASES.get(name, name)}{operator}{value})"
+
+SubscriptionKey = Tuple[Optional[str], str]
+"""Subnet and runtime of a subscription."""
+
+
+@dataclass
+class SubscriptionStats:
+    """Throughput of subscriptions for one subnet and runtime, summed over sweeps."""
+
+    subnet: Optional[str]
+    runtime: str
+    sweeps: int = 0
+    polls: int = 0
+    offers: int = 0
+    changes: int = 0
+    seconds: float = 0.0
+    errors: int = 0
+    last_error: Optional[str] = None
+
+    @property
+    def label(self) -> str:
+        return f"{self.subnet or '-'}/{self.runtime}"
+
+    @property
+    def offers_per_second(self) -> float:
+        return self.offers / self.seconds if self.seconds > 0 else 0.0
+
+    def describe(self) -> str:
+        errors = f", {self.errors} errors (last: {self.last_error})" if self.errors else ""
+        return (
+            f"{self.label}: {self.sweeps} sweeps, {self.polls} polls, {self.offers} offers "
+            f"({self.offers_per_second:.1f}/s), {self.changes} added or updated{errors}"
+        )
+
+
+def split_list(value: Optional[str]) -> List[Optional[str]]:
+    """Comma separated names. Missing value stands for the default of yapapi."""
+    if not value:
+        return [None]
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+
+def build_demand(subnet_tag: Optional[str], runtime: str, constraints: List[str]) -> DemandBuilder:
+    dbuild = DemandBuilder()
+    dbuild.add(yp.NodeInfo(name="some scanning node", subnet_tag=subnet_tag))
+    dbuild.add(yp.Activity(expiration=datetime.now(timezone.utc)))
+    dbuild.ensure(f"(golem.runtime.name={runtime})")
+    for constraint in constraints:
+        dbuild.ensure(constraint)
+    return dbuild
 
-async def list_offers(conf: Configuration, subnet_tag: str):
-    async with conf.market() as client:
-        market_api = Market(client)
-        dbuild = DemandBuilder()
-        dbuild.add(yp.NodeInfo(name="some scanning node", subnet_tag=subnet_tag))
-        dbuild.add(yp.Activity(expiration=datetime.now(timezone.utc)))
-        dbuild.ensure("(golem.runtime.name=automatic)")
 
+async def sweep(
+    market_api: Market, requestor_api: RequestorApi, dbuild: DemandBuilder, duration: float, stats: SubscriptionStats
+) -> AsyncIterator[models.Proposal]:
+    """Offers matching the demand, for `duration` seconds of a fresh subscription.
+
+    Market sends every currently matching offer to a new subscription, so
+    repeating sweeps observes offers that are still there and misses withdrawn ones.
+    `Subscription.events()` of yapapi polls without end, so offers are collected
+    with `requestor_api`, made from the same client as `market_api`.
+    """
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+    deadline = started + duration
+    stats.sweeps += 1
+    try:
         async with market_api.subscribe(dbuild.properties, dbuild.constraints) as subscription:
-            async for event in subscription.events():
-                print(f"Offer: {event.id}")
-                print(f"from {event.issuer}")
-                print(f"props {json.dumps(event.props, indent=4)}")
-                print("\n\n")
-        print("done")
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                events = await requestor_api.collect_offers(
+                    subscription.id, timeout=min(remaining, 5.0), max_events=COLLECT_BATCH
+                )
+                stats.polls += 1
+                for event in events:
+                    if isinstance(event, models.ProposalEvent):
+                        stats.offers += 1
+                        yield event.proposal
+    finally:
+        stats.seconds += loop.time() - started
+
+
+async def sweep_all(
+    market_api: Market, requestor_api: RequestorApi, demands: Dict[SubscriptionKey, DemandBuilder], duration: float,
+    stats: Dict[SubscriptionKey, SubscriptionStats],
+) -> AsyncIterator[Tuple[SubscriptionStats, models.Proposal]]:
+    """Sweep all subscriptions at once, yielding offers in order of arrival.
+
+    Subscriptions share connection pool of the market client. A failing subscription
+    is counted in its stats and does not stop the others.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def run(key, dbuild):
+        try:
+            async for proposal in sweep(market_api, requestor_api, dbuild, duration, stats[key]):
+                await queue.put((stats[key], proposal))
+        except (ApiException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            stats[key].errors += 1
+            stats[key].last_error = str(e).splitlines()[0] if str(e) else type(e).__name__
+        finally:
+            await queue.put((stats[key], None))
+
+    tasks = [asyncio.create_task(run(key, dbuild)) for key, dbuild in demands.items()]
+    running = len(tasks)
+    try:
+        while running:
+            subscription_stats, proposal = await queue.get()
+            if proposal is None:
+                running -= 1
+            else:
+                yield subscription_stats, proposal
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def build_demands(subnets, runtimes, constraints) -> Dict[SubscriptionKey, DemandBuilder]:
+    return {
+        (subnet, runtime): build_demand(subnet, runtime, list(constraints))
+        for subnet, runtime in itertools.product(subnets, runtimes)
+    }
+
+
+def print_stats(stats: Dict[SubscriptionKey, SubscriptionStats]):
+    for subscription_stats in stats.values():
+        sys.stderr.write(f"  {subscription_stats.describe()}\n")
+
+
+async def list_offers(conf: Configuration, subnet_tag: str, runtime: str = "automatic", constraints=(), duration=4.0):
+    """Print offers of every combination of comma separated subnets and runtimes, collected in parallel."""
+    index = OfferIndex()
+    demands = build_demands(split_list(subnet_tag), split_list(runtime), constraints)
+    stats = {key: SubscriptionStats(*key) for key in demands}
+    async with conf.market() as client:
+        market_api, requestor_api = Market(client), RequestorApi(client)
+        async for subscription_stats, proposal in sweep_all(market_api, requestor_api, demands, duration, stats):
+            op, entry = index.observe(proposal.proposal_id, proposal.issuer_id, proposal.properties)
+            if op is None:
+                continue
+            subscription_stats.changes += 1
+            print(f"Offer: {entry.offer_id}")
+            print(f"from {entry.issuer}")
+            print(f"props {json.dumps(entry.props, indent=4)}")
+            print("\n\n")
+    print("done")
+    if len(stats) > 1 or any(s.errors for s in stats.values()):
+        sys.stderr.write(f"Subscriptions ({len(index)} distinct offers):\n")
+        print_stats(stats)
+
+
+def emit(record: dict):
+    sys.stdout.write(json.dumps(record, separators=(",", ":")) + "\n")
+    sys.stdout.flush()
+
+
+async def watch(
+    conf: Configuration, args, index: OfferIndex, stats: Dict[SubscriptionKey, SubscriptionStats]
+):
+    """Sweep the market every `args.refresh` seconds, writing JSON lines with changes of the index."""
+    demands = build_demands(split_list(args.subnet_tag), split_list(args.runtime), args.filter)
+    async with conf.market() as client:
+        market_api, requestor_api = Market(client), RequestorApi(client)
+        while True:
+            started = time.time()
+            seen = changed = 0
+            async for subscription_stats, proposal in sweep_all(market_api, requestor_api, demands, args.sweep_time, stats):
+                seen += 1
+                op, entry = index.observe(proposal.proposal_id, proposal.issuer_id, proposal.properties, now=started)
+                if op is not None:
+                    changed += 1
+                    subscription_stats.changes += 1
+                    emit(entry.to_record(op, with_props=not args.no_props))
+            expired = index.expire(started - args.expire_after)
+            for entry in expired:
+                emit(entry.to_record("expire"))
+            sys.stderr.write(
+                f"Sweep: {seen} offers in {time.time() - started:.1f}s, {changed} added or updated, "
+                f"{len(expired)} expired, {len(index)} known\n"
+            )
+            if len(stats) > 1 or any(s.errors for s in stats.values()):
+                print_stats(stats)
+            await asyncio.sleep(max(0.0, started + args.refresh - time.time()))
+
+
+def print_summary(index: OfferIndex, stats: Dict[SubscriptionKey, SubscriptionStats]):
+    sys.stderr.write("Subscriptions:\n")
+    print_stats(stats)
+    sys.stderr.write(f"Known offers: {len(index)}\n")
+    for model, count in sorted(index.gpu_models().items(), key=lambda item: -item[1]):
+        sys.stderr.write(f"  {model}: {count}\n")
+    cheapest: List[OfferEntry] = index.cheapest(5)
+    if cheapest:
+        sys.stderr.write("Cheapest per image:\n")
+    for entry in cheapest:
+        sys.stderr.write(f"  {entry.name} ({entry.issuer}): {entry.gpu.model if entry.gpu else '-'}, {entry.cost_per_image:.3g} GLM\n")
 
 
 def main():
     parser = utils.build_parser("List offers")
+    parser.add_argument(
+        "--runtime",
+        default="automatic",
+        help="Runtime names, comma separated, e.g. `automatic,dummy`; default: %(default)s",
+    )
+    parser.add_argument(
+        "--filter",
+        action="append",
+        type=filter_constraint,
+        default=[],
+        help=f"Match only offers satisfying expression `name<op>value`, op is one of = >= <= > <, "
+        f"`*` is a wildcard in values; name is a property or one of: {', '.join(FILTER_ALIASES)}. Can be repeated",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Scan continuously, writing added, updated and expired offers as JSON lines",
+    )
+    parser.add_argument(
+        "--sweep-time",
+        type=float,
+        default=4.0,
+        help="Seconds to collect offers from one subscription; default: %(default)s",
+    )
+    parser.add_argument(
+        "--refresh",
+        type=float,
+        default=60.0,
+        help="With --watch, seconds between starts of sweeps; default: %(default)s",
+    )
+    parser.add_argument(
+        "--expire-after",
+        type=float,
+        default=180.0,
+        help="With --watch, drop offers not seen for this many seconds; default: %(default)s",
+    )
+    parser.add_argument("--no-props", action="store_true", help="With --watch, omit offer properties from output")
     args = parser.parse_args()
 
+    # Like `--runtime`, `--subnet-tag` may list several subnets separated with commas.
     subnet = args.subnet_tag
     sys.stderr.write(f"Using subnet: {utils.TEXT_COLOR_YELLOW}{subnet}{utils.TEXT_COLOR_DEFAULT}\n")
 
     enable_default_logger()
-    try:
+    conf = Configuration(api_config=ApiConfig())  # YAGNA_APPKEY will be loaded from env
+    if not args.watch:
         asyncio.get_event_loop().run_until_complete(
-            asyncio.wait_for(
-                list_offers(
-                    Configuration(api_config=ApiConfig()),  # YAGNA_APPKEY will be loaded from env
-                    subnet_tag=subnet,
-                ),
-                timeout=4,
-            )
+            list_offers(conf, subnet_tag=subnet, runtime=args.runtime, constraints=args.filter, duration=args.sweep_time)
         )
-    except TimeoutError:
+        return
+
+    index = OfferIndex()
+    stats = {
+        key: SubscriptionStats(*key) for key in itertools.product(split_list(args.subnet_tag), split_list(args.runtime))
+    }
+    try:
+        asyncio.get_event_loop().run_until_complete(watch(conf, args, index, stats))
+    except KeyboardInterrupt:
         pass
+    finally:
+        print_summary(index, stats)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,209 @@
+"""Per-request timing and its aggregation into Prometheus-style histograms."""
+import asyncio
+import bisect
+import json
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+SIZE_BUCKETS = (16e3, 64e3, 256e3, 1e6, 4e6, 16e6, 64e6)
+RECENT_WINDOW = 512
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+@dataclass
+class RequestTiming:
+    """Timings of a single prompt, filled in by consecutive stages of the pipeline."""
+
+    created_at: float = field(default_factory=time.monotonic)
+    provider_id: str = ""
+    provider_name: str = ""
+    queue_wait: Optional[float] = None
+    """From submitting the prompt to sending request to yagna."""
+    ttfb: Optional[float] = None
+    """From sending request to receiving response headers through proxy-http."""
+    first_event: Optional[float] = None
+    """From sending request to the first progress event, if runtime streams them."""
+    total: Optional[float] = None
+    """From sending request to receiving the last byte of the response."""
+    decode: float = 0.0
+    """Time spent decoding base64 payload and writing images to disk."""
+    bytes: int = 0
+    status: str = "ok"
+    work: float = 1.0
+    """Size of the request in reference images, see `scoring.reference_images`."""
+
+    def dispatched(self, provider_id: Optional[str], provider_name: Optional[str]):
+        self.provider_id = provider_id or ""
+        self.provider_name = provider_name or ""
+        self.queue_wait = time.monotonic() - self.created_at
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent: Deque[float] = deque(maxlen=RECENT_WINDOW)
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Quantile over the most recent observations."""
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Metrics:
+    """Collects `RequestTiming`s tagged by provider and runtime.
+
+    Aggregates can be scraped in Prometheus text format from `serve()` endpoint or
+    dumped periodically to a json file with `write_snapshots()`.
+    """
+
+    def __init__(self, runtime: str):
+        self.runtime = runtime
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._listeners: List[Callable[[RequestTiming], None]] = []
+
+    def add_listener(self, listener: Callable[[RequestTiming], None]):
+        """Call `listener` with every recorded timing."""
+        self._listeners.append(listener)
+
+    def _labels(self, timing: RequestTiming) -> Labels:
+        return (
+            ("provider_id", timing.provider_id),
+            ("provider_name", timing.provider_name),
+            ("runtime", self.runtime),
+        )
+
+    def observe(self, name: str, value: float, labels: Labels, buckets=LATENCY_BUCKETS):
+        series = self._histograms.setdefault(name, {})
+        histogram = series.get(labels)
+        if histogram is None:
+            histogram = series[labels] = Histogram(buckets)
+        histogram.observe(value)
+
+    def increment(self, name: str, labels: Labels, value: float = 1):
+        series = self._counters.setdefault(name, {})
+        series[labels] = series.get(labels, 0) + value
+
+    def record(self, timing: RequestTiming):
+        for listener in self._listeners:
+            listener(timing)
+        labels = self._labels(timing)
+        self.increment("ai_requests_total", labels + (("status", timing.status),))
+        if timing.queue_wait is not None:
+            self.observe("ai_request_queue_wait_seconds", timing.queue_wait, labels)
+        if timing.status != "ok":
+            return
+        if timing.ttfb is not None:
+            self.observe("ai_request_ttfb_seconds", timing.ttfb, labels)
+        if timing.first_event is not None:
+            self.observe("ai_request_first_event_seconds", timing.first_event, labels)
+        if timing.total is not None:
+            self.observe("ai_request_duration_seconds", timing.total, labels)
+        self.observe("ai_request_decode_seconds", timing.decode, labels)
+        self.observe("ai_response_bytes", timing.bytes, labels, SIZE_BUCKETS)
+
+    def quantile(self, name: str, q: float, provider_id: Optional[str] = None) -> Optional[float]:
+        """Quantile of recent observations, for a single provider or across all of them."""
+        values: List[float] = []
+        for labels, histogram in self._histograms.get(name, {}).items():
+            if provider_id is None or dict(labels).get("provider_id") == provider_id:
+                values.extend(histogram.recent)
+        if not values:
+            return None
+        values.sort()
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def count(self, name: str) -> int:
+        return sum(h.count for h in self._histograms.get(name, {}).values())
+
+    def snapshot(self) -> dict:
+        return {
+            "timestamp": time.time(),
+            "runtime": self.runtime,
+            "counters": {
+                name: [{"labels": dict(labels), "value": value} for labels, value in series.items()]
+                for name, series in self._counters.items()
+            },
+            "histograms": {
+                name: [{"labels": dict(labels), **h.snapshot()} for labels, h in series.items()]
+                for name, series in self._histograms.items()
+            },
+        }
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for name, series in self._counters.items():
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in series.items():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        for name, series in self._histograms.items():
+            lines.append(f"# TYPE {name} histogram")
+            for labels, h in series.items():
+                cumulative = 0
+                for bound, count in zip(h.buckets + (float("inf"),), h.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {h.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host: str, port: int) -> web.AppRunner:
+        """Expose `/metrics` (Prometheus text format) and `/metrics.json`."""
+
+        async def prometheus(_request):
+            return web.Response(text=self.render_prometheus(), content_type="text/plain")
+
+        async def snapshot(_request):
+            return web.json_response(self.snapshot())
+
+        app = web.Application()
+        app.router.add_get("/metrics", prometheus)
+        app.router.add_get("/metrics.json", snapshot)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+    async def write_snapshots(self, path: Path, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            with open(path, "a") as f:
+                f.write(json.dumps(self.snapshot()) + "\n")
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+
+    def escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
@@ -0,0 +1,190 @@
+"""In-memory index of market offers, deduplicated by provider and runtime."""
+import bisect
+import hashlib
+import json
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from scoring import GpuInfo, OfferScorer
+
+OfferKey = Tuple[str, str]
+"""Issuer and runtime name. Providers offer every runtime separately."""
+
+
+def fingerprint(props: Dict) -> str:
+    return hashlib.sha1(json.dumps(props, sort_keys=True).encode()).hexdigest()
+
+
+@dataclass
+class OfferEntry:
+    issuer: str
+    runtime: str
+    offer_id: str
+    props: Dict
+    fingerprint: str
+    gpu: Optional[GpuInfo]
+    cost_per_image: Optional[float]
+    first_seen: float
+    last_seen: float
+
+    @property
+    def key(self) -> OfferKey:
+        return self.issuer, self.runtime
+
+    @property
+    def name(self) -> str:
+        return self.props.get("golem.node.id.name", "")
+
+    @property
+    def subnet(self) -> Optional[str]:
+        return self.props.get("golem.node.debug.subnet")
+
+    def to_record(self, op: str, with_props: bool = True) -> Dict:
+        record = {
+            "ts": round(time.time(), 3),
+            "op": op,
+            "issuer": self.issuer,
+            "name": self.name,
+            "subnet": self.subnet,
+            "runtime": self.runtime,
+            "offer_id": self.offer_id,
+        }
+        if op != "expire":
+            record.update(
+                gpu=self.gpu.model if self.gpu is not None else None,
+                vram_gib=self.gpu.memory_gib if self.gpu is not None else None,
+                cost_per_image=self.cost_per_image,
+            )
+            if with_props:
+                record["props"] = self.props
+        return record
+
+
+class _SortedKeys:
+    """Keys ordered by a numeric value, for range queries."""
+
+    def __init__(self):
+        self._items: List[Tuple[float, OfferKey]] = []
+
+    def add(self, value: Optional[float], key: OfferKey):
+        if value is not None:
+            bisect.insort(self._items, (value, key))
+
+    def remove(self, value: Optional[float], key: OfferKey):
+        if value is None:
+            return
+        i = bisect.bisect_left(self._items, (value, key))
+        if i < len(self._items) and self._items[i] == (value, key):
+            del self._items[i]
+
+    def at_least(self, value: float) -> Iterator[OfferKey]:
+        for _, key in self._items[bisect.bisect_left(self._items, (value,)):]:
+            yield key
+
+    def __iter__(self) -> Iterator[OfferKey]:
+        return (key for _, key in self._items)
+
+
+class OfferIndex:
+    """Latest offer of every provider and runtime, indexed by issuer, GPU model, VRAM and price.
+
+    `observe` tells whether an offer is new (`"add"`), changed its properties
+    (`"update"`) or is a repeat of a known one (`None`), so callers can emit
+    only differences. Offers not observed for a while are dropped by `expire`.
+    Price is expected GLM per image, as estimated by `OfferScorer`.
+    """
+
+    def __init__(self, scorer: Optional[OfferScorer] = None):
+        self.scorer = scorer or OfferScorer()
+        self._entries: Dict[OfferKey, OfferEntry] = {}
+        self._by_issuer: Dict[str, Set[OfferKey]] = {}
+        self._by_gpu: Dict[str, Set[OfferKey]] = {}
+        self._by_vram = _SortedKeys()
+        self._by_price = _SortedKeys()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[OfferEntry]:
+        return iter(self._entries.values())
+
+    def get(self, issuer: str, runtime: str) -> Optional[OfferEntry]:
+        return self._entries.get((issuer, runtime))
+
+    def observe(self, offer_id: str, issuer: str, props: Dict, now: Optional[float] = None) -> Tuple[Optional[str], OfferEntry]:
+        now = time.time() if now is None else now
+        key = (issuer, props.get("golem.runtime.name", ""))
+        digest = fingerprint(props)
+        entry = self._entries.get(key)
+        if entry is not None and entry.fingerprint == digest:
+            entry.offer_id = offer_id
+            entry.last_seen = now
+            return None, entry
+        estimate = self.scorer.estimate(props)
+        new = OfferEntry(
+            issuer=issuer,
+            runtime=key[1],
+            offer_id=offer_id,
+            props=props,
+            fingerprint=digest,
+            gpu=estimate.gpu,
+            cost_per_image=estimate.cost_per_image,
+            first_seen=entry.first_seen if entry is not None else now,
+            last_seen=now,
+        )
+        if entry is not None:
+            self._unindex(entry)
+        self._entries[key] = new
+        self._by_issuer.setdefault(issuer, set()).add(key)
+        if new.gpu is not None:
+            self._by_gpu.setdefault(new.gpu.model, set()).add(key)
+            self._by_vram.add(new.gpu.memory_gib, key)
+        self._by_price.add(new.cost_per_image, key)
+        return ("add" if entry is None else "update"), new
+
+    def _unindex(self, entry: OfferEntry):
+        key = entry.key
+        issuer_keys = self._by_issuer.get(entry.issuer, set())
+        issuer_keys.discard(key)
+        if not issuer_keys:
+            self._by_issuer.pop(entry.issuer, None)
+        if entry.gpu is not None:
+            gpu_keys = self._by_gpu.get(entry.gpu.model, set())
+            gpu_keys.discard(key)
+            if not gpu_keys:
+                self._by_gpu.pop(entry.gpu.model, None)
+            self._by_vram.remove(entry.gpu.memory_gib, key)
+        self._by_price.remove(entry.cost_per_image, key)
+
+    def expire(self, seen_before: float) -> List[OfferEntry]:
+        """Remove and return offers last observed before `seen_before`."""
+        expired = [entry for entry in self._entries.values() if entry.last_seen < seen_before]
+        for entry in expired:
+            self._unindex(entry)
+            del self._entries[entry.key]
+        return expired
+
+    def by_issuer(self, issuer: str) -> List[OfferEntry]:
+        return [self._entries[key] for key in self._by_issuer.get(issuer, ())]
+
+    def by_gpu(self, model: str) -> List[OfferEntry]:
+        return [self._entries[key] for key in self._by_gpu.get(model, ())]
+
+    def gpu_models(self) -> Dict[str, int]:
+        return {model: len(keys) for model, keys in self._by_gpu.items()}
+
+    def with_vram(self, min_gib: float) -> List[OfferEntry]:
+        return [self._entries[key] for key in self._by_vram.at_least(min_gib)]
+
+    def cheapest(self, count: int, min_vram_gib: float = 0.0) -> List[OfferEntry]:
+        """Offers with the lowest expected cost per image. Offers without price are not included."""
+        result = []
+        for key in self._by_price:
+            entry = self._entries[key]
+            if min_vram_gib > 0 and (entry.gpu is None or entry.gpu.memory_gib < min_vram_gib):
+                continue
+            result.append(entry)
+            if len(result) >= count:
+                break
+        return result
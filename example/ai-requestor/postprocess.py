@@ -0,0 +1,136 @@
+"""Image post-processing executed outside of the event loop thread."""
+import asyncio
+import hashlib
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+@dataclass
+class PostProcessOptions:
+    image_format: str = "png"
+    """Target format: `png`, `webp` or `jpeg`. Png is what automatic returns, so it needs no re-encoding."""
+
+    quality: int = 90
+    """Quality used for lossy formats."""
+
+    thumbnail_size: Optional[int] = None
+    """If set, thumbnail fitting into square of this size is saved next to the image."""
+
+    embed_metadata: bool = False
+    """Store prompt and generation parameters inside the image file."""
+
+    @property
+    def reencode(self) -> bool:
+        return self.image_format != "png" or self.embed_metadata
+
+
+def normalize_format(image_format: str) -> str:
+    image_format = image_format.lower()
+    return "jpeg" if image_format == "jpg" else image_format
+
+
+def file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _save_with_metadata(image, target: Path, options: PostProcessOptions, description: Optional[str]):
+    from PIL import PngImagePlugin
+
+    image_format = normalize_format(options.image_format)
+    kwargs = {}
+    if image_format == "png":
+        if description is not None:
+            info = PngImagePlugin.PngInfo()
+            # Same key automatic uses for generation parameters.
+            info.add_text("parameters", description)
+            kwargs["pnginfo"] = info
+    else:
+        kwargs["quality"] = options.quality
+        if description is not None:
+            exif = image.getexif()
+            exif[0x010E] = description  # ImageDescription
+            kwargs["exif"] = exif
+        if image_format == "jpeg" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+    # Write next to the target and rename, so files hard linked elsewhere (e.g. by
+    # the result cache) are never modified in place.
+    partial = target.with_name(f"{target.name}.part")
+    image.save(partial, format=image_format.upper(), **kwargs)
+    os.replace(partial, target)
+
+
+def process_image(path: str, options: PostProcessOptions, description: Optional[str] = None) -> dict:
+    """Convert, thumbnail and hash single image. Runs inside executor worker.
+
+    Returns dict describing produced files, suitable for storing in manifest.
+    """
+    source = Path(path)
+    target = source
+    thumbnail = None
+
+    if options.reencode or options.thumbnail_size:
+        from PIL import Image
+
+        with Image.open(source) as image:
+            image.load()
+            if options.reencode:
+                target = source.with_suffix(f".{normalize_format(options.image_format)}")
+                _save_with_metadata(image, target, options, description if options.embed_metadata else None)
+            if options.thumbnail_size:
+                thumbnail = source.with_name(f"{source.stem}.thumb.{target.suffix.lstrip('.')}")
+                image.thumbnail((options.thumbnail_size, options.thumbnail_size))
+                _save_with_metadata(image, thumbnail, options, None)
+        if target != source:
+            source.unlink()
+
+    return {
+        "file": str(target),
+        "thumbnail": str(thumbnail) if thumbnail else None,
+        "sha256": file_digest(target),
+        "bytes": target.stat().st_size,
+    }
+
+
+class PostProcessor:
+    """Runs `process_image` on a thread or process pool.
+
+    Process pool keeps CPU heavy encoding away from the GIL, so neither yagna API
+    traffic nor streaming of other responses is delayed by it.
+    """
+
+    def __init__(self, options: PostProcessOptions, workers: Optional[int] = None, mode: str = "process"):
+        self.options = options
+        workers = workers or min(4, os.cpu_count() or 1)
+        if mode == "process":
+            self._executor: Executor = ProcessPoolExecutor(max_workers=workers)
+        elif mode == "thread":
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="postprocess")
+        else:
+            raise ValueError(f"Unknown post-processing mode: {mode}")
+
+    async def process(self, files: List[Path], description: Optional[str] = None) -> List[dict]:
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(
+            *(
+                loop.run_in_executor(self._executor, process_image, str(f), self.options, description)
+                for f in files
+            )
+        )
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self) -> "PostProcessor":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
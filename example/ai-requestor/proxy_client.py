@@ -0,0 +1,219 @@
+"""Asyncio client for AI runtimes exposed through yagna `proxy-http`."""
+import asyncio
+import json
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+import aiohttp
+
+from images import StreamingImageDecoder
+from metrics import RequestTiming
+from registry import ActivityHandle
+from scoring import reference_images
+from sse import SseParser
+
+TXT2IMG_URL = "/sdapi/v1/txt2img"
+CHUNK_SIZE = 64 * 1024
+EVENT_STREAM = "text/event-stream"
+
+ProgressCallback = Callable[[str, Dict[str, Any]], None]
+
+
+class InferenceError(Exception):
+    """Runtime responded with an error status."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f"Error code: {status}, message: {message}")
+        self.status = status
+        self.message = message
+
+
+@dataclass
+class ClientConfig:
+    request_timeout: Optional[float] = 600.0
+    """Total time allowed for a single request, including inference. `None` disables the limit."""
+
+    connect_timeout: float = 30.0
+    """Time allowed for establishing connection to yagna."""
+
+    connections_per_activity: int = 4
+    """Size of keep-alive connection pool kept for each activity."""
+
+    max_concurrency: int = 32
+    """Upper bound on requests in flight across all activities."""
+
+    stream_progress: bool = True
+    """Ask runtime for `text/event-stream` progress events. Runtimes not supporting it respond with json."""
+
+    stall_timeout: Optional[float] = 60.0
+    """Fail streamed request if no event arrives for this long. `None` disables the check."""
+
+
+class ProxyHttpClient:
+    """Sends HTTP requests to providers' runtimes through yagna `proxy-http` endpoint.
+
+    Each activity gets its own `aiohttp` session, so connections to yagna are reused
+    between prompts sent to the same provider. Sessions are created lazily and should
+    be dropped with `close_activity` when the activity terminates.
+    """
+
+    def __init__(self, config: Optional[ClientConfig] = None):
+        self.config = config or ClientConfig()
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._semaphore = asyncio.Semaphore(self.config.max_concurrency)
+
+    def _session(self, handle: ActivityHandle) -> aiohttp.ClientSession:
+        session = self._sessions.get(handle.id)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.config.connections_per_activity)
+            session = aiohttp.ClientSession(connector=connector, headers=handle.headers)
+            self._sessions[handle.id] = session
+        return session
+
+    def _timeout(self, timeout: Optional[float]) -> aiohttp.ClientTimeout:
+        return aiohttp.ClientTimeout(
+            total=timeout if timeout is not None else self.config.request_timeout,
+            connect=self.config.connect_timeout,
+        )
+
+    @asynccontextmanager
+    async def post(
+        self,
+        handle: ActivityHandle,
+        path: str,
+        payload: dict,
+        timeout: Optional[float] = None,
+    ) -> AsyncIterator[aiohttp.ClientResponse]:
+        """Post json `payload` to `path` on provider's runtime and yield the response.
+
+        Response body is not read, so caller can either load it at once or consume it
+        as a stream.
+        """
+        async with self._semaphore:
+            session = self._session(handle)
+            headers = {"Accept": f"{EVENT_STREAM}, application/json"} if self.config.stream_progress else None
+            async with session.post(
+                handle.url + path,
+                json=payload,
+                headers=headers,
+                timeout=self._timeout(timeout),
+            ) as response:
+                yield response
+
+    async def close_activity(self, activity_id: str):
+        session = self._sessions.pop(activity_id, None)
+        if session is not None:
+            await session.close()
+
+    async def close(self):
+        sessions, self._sessions = self._sessions, {}
+        await asyncio.gather(*(s.close() for s in sessions.values()))
+
+    async def __aenter__(self) -> "ProxyHttpClient":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+async def txt2img(
+    client: ProxyHttpClient, handle: ActivityHandle, payload: dict, timeout: Optional[float] = None
+) -> dict:
+    """Run txt2img on provider's runtime and return decoded json response."""
+    async with client.post(handle, TXT2IMG_URL, payload, timeout) as response:
+        body = await response.read()
+        if not response.ok:
+            raise InferenceError(response.status, body.decode("utf-8", errors="replace"))
+        return json.loads(body)
+
+
+async def txt2img_to_files(
+    client: ProxyHttpClient,
+    handle: ActivityHandle,
+    payload: dict,
+    path_for: Callable[[int], Path],
+    timeout: Optional[float] = None,
+    timing: Optional[RequestTiming] = None,
+    on_progress: Optional[ProgressCallback] = None,
+) -> dict:
+    """Run txt2img and stream returned images to files given by `path_for(index)`.
+
+    Response body is never loaded into memory as a whole. Returned dict is the
+    runtime's response with `images` replaced by paths of written files.
+    If runtime responds with `text/event-stream`, `on_progress(event, data)` is
+    called for every progress and preview event before the final result.
+    If `timing` is given, time to first byte, total time, decoding time and size
+    of the response are recorded in it.
+    """
+    timing = timing or RequestTiming()
+    timing.work = reference_images(payload)
+    started = time.monotonic()
+    async with client.post(handle, TXT2IMG_URL, payload, timeout) as response:
+        timing.ttfb = time.monotonic() - started
+        if not response.ok:
+            body = await response.read()
+            raise InferenceError(response.status, body.decode("utf-8", errors="replace"))
+
+        decoder = StreamingImageDecoder(path_for)
+        try:
+            if response.content_type == EVENT_STREAM:
+                await _consume_events(client, response, decoder, started, timing, on_progress)
+            else:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    _decode(decoder, chunk, timing)
+        finally:
+            decoder.close()
+        timing.total = time.monotonic() - started
+        return decoder.result()
+
+
+def _decode(decoder: StreamingImageDecoder, chunk: bytes, timing: RequestTiming):
+    timing.bytes += len(chunk)
+    decode_started = time.monotonic()
+    decoder.feed(chunk)
+    timing.decode += time.monotonic() - decode_started
+
+
+async def _consume_events(
+    client: ProxyHttpClient,
+    response: aiohttp.ClientResponse,
+    decoder: StreamingImageDecoder,
+    started: float,
+    timing: RequestTiming,
+    on_progress: Optional[ProgressCallback],
+):
+    """Feed `result` event into `decoder`, reporting other events as they arrive."""
+    error: Optional[InferenceError] = None
+    finished = False
+
+    def on_event(name: str, data: str):
+        nonlocal error
+        if timing.first_event is None:
+            timing.first_event = time.monotonic() - started
+        message = json.loads(data)
+        if name == "error":
+            error = InferenceError(message.get("status", 500), message.get("error", data))
+        elif on_progress is not None:
+            on_progress(name, message)
+
+    def on_result_end():
+        nonlocal finished
+        finished = True
+
+    parser = SseParser(on_event, lambda chunk: _decode(decoder, chunk, timing), on_result_end)
+    while not finished and error is None:
+        # Progress events arrive every sampling step, so a silent stream means stalled provider.
+        chunk = await asyncio.wait_for(response.content.readany(), client.config.stall_timeout)
+        if not chunk:
+            break
+        parser.feed(chunk)
+
+    if error is not None:
+        raise error
+    if not finished:
+        raise InferenceError(502, "Event stream ended before result")
+    # Read the end of the stream, so the connection can be reused for next request.
+    await asyncio.wait_for(response.content.read(), client.config.stall_timeout)
@@ -0,0 +1,194 @@
+"""Readiness and liveness probes of AI runtimes behind yagna `proxy-http`."""
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional, Set
+
+import aiohttp
+
+from proxy_client import TXT2IMG_URL
+from registry import ActivityHandle
+
+WARM_UP_PAYLOAD = {"prompt": "warm-up", "steps": 1, "width": 64, "height": 64, "batch_size": 1, "n_iter": 1}
+"""Smallest txt2img request. It succeeds only once the model is downloaded and loaded."""
+LIVENESS_PATH = "/sdapi/v1/progress"
+
+
+@dataclass
+class ProbeOptions:
+    ready_timeout: float = 1800.0
+    """Time allowed from `running` to a successful warm-up request. Covers model download."""
+
+    ready_interval: float = 5.0
+    """Pause between warm-up attempts."""
+
+    liveness_interval: float = 30.0
+    """Pause between liveness probes of ready instances. 0 disables them."""
+
+    liveness_failures: int = 3
+    """Consecutive failed probes after which instance stops receiving requests."""
+
+    probe_timeout: float = 10.0
+    """Timeout of a liveness probe."""
+
+    warm_up_timeout: float = 300.0
+    """Timeout of a single warm-up request."""
+
+
+@dataclass
+class InstanceHealth:
+    handle: ActivityHandle
+    running_at: float
+    ready_at: Optional[float] = None
+    state: str = "warming"
+    """`warming`, `ready`, `unhealthy` or `failed` (not ready within `ready_timeout`)."""
+    failures: int = 0
+    last_error: Optional[str] = None
+
+    @property
+    def warm_up(self) -> Optional[float]:
+        """Seconds from `running` to the first successful warm-up request."""
+        return self.ready_at - self.running_at if self.ready_at is not None else None
+
+
+Listener = Callable[[InstanceHealth], None]
+
+
+class ReadinessMonitor:
+    """Lets instances receive requests only when their runtime answers.
+
+    `running` state means the runtime process started, not that it has loaded the
+    model. Every added instance gets warm-up requests until one succeeds, then
+    `on_ready` is called. Ready instances are probed every `liveness_interval`
+    with a cheap GET; any response below 500 counts as alive. After
+    `liveness_failures` failures in a row `on_unhealthy` is called, and `on_ready`
+    again once a probe succeeds. `on_failed` is called for instances not ready within
+    `ready_timeout`. Feed it with `ActivityRegistry` listeners:
+    `registry.add_listener(on_added=monitor.add, on_removed=monitor.remove)`.
+    """
+
+    def __init__(self, options: Optional[ProbeOptions] = None):
+        self.options = options or ProbeOptions()
+        self._on_ready: List[Listener] = []
+        self._on_unhealthy: List[Listener] = []
+        self._on_failed: List[Listener] = []
+        self._health: Dict[str, InstanceHealth] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _client(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=16))
+        return self._session
+
+    def add_listener(
+        self,
+        on_ready: Optional[Listener] = None,
+        on_unhealthy: Optional[Listener] = None,
+        on_failed: Optional[Listener] = None,
+    ):
+        if on_ready is not None:
+            self._on_ready.append(on_ready)
+        if on_unhealthy is not None:
+            self._on_unhealthy.append(on_unhealthy)
+        if on_failed is not None:
+            self._on_failed.append(on_failed)
+
+    def add(self, handle: ActivityHandle):
+        self.remove(handle)
+        health = self._health[handle.service_id] = InstanceHealth(handle, time.monotonic())
+        self._tasks[handle.service_id] = asyncio.create_task(self._watch(health))
+
+    def remove(self, handle: ActivityHandle):
+        self._health.pop(handle.service_id, None)
+        task = self._tasks.pop(handle.service_id, None)
+        if task is not None:
+            task.cancel()
+
+    def __iter__(self) -> Iterator[InstanceHealth]:
+        return iter(list(self._health.values()))
+
+    @property
+    def ready(self) -> List[ActivityHandle]:
+        return [h.handle for h in self._health.values() if h.state == "ready"]
+
+    @property
+    def failing(self) -> Set[str]:
+        """Ids of services which are unhealthy or were not ready within `ready_timeout`."""
+        return {service_id for service_id, h in self._health.items() if h.state in ("unhealthy", "failed")}
+
+    async def _warm_up(self, handle: ActivityHandle):
+        async with self._client().post(
+            handle.url + TXT2IMG_URL,
+            json=WARM_UP_PAYLOAD,
+            headers={**handle.headers, "Accept": "application/json"},
+            timeout=aiohttp.ClientTimeout(total=self.options.warm_up_timeout),
+        ) as response:
+            body = await response.read()
+            if not response.ok:
+                raise RuntimeError(f"{response.status}: {body[:200].decode('utf-8', errors='replace')}")
+
+    async def _probe(self, handle: ActivityHandle):
+        async with self._client().get(
+            handle.url + LIVENESS_PATH,
+            headers=handle.headers,
+            timeout=aiohttp.ClientTimeout(total=self.options.probe_timeout),
+        ) as response:
+            await response.read()
+            if response.status >= 500:
+                raise RuntimeError(f"{response.status}")
+
+    async def _watch(self, health: InstanceHealth):
+        options = self.options
+        deadline = health.running_at + options.ready_timeout
+        while True:
+            try:
+                await self._warm_up(health.handle)
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError) as e:
+                health.last_error = str(e) or type(e).__name__
+            if time.monotonic() >= deadline:
+                health.state = "failed"
+                print(
+                    f"{health.handle.provider_name} not ready in {options.ready_timeout:.0f}s, "
+                    f"not sending requests to it (last error: {health.last_error})"
+                )
+                for listener in self._on_failed:
+                    listener(health)
+                return
+            await asyncio.sleep(options.ready_interval)
+        health.ready_at = time.monotonic()
+        health.state = "ready"
+        print(f"{health.handle.provider_name} ready after {health.warm_up:.1f}s of warm-up")
+        for listener in self._on_ready:
+            listener(health)
+
+        if options.liveness_interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(options.liveness_interval)
+            try:
+                await self._probe(health.handle)
+            except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError) as e:
+                health.failures += 1
+                health.last_error = str(e) or type(e).__name__
+                if health.state == "ready" and health.failures >= options.liveness_failures:
+                    health.state = "unhealthy"
+                    print(f"{health.handle.provider_name} failed {health.failures} liveness probes: {health.last_error}")
+                    for listener in self._on_unhealthy:
+                        listener(health)
+                continue
+            health.failures = 0
+            if health.state == "unhealthy":
+                health.state = "ready"
+                print(f"{health.handle.provider_name} is alive again")
+                for listener in self._on_ready:
+                    listener(health)
+
+    async def close(self):
+        tasks, self._tasks = list(self._tasks.values()), {}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
@@ -0,0 +1,98 @@
+"""Registry of activities of running service instances."""
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional
+
+from yapapi import events
+from yapapi.rest.activity import Activity
+from yapapi.services import Service
+
+ROUTABLE_STATES = {"running"}
+
+
+def proxy_url(activity: Activity) -> str:
+    host = activity._api.api_client.configuration.host
+    return f"{host}/activity/{activity.id}/proxy-http"
+
+
+@dataclass
+class ActivityHandle:
+    """Everything needed to send request to a running instance, prepared once."""
+
+    service: Service
+    activity: Activity
+    url: str
+    headers: Dict[str, str]
+
+    @property
+    def id(self) -> str:
+        return self.activity.id
+
+    @property
+    def service_id(self) -> str:
+        return self.service.id
+
+    @property
+    def provider_id(self) -> Optional[str]:
+        return self.service.provider_id
+
+    @property
+    def provider_name(self) -> Optional[str]:
+        return self.service.provider_name
+
+
+Listener = Callable[[ActivityHandle], None]
+
+
+class ActivityRegistry:
+    """Keeps `ActivityHandle` for every running instance, keyed by service id.
+
+    Registry is driven by `ServiceStateChanged` events, so handles are created once
+    when an instance starts running and dropped as soon as it leaves that state.
+    Register it with `golem.add_event_consumer(registry.consume, [ServiceStateChanged])`.
+    """
+
+    def __init__(self, token: str):
+        self._headers = {"Authorization": f"Bearer {token}"}
+        self._handles: Dict[str, ActivityHandle] = {}
+        self._on_added: List[Listener] = []
+        self._on_removed: List[Listener] = []
+
+    def add_listener(self, on_added: Optional[Listener] = None, on_removed: Optional[Listener] = None):
+        if on_added is not None:
+            self._on_added.append(on_added)
+        if on_removed is not None:
+            self._on_removed.append(on_removed)
+
+    def consume(self, event: events.ServiceStateChanged):
+        if event.new.value in ROUTABLE_STATES:
+            self.add(event.service, event.activity)
+        else:
+            self.remove(event.service.id)
+
+    def add(self, service: Service, activity: Activity) -> ActivityHandle:
+        handle = self._handles.get(service.id)
+        if handle is not None and handle.activity.id == activity.id:
+            return handle
+        handle = ActivityHandle(service, activity, proxy_url(activity), self._headers)
+        self._handles[service.id] = handle
+        for listener in self._on_added:
+            listener(handle)
+        return handle
+
+    def remove(self, service_id: str):
+        handle = self._handles.pop(service_id, None)
+        if handle is not None:
+            for listener in self._on_removed:
+                listener(handle)
+
+    def get(self, service_id: str) -> Optional[ActivityHandle]:
+        return self._handles.get(service_id)
+
+    def __contains__(self, service_id: str) -> bool:
+        return service_id in self._handles
+
+    def __iter__(self) -> Iterator[ActivityHandle]:
+        return iter(list(self._handles.values()))
+
+    def __len__(self) -> int:
+        return len(self._handles)
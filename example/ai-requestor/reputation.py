@@ -0,0 +1,342 @@
+"""Durable per-provider track record: startup, request latency, errors, cost and deployed models."""
+import sqlite3
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from decimal import Decimal
+from pathlib import Path
+from typing import Deque, Dict, List, Optional, Tuple
+
+from yapapi import events
+
+from metrics import RequestTiming
+
+LATENCY_WINDOW = 100
+"""Number of most recent request durations kept per provider."""
+MIN_REQUESTS = 5
+"""Requests needed before measured latency and error rate are trusted."""
+FLUSH_EVERY = 50
+"""Writes are committed in batches, and always on `close()`."""
+COLD_DEPLOY_FACTOR = 3.0
+"""Deploy this many times slower than the usual one of the model on the provider counts as a new download."""
+
+
+@dataclass
+class ProviderRecord:
+    provider_id: str
+    name: str = ""
+    starts: int = 0
+    start_failures: int = 0
+    startup_seconds: float = 0.0
+    """Sum over successful starts, from `starting` to `running`."""
+    drops: int = 0
+    """Instances terminated with an error after they were running."""
+    requests: int = 0
+    errors: int = 0
+    paid: float = 0.0
+    last_seen: float = 0.0
+    latencies: Deque[float] = field(default_factory=lambda: deque(maxlen=LATENCY_WINDOW))
+    """Recent request durations per reference image (512x512 in 20 steps), see `scoring.reference_images`."""
+
+    @property
+    def start_failure_rate(self) -> float:
+        attempts = self.starts + self.start_failures
+        return self.start_failures / attempts if attempts else 0.0
+
+    @property
+    def error_rate(self) -> float:
+        return self.errors / self.requests if self.requests else 0.0
+
+    @property
+    def mean_startup(self) -> Optional[float]:
+        return self.startup_seconds / self.starts if self.starts else None
+
+    @property
+    def cost_per_request(self) -> Optional[float]:
+        ok = self.requests - self.errors
+        return self.paid / ok if ok > 0 and self.paid > 0 else None
+
+    def latency(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @property
+    def measured_seconds(self) -> Optional[float]:
+        """Median time per reference image, once there are enough requests to trust it.
+        Comparable with `OfferEstimate.seconds_per_image`."""
+        return self.latency(0.5) if len(self.latencies) >= MIN_REQUESTS else None
+
+    @property
+    def reliability(self) -> float:
+        """Chance that hiring the provider ends with a served request."""
+        error_rate = self.error_rate if self.requests >= MIN_REQUESTS else 0.0
+        return (1 - self.start_failure_rate) * (1 - error_rate)
+
+    def rejection(self, max_error_rate: float) -> Optional[str]:
+        """Reason to stop hiring the provider, None if the record is good enough."""
+        if self.requests >= MIN_REQUESTS and self.error_rate > max_error_rate:
+            return f"{self.error_rate:.0%} of {self.requests} requests failed"
+        if self.starts == 0 and self.start_failures >= 3:
+            return f"failed to start {self.start_failures} times"
+        return None
+
+    def describe(self) -> str:
+        p50, p95 = self.latency(0.5), self.latency(0.95)
+        latency = f"p50 {p50:.2f}s, p95 {p95:.2f}s per image" if p50 is not None else "no durations"
+        startup = f"{self.mean_startup:.1f}s" if self.mean_startup is not None else "-"
+        return (
+            f"{self.starts} starts ({self.start_failures} failed, mean {startup}), "
+            f"{self.requests} requests ({self.errors} failed, {latency})"
+        )
+
+
+@dataclass
+class ModelRecord:
+    """Deployments of one model on one provider.
+
+    The first deploy is counted as cold, the provider has to download the model.
+    Later deploys are counted as cold when they are much slower than the usual
+    warm one, as if the provider evicted the model from its cache.
+    """
+
+    provider_id: str
+    model: str
+    """Model hash, `<algorithm>:<hash>`."""
+    deploys: int = 0
+    cold_deploys: int = 0
+    cold_seconds: float = 0.0
+    warm_seconds: float = 0.0
+    """Sums over deploys, from `starting` to the first answered request."""
+    last_deploy: float = 0.0
+    last_cold: bool = False
+    """Whether the last deploy in this run was cold, not stored."""
+
+    @property
+    def mean_warm(self) -> Optional[float]:
+        warm = self.deploys - self.cold_deploys
+        return self.warm_seconds / warm if warm else None
+
+    def is_cold(self, seconds: float) -> bool:
+        mean_warm = self.mean_warm
+        return self.deploys == 0 or (mean_warm is not None and seconds > mean_warm * COLD_DEPLOY_FACTOR)
+
+
+class ReputationStore:
+    """Outcomes of past work with providers, kept in SQLite across runs.
+
+    Everything is loaded into memory when opened, so lookups from `score_offer`
+    are dictionary reads. Updates come from yapapi events (register `consume`
+    for `ServiceStateChanged`, `DebitNoteAccepted` and `InvoiceAccepted`) and
+    from finished requests (`record_request`). Deployed models are recorded with
+    `record_deploy` once an instance answers its first request.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS providers (
+                provider_id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                starts INTEGER NOT NULL,
+                start_failures INTEGER NOT NULL,
+                startup_seconds REAL NOT NULL,
+                drops INTEGER NOT NULL,
+                requests INTEGER NOT NULL,
+                errors INTEGER NOT NULL,
+                paid REAL NOT NULL,
+                last_seen REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS image_seconds (
+                provider_id TEXT NOT NULL,
+                ts REAL NOT NULL,
+                seconds REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS image_seconds_provider ON image_seconds(provider_id, ts);
+            CREATE TABLE IF NOT EXISTS models (
+                provider_id TEXT NOT NULL,
+                model TEXT NOT NULL,
+                deploys INTEGER NOT NULL,
+                cold_deploys INTEGER NOT NULL,
+                cold_seconds REAL NOT NULL,
+                warm_seconds REAL NOT NULL,
+                last_deploy REAL NOT NULL,
+                PRIMARY KEY (provider_id, model)
+            );
+            """
+        )
+        self._records: Dict[str, ProviderRecord] = {}
+        self._models: Dict[Tuple[str, str], ModelRecord] = {}
+        self._starting: Dict[str, float] = {}
+        self._startups: Dict[str, float] = {}
+        self._agreement_paid: Dict[str, Decimal] = {}
+        self._pending = 0
+        self._load()
+
+    def _load(self):
+        for row in self._db.execute(
+            "SELECT provider_id, name, starts, start_failures, startup_seconds, drops, requests, errors, paid, last_seen"
+            " FROM providers"
+        ):
+            self._records[row[0]] = ProviderRecord(*row)
+        for provider_id, seconds in self._db.execute(
+            "SELECT provider_id, seconds FROM image_seconds ORDER BY provider_id, ts"
+        ):
+            record = self._records.get(provider_id)
+            if record is not None:
+                record.latencies.append(seconds)
+        for row in self._db.execute(
+            "SELECT provider_id, model, deploys, cold_deploys, cold_seconds, warm_seconds, last_deploy FROM models"
+        ):
+            self._models[(row[0], row[1])] = ModelRecord(*row)
+        # Drop latencies that fell out of the window in previous runs.
+        self._db.execute(
+            """
+            DELETE FROM image_seconds WHERE rowid IN (
+                SELECT rowid FROM (
+                    SELECT rowid, ROW_NUMBER() OVER (PARTITION BY provider_id ORDER BY ts DESC) AS n
+                    FROM image_seconds
+                ) WHERE n > ?
+            )
+            """,
+            (LATENCY_WINDOW,),
+        )
+        self._db.commit()
+
+    def get(self, provider_id: str) -> Optional[ProviderRecord]:
+        return self._records.get(provider_id)
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def models(self, provider_id: str) -> List[ModelRecord]:
+        return [record for (provider, _), record in self._models.items() if provider == provider_id]
+
+    def has_model(self, provider_id: str, model: str) -> bool:
+        """Whether the provider deployed `model` (hash) for us before, so likely keeps it cached."""
+        record = self._models.get((provider_id, model))
+        return record is not None and record.deploys > 0
+
+    def _record(self, provider_id: str, name: Optional[str] = None) -> ProviderRecord:
+        record = self._records.get(provider_id)
+        if record is None:
+            record = self._records[provider_id] = ProviderRecord(provider_id)
+        if name:
+            record.name = name
+        record.last_seen = time.time()
+        return record
+
+    def _save(self, record: ProviderRecord):
+        self._db.execute(
+            "INSERT OR REPLACE INTO providers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                record.provider_id, record.name, record.starts, record.start_failures, record.startup_seconds,
+                record.drops, record.requests, record.errors, record.paid, record.last_seen,
+            ),
+        )
+        self._pending += 1
+        if self._pending >= FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        self._db.commit()
+        self._pending = 0
+
+    def consume(self, event: events.Event):
+        if isinstance(event, events.ServiceStateChanged):
+            self._on_state_changed(event)
+        elif isinstance(event, (events.DebitNoteAccepted, events.InvoiceAccepted)):
+            # Debit notes are cumulative and invoice carries the final amount of the agreement.
+            amount = Decimal(event.amount)
+            previous = self._agreement_paid.get(event.agr_id, Decimal(0))
+            if amount > previous:
+                self._agreement_paid[event.agr_id] = amount
+                record = self._record(event.provider_id)
+                record.paid += float(amount - previous)
+                self._save(record)
+
+    def _on_state_changed(self, event: events.ServiceStateChanged):
+        service = event.service
+        if service.provider_id is None:
+            return
+        old, new = event.old.value, event.new.value
+        if new == "starting":
+            self._starting[service.id] = time.monotonic()
+            return
+        started = self._starting.pop(service.id, None)
+        if new == "terminated":
+            self._startups.pop(service.id, None)
+        failed = service.exc_info != (None, None, None)
+        record = self._record(service.provider_id, service.provider_name)
+        if old == "starting" and new == "running":
+            record.starts += 1
+            if started is not None:
+                startup = time.monotonic() - started
+                record.startup_seconds += startup
+                self._startups[service.id] = startup
+        elif old == "starting" and failed:
+            record.start_failures += 1
+        elif new == "terminated" and failed:
+            record.drops += 1
+        else:
+            return
+        self._save(record)
+        self.flush()
+
+    def record_request(self, timing: RequestTiming):
+        """Metrics listener. Cancelled requests (lost hedges, deadline) and ones rejected as invalid
+        say nothing about the provider."""
+        if not timing.provider_id or timing.status in ("cancelled", "rejected"):
+            return
+        record = self._record(timing.provider_id, timing.provider_name)
+        record.requests += 1
+        if timing.status != "ok":
+            record.errors += 1
+        elif timing.total is not None:
+            # Requests differ in steps, size and batch, compare time per reference image.
+            seconds = timing.total / timing.work
+            record.latencies.append(seconds)
+            self._db.execute(
+                "INSERT INTO image_seconds VALUES (?, ?, ?)", (timing.provider_id, time.time(), seconds)
+            )
+        self._save(record)
+
+    def record_deploy(self, service_id: str, provider_id: str, model: str, warm_up: float) -> Optional[ModelRecord]:
+        """Record that instance `service_id` got ready with `model` (hash), `warm_up` seconds after `running`.
+
+        Deploy time also covers startup of the instance, during which the model is
+        downloaded. Returns None for instances already recorded.
+        """
+        startup = self._startups.pop(service_id, None)
+        if startup is None:
+            return None
+        seconds = startup + warm_up
+        record = self._models.get((provider_id, model))
+        if record is None:
+            record = self._models[(provider_id, model)] = ModelRecord(provider_id, model)
+        record.last_cold = record.is_cold(seconds)
+        if record.last_cold:
+            record.cold_deploys += 1
+            record.cold_seconds += seconds
+        else:
+            record.warm_seconds += seconds
+        record.deploys += 1
+        record.last_deploy = time.time()
+        self._db.execute(
+            "INSERT OR REPLACE INTO models VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                record.provider_id, record.model, record.deploys, record.cold_deploys,
+                record.cold_seconds, record.warm_seconds, record.last_deploy,
+            ),
+        )
+        self.flush()
+        return record
+
+    def close(self):
+        self.flush()
+        self._db.close()
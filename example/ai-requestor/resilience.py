@@ -0,0 +1,215 @@
+"""Deadlines, retries on other providers and hedged requests."""
+import asyncio
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set
+
+import aiohttp
+
+from dispatcher import Dispatcher
+from metrics import LATENCY_BUCKETS, Histogram, Metrics, RequestTiming
+from proxy_client import InferenceError
+from scoring import reference_images
+
+RETRYABLE_STATUSES = {408, 429}
+
+
+def retryable(error: BaseException) -> bool:
+    """Errors caused by the provider or the network, which other provider may not hit."""
+    if isinstance(error, InferenceError):
+        return error.status >= 500 or error.status in RETRYABLE_STATUSES
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError))
+
+
+@dataclass
+class RequestPolicy:
+    attempts: int = 3
+    """Maximum number of requests sent for a single prompt, hedges included."""
+
+    deadline: Optional[float] = None
+    """Time limit for the prompt, covering queueing, retries and hedges."""
+
+    hedge: bool = False
+    """Send duplicate to another provider if the first one is slower than usual."""
+
+    hedge_quantile: float = 0.95
+    """Quantile of observed request durations per reference image in the pool, scaled to
+    the size of the request, after which hedge is sent. Time in the queue is not counted."""
+
+    hedge_delay: float = 60.0
+    """Hedge delay used until `min_observations` durations are recorded in the pool."""
+
+    min_observations: int = 20
+
+
+@dataclass
+class Attempt:
+    """Single request sent on behalf of a prompt.
+
+    Every attempt writes images to its own files, so concurrent hedged attempts
+    never overwrite each other; the winner's files are renamed to final paths.
+    """
+
+    index: int
+    payload: dict
+    path_for: Callable[[int], Path]
+    timing: RequestTiming = field(default_factory=RequestTiming)
+    instance: Any = None
+    dispatched_at: Optional[float] = None
+    paths: List[Path] = field(default_factory=list)
+    dispatched: asyncio.Event = field(default_factory=asyncio.Event)
+    finished: asyncio.Event = field(default_factory=asyncio.Event)
+
+    def attempt_path(self, index: int) -> Path:
+        final = self.path_for(index)
+        path = final.with_name(f"{final.stem}.attempt{self.index}{final.suffix}")
+        self.paths.append(path)
+        return path
+
+    def promote(self, result: dict) -> dict:
+        images = []
+        for index, image in enumerate(result.get("images", [])):
+            final = self.path_for(index)
+            Path(image).replace(final)
+            images.append(str(final))
+        return {**result, "images": images}
+
+    async def discard(self):
+        if self.instance is None:
+            # Cancelled while still queued, handler never ran.
+            return
+        await self.finished.wait()
+        for path in self.paths:
+            path.unlink(missing_ok=True)
+
+
+def attempt_handler(handler: Callable[..., Awaitable[dict]]) -> Callable[..., Awaitable[dict]]:
+    """Adapt `handler(target, payload, path_for, timing)` to be used with `ResilientRequester`."""
+
+    async def handle(target, payload: dict, attempt: Attempt) -> dict:
+        attempt.instance = target.service_id
+        attempt.dispatched_at = asyncio.get_running_loop().time()
+        attempt.dispatched.set()
+        try:
+            return await handler(target, payload, attempt.attempt_path, attempt.timing)
+        finally:
+            attempt.finished.set()
+
+    return handle
+
+
+class ResilientRequester:
+    """Sends prompts through the dispatcher, retrying and hedging them on other instances.
+
+    Dispatcher must be created with handler wrapped by `attempt_handler`.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, policy: RequestPolicy, metrics: Metrics):
+        self.dispatcher = dispatcher
+        self.policy = policy
+        self.metrics = metrics
+        self._image_seconds: Dict[Hashable, Histogram] = {}
+        self._background: Set[asyncio.Task] = set()
+
+    def hedge_delay(self, pool: Hashable = None, work: float = 1.0) -> float:
+        """Time after dispatch to hedge a request of `work` reference images sent to `pool`.
+
+        Models and image sizes differ in speed, so durations per reference image are
+        kept for every pool.
+        """
+        observed = self._image_seconds.get(pool)
+        if observed is None or observed.count < self.policy.min_observations:
+            return self.policy.hedge_delay
+        return observed.quantile(self.policy.hedge_quantile) * work
+
+    def _observe(self, pool: Hashable, timing: RequestTiming):
+        if timing.total is not None:
+            histogram = self._image_seconds.setdefault(pool, Histogram(LATENCY_BUCKETS))
+            histogram.observe(timing.total / timing.work)
+
+    async def submit(self, payload: dict, path_for: Callable[[int], Path], pool: Hashable = None) -> dict:
+        """Send `payload` to instances of the dispatcher `pool`, any instance if it is None."""
+        if self.policy.deadline is None:
+            return await self._submit(payload, path_for, pool)
+        return await asyncio.wait_for(self._submit(payload, path_for, pool), self.policy.deadline)
+
+    async def _submit(self, payload: dict, path_for: Callable[[int], Path], pool: Hashable) -> dict:
+        running: Dict[asyncio.Future, Attempt] = {}
+        tried: Set = set()
+        launched = 0
+        last_error: Optional[BaseException] = None
+
+        def busy() -> Set:
+            return {a.instance for a in running.values() if a.instance is not None}
+
+        def launch():
+            nonlocal launched
+            attempt = Attempt(launched, payload, path_for)
+            launched += 1
+            future = self.dispatcher.submit(payload, attempt, exclude=frozenset(tried | busy()), pool=pool)
+            running[future] = attempt
+
+        loop = asyncio.get_running_loop()
+        work = reference_images(payload)
+        launch()
+        try:
+            while running:
+                timeout = None
+                if self.policy.hedge and len(running) == 1 and launched < self.policy.attempts:
+                    attempt = next(iter(running.values()))
+                    if attempt.dispatched_at is None:
+                        # Waiting in the queue is no reason to hedge, start the timer on dispatch.
+                        dispatched = asyncio.ensure_future(attempt.dispatched.wait())
+                        try:
+                            await asyncio.wait([*running, dispatched], return_when=asyncio.FIRST_COMPLETED)
+                        finally:
+                            dispatched.cancel()
+                    if attempt.dispatched_at is not None:
+                        elapsed = loop.time() - attempt.dispatched_at
+                        timeout = max(self.hedge_delay(pool, work) - elapsed, 0.0)
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if self.dispatcher.has_free_instance(tried | busy(), pool):
+                        launch()
+                    else:
+                        # Nobody to hedge with right now, wait for the request without timer.
+                        await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+
+                for future in done:
+                    attempt = running.pop(future)
+                    if attempt.instance is not None:
+                        tried.add(attempt.instance)
+                    error = future.exception()
+                    if error is None:
+                        self.metrics.record(attempt.timing)
+                        self._observe(pool, attempt.timing)
+                        return attempt.promote(future.result())
+
+                    # Requests the runtime rejected as invalid would fail on any provider.
+                    attempt.timing.status = "error" if retryable(error) else "rejected"
+                    self.metrics.record(attempt.timing)
+                    self._discard(attempt)
+                    last_error = error
+                    if not retryable(error):
+                        raise error
+
+                if not running and launched < self.policy.attempts:
+                    print(f"Retrying on another provider after: {last_error!r}")
+                    launch()
+
+            assert last_error is not None
+            raise last_error
+        finally:
+            # Losers of a hedge, or everything still in flight when deadline expired.
+            for future, attempt in running.items():
+                future.cancel()
+                attempt.timing.status = "cancelled"
+                self.metrics.record(attempt.timing)
+                self._discard(attempt)
+
+    def _discard(self, attempt: Attempt):
+        task = asyncio.create_task(attempt.discard())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
@@ -0,0 +1,169 @@
+"""Price/performance scoring of offers from GAP-35 GPU properties and linear pricing."""
+import re
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from yapapi.strategy import SCORE_NEUTRAL, SCORE_REJECTED, SCORE_TRUSTED
+
+GAP_35 = "golem.!exp.gap-35.v1.inf.gpu"
+PROP_PRICING_COEFFS = "golem.com.pricing.model.linear.coeffs"
+PROP_USAGE_VECTOR = "golem.com.usage.vector"
+REQUESTS_COUNTER = "ai-runtime.requests"
+
+# Speed is estimated from FP32 throughput (CUDA cores * graphics clock), relative
+# to RTX 3090 generating a 512x512 image in 20 steps in about 2 seconds.
+REFERENCE_CUDA_CORES = 10496
+REFERENCE_GRAPHICS_MHZ = 1695
+REFERENCE_SECONDS_PER_IMAGE = 2.0
+REFERENCE_STEPS = 20
+REFERENCE_PIXELS = 512 * 512
+API_DEFAULT_STEPS = 50
+
+
+@dataclass
+class GpuInfo:
+    model: str
+    memory_gib: float
+    cuda_cores: int
+    graphics_mhz: float
+    memory_mhz: Optional[float] = None
+    compute_capability: Optional[str] = None
+
+    @classmethod
+    def from_props(cls, props: Dict) -> Optional["GpuInfo"]:
+        try:
+            return cls(
+                model=props[f"{GAP_35}.model"],
+                memory_gib=float(props[f"{GAP_35}.memory.total.gib"]),
+                cuda_cores=int(props[f"{GAP_35}.cuda.cores"]),
+                graphics_mhz=float(props[f"{GAP_35}.clocks.graphics.mhz"]),
+                memory_mhz=props.get(f"{GAP_35}.clocks.memory.mhz"),
+                compute_capability=props.get(f"{GAP_35}.cuda.compute-capability"),
+            )
+        except (KeyError, TypeError, ValueError):
+            return None
+
+
+def reference_images(payload: dict) -> float:
+    """Work of a txt2img request as a number of reference images, 512x512 in 20 steps.
+
+    Generation time grows about linearly with steps, number of images and pixels,
+    so request duration divided by this compares with `seconds_per_image` estimates.
+    """
+    try:
+        steps = int(payload.get("steps", API_DEFAULT_STEPS))
+        images = int(payload.get("batch_size", 1)) * int(payload.get("n_iter", 1))
+        pixels = int(payload.get("width", 512)) * int(payload.get("height", 512))
+    except (TypeError, ValueError):
+        return 1.0
+    return max(steps, 1) * max(images, 1) * max(pixels, 1) / (REFERENCE_STEPS * REFERENCE_PIXELS)
+
+
+def cost_per_image(props: Dict, seconds_per_image: float) -> Optional[float]:
+    """Expected GLM paid for one image on a fully utilized provider, from linear pricing.
+
+    Time based counters (`golem.usage.duration_sec`, `golem.usage.gpu-sec`, ...)
+    are charged for `seconds_per_image`, `ai-runtime.requests` once.
+    Start price is not included, it does not depend on the number of images.
+    """
+    coeffs = props.get(PROP_PRICING_COEFFS)
+    usage_vector = props.get(PROP_USAGE_VECTOR)
+    if not isinstance(coeffs, list) or not isinstance(usage_vector, list) or len(coeffs) < len(usage_vector):
+        return None
+    cost = 0.0
+    for counter, price in zip(usage_vector, coeffs):
+        cost += float(price) * (1.0 if counter == REQUESTS_COUNTER else seconds_per_image)
+    return cost
+
+
+@dataclass
+class ScoringOptions:
+    """Hard filters. Offers failing any of them are rejected."""
+
+    gpu_model: Optional[str] = None
+    min_vram_gib: float = 0.0
+    max_seconds_per_image: Optional[float] = None
+    max_cost_per_image: Optional[float] = None
+    require_gpu: bool = False
+    reference_seconds_per_image: float = REFERENCE_SECONDS_PER_IMAGE
+
+
+@dataclass
+class OfferEstimate:
+    gpu: Optional[GpuInfo]
+    seconds_per_image: Optional[float]
+    cost_per_image: Optional[float]
+    reliability: float = 1.0
+    """Fraction of hires expected to end with served requests, from provider's track record."""
+
+    @property
+    def images_per_glm(self) -> Optional[float]:
+        if self.cost_per_image is None:
+            return None
+        return float("inf") if self.cost_per_image <= 0 else self.reliability / self.cost_per_image
+
+    def describe(self) -> str:
+        if self.gpu is None:
+            return "no GPU info"
+        if self.seconds_per_image is None:
+            return f"{self.gpu.model}, {self.gpu.memory_gib:.0f} GiB, no speed estimate"
+        cost = "unknown" if self.cost_per_image is None else f"{self.cost_per_image:.3g} GLM"
+        return f"{self.gpu.model}, {self.gpu.memory_gib:.0f} GiB, {self.seconds_per_image:.2f}s and {cost} per image"
+
+
+class OfferScorer:
+    """Ranks offers by expected images per GLM.
+
+    Score grows with images per GLM and stays below `SCORE_TRUSTED`; free offers
+    get `SCORE_TRUSTED`. Offers without GPU properties or pricing get
+    `SCORE_NEUTRAL`, so they are hired only when nothing better is available.
+    """
+
+    def __init__(self, options: Optional[ScoringOptions] = None):
+        self.options = options or ScoringOptions()
+        self._gpu_model = re.compile(self.options.gpu_model) if self.options.gpu_model else None
+
+    def estimate(
+        self, props: Dict, measured_seconds: Optional[float] = None, reliability: float = 1.0
+    ) -> OfferEstimate:
+        """Estimate from offer properties. Time per reference image measured on this provider
+        before, if known, replaces the one derived from GPU properties."""
+        gpu = GpuInfo.from_props(props)
+        seconds = measured_seconds
+        if seconds is None and gpu is not None and gpu.cuda_cores > 0 and gpu.graphics_mhz > 0:
+            seconds = self.options.reference_seconds_per_image * (
+                REFERENCE_CUDA_CORES * REFERENCE_GRAPHICS_MHZ / (gpu.cuda_cores * gpu.graphics_mhz)
+            )
+        if seconds is None:
+            return OfferEstimate(gpu, None, None, reliability)
+        return OfferEstimate(gpu, seconds, cost_per_image(props, seconds), reliability)
+
+    def rejection(self, estimate: OfferEstimate) -> Optional[str]:
+        """Reason why offer fails hard filters, None if it passes."""
+        options = self.options
+        gpu = estimate.gpu
+        if gpu is None:
+            filtered = options.require_gpu or options.gpu_model or options.min_vram_gib > 0
+            return "no GPU info" if filtered else None
+        if self._gpu_model is not None and not self._gpu_model.search(gpu.model):
+            return f"GPU {gpu.model} does not match {options.gpu_model}"
+        if gpu.memory_gib < options.min_vram_gib:
+            return f"{gpu.memory_gib:.1f} GiB VRAM, required {options.min_vram_gib}"
+        seconds = estimate.seconds_per_image
+        if options.max_seconds_per_image is not None and seconds is not None and seconds > options.max_seconds_per_image:
+            return f"expected {seconds:.2f}s per image, limit {options.max_seconds_per_image}"
+        cost = estimate.cost_per_image
+        if options.max_cost_per_image is not None and (cost is None or cost > options.max_cost_per_image):
+            return f"expected {cost} GLM per image, limit {options.max_cost_per_image}"
+        return None
+
+    def score(self, estimate: OfferEstimate) -> float:
+        if self.rejection(estimate) is not None:
+            return SCORE_REJECTED
+        value = estimate.images_per_glm
+        if value is None:
+            return SCORE_NEUTRAL
+        if value == float("inf"):
+            return SCORE_TRUSTED
+        return SCORE_TRUSTED * value / (value + 1.0)
+
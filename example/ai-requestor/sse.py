@@ -0,0 +1,109 @@
+"""Incremental parser of `text/event-stream` responses."""
+from typing import Callable, List, Optional
+
+RESULT_EVENT = "result"
+
+
+class SseParser:
+    """Splits Server-Sent Events stream into events, as bytes arrive.
+
+    Events are small, except for the final `result` event carrying whole txt2img
+    response. Its data is passed to `on_result` chunk by chunk, without waiting
+    for the end of line, so images can be decoded while they are downloaded.
+    All other events are buffered and passed to `on_event(name, data)`.
+    """
+
+    def __init__(
+        self,
+        on_event: Callable[[str, str], None],
+        on_result: Callable[[bytes], None],
+        on_result_end: Optional[Callable[[], None]] = None,
+    ):
+        self._on_event = on_event
+        self._on_result = on_result
+        self._on_result_end = on_result_end
+        self._line = bytearray()
+        self._event = "message"
+        self._data: List[str] = []
+        self._streaming = False
+        self._skip_space = False
+        self._has_result = False
+        self._pending_cr = False
+
+    def feed(self, chunk: bytes):
+        pos = 0
+        while pos < len(chunk):
+            newline = chunk.find(b"\n", pos)
+            end = len(chunk) if newline == -1 else newline
+
+            if self._streaming:
+                piece = chunk[pos:end]
+                if self._skip_space and piece:
+                    piece = piece[1:] if piece.startswith(b" ") else piece
+                    self._skip_space = False
+                self._stream(piece, newline != -1)
+                if newline != -1:
+                    self._streaming = False
+                pos = end + 1
+                continue
+
+            self._line += chunk[pos:end]
+            if newline == -1:
+                if self._event == RESULT_EVENT and self._line.startswith(b"data:"):
+                    self._start_result(bytes(self._line[5:]))
+                return
+            line = bytes(self._line).rstrip(b"\r")
+            self._line.clear()
+            pos = end + 1
+            self._line_complete(line)
+
+    def _start_result(self, data: bytes):
+        self._line.clear()
+        self._has_result = True
+        self._streaming = True
+        self._skip_space = not data
+        if data.startswith(b" "):
+            data = data[1:]
+        self._stream(data, False)
+
+    def _stream(self, piece: bytes, line_end: bool):
+        # `\r` ending a chunk may be the first half of a CRLF split between chunks,
+        # hold it back until the next byte shows whether it ends the line.
+        if self._pending_cr:
+            self._pending_cr = False
+            if piece or not line_end:
+                piece = b"\r" + piece
+        if piece.endswith(b"\r"):
+            piece = piece[:-1]
+            self._pending_cr = not line_end
+        if piece:
+            self._on_result(piece)
+
+    def _line_complete(self, line: bytes):
+        if not line:
+            self._dispatch()
+            return
+        if line.startswith(b":"):
+            # Comment, used as keep-alive.
+            return
+        name, _, value = line.partition(b":")
+        if value.startswith(b" "):
+            value = value[1:]
+        if name == b"event":
+            self._event = value.decode("utf-8")
+        elif name == b"data":
+            if self._event == RESULT_EVENT:
+                self._has_result = True
+                self._on_result(value)
+            else:
+                self._data.append(value.decode("utf-8"))
+
+    def _dispatch(self):
+        if self._event == RESULT_EVENT:
+            if self._has_result and self._on_result_end is not None:
+                self._on_result_end()
+        elif self._data:
+            self._on_event(self._event, "\n".join(self._data))
+        self._event = "message"
+        self._data = []
+        self._has_result = False
@@ -0,0 +1,60 @@
+"""Machine readable feed of service instance state changes, one JSON object per line."""
+import json
+import os
+import time
+from typing import IO, Optional
+
+from yapapi import events
+
+
+def open_channel(spec: str) -> IO[str]:
+    """Open feed destination: `fd:N` for a descriptor inherited from parent process,
+    otherwise a path of a file, FIFO or Windows named pipe (`\\\\.\\pipe\\name`)."""
+    if spec.startswith("fd:"):
+        return os.fdopen(int(spec[3:]), "w", buffering=1, encoding="utf-8")
+    return open(spec, "a", buffering=1, encoding="utf-8")
+
+
+class StateFeed:
+    """Writes a line for every `ServiceStateChanged` event, as soon as yapapi emits it.
+
+    Register with `golem.add_event_consumer(feed.consume, [ServiceStateChanged])`.
+    Lines look like:
+
+        {"ts": 1718000000.123, "event": "state", "service": "...", "provider_id": "0x...", "provider_name": "...",
+         "activity": "...", "old": "starting", "new": "running"}
+    """
+
+    def __init__(self, channel: Optional[IO[str]] = None, echo: bool = True):
+        self._channel = channel
+        self._echo = echo
+
+    def consume(self, event: events.ServiceStateChanged):
+        service = event.service
+        record = {
+            "ts": round(time.time(), 3),
+            "event": "state",
+            "service": service.id,
+            "provider_id": service.provider_id,
+            "provider_name": service.provider_name,
+            "activity": event.activity.id if event.activity is not None else None,
+            "old": event.old.value,
+            "new": event.new.value,
+        }
+        if self._echo:
+            print(f"instance {service.provider_name}: {event.old.value} -> {event.new.value}")
+        self.emit(record)
+
+    def emit(self, record: dict):
+        if self._channel is None:
+            return
+        try:
+            self._channel.write(json.dumps(record, separators=(",", ":")) + "\n")
+        except (BrokenPipeError, ValueError):
+            # Reader went away, keep running without the feed.
+            self._channel = None
+
+    def close(self):
+        if self._channel is not None:
+            self._channel.close()
+            self._channel = None
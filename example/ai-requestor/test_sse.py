@@ -0,0 +1,49 @@
+import unittest
+
+from sse import SseParser
+
+RESULT = b'{"images":["iVBORw0KGgo="],"info":"{}"}'
+STREAM = (
+    b": keep-alive\r\n"
+    b"\r\n"
+    b"event: progress\r\n"
+    b'data: {"progress": 0.5}\r\n'
+    b"\r\n"
+    b"event: result\r\n"
+    b"data: " + RESULT + b"\r\n"
+    b"\r\n"
+)
+
+
+def parse(chunks):
+    events, result, ends = [], bytearray(), []
+    parser = SseParser(
+        lambda name, data: events.append((name, data)), result.extend, lambda: ends.append(bytes(result))
+    )
+    for chunk in chunks:
+        parser.feed(chunk)
+    return events, bytes(result), ends
+
+
+class SseParserTest(unittest.TestCase):
+    def test_whole_stream(self):
+        self.assertEqual(parse([STREAM]), ([("progress", '{"progress": 0.5}')], RESULT, [RESULT]))
+
+    def test_split_at_every_offset(self):
+        expected = parse([STREAM])
+        for offset in range(1, len(STREAM)):
+            with self.subTest(offset=offset, at=STREAM[offset - 1:offset + 1]):
+                self.assertEqual(parse([STREAM[:offset], STREAM[offset:]]), expected)
+
+    def test_byte_by_byte(self):
+        self.assertEqual(parse([STREAM[i:i + 1] for i in range(len(STREAM))]), parse([STREAM]))
+
+    def test_carriage_return_inside_data_is_kept(self):
+        stream = b"event: result\r\ndata: a\rb\r\n\r\n"
+        for offset in range(1, len(stream)):
+            with self.subTest(offset=offset):
+                self.assertEqual(parse([stream[:offset], stream[offset:]])[1], b"a\rb")
+
+
+if __name__ == "__main__":
+    unittest.main()